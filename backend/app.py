@@ -1,21 +1,69 @@
-from fastapi import FastAPI, HTTPException, Depends
+import startup  # first, so the imports below are timed
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, Any, Dict, List
-from parser_ai import parse_document_ai
-from sqlalchemy.orm import Session
-import re
+from parser_ai import PROMPT_VERSION, parse_document_ai, parse_prompt
+from dsl import DSLSyntaxError, parse_formula
+from engine import PlanError
+from plan_cache import (
+    get_plan,
+    get_state,
+    save_state,
+    get_formula_plan,
+    get_department_plan,
+    plan_cache,
+    formula_plan_cache,
+    department_plan_cache,
+    state_cache,
+)
+from cohort import DEFAULT_CHUNK_SIZE, FORMATS, guess_format, score_body
+import parse_cache
+import formula_io
+import metrics
+import profiling
+from llm import (
+    GEMINI_MODEL,
+    LLMCancelledError,
+    LLMNotConfiguredError,
+    LLM_MAX_WORKERS,
+    LLMTimeoutError,
+    check_configured,
+    get_provider,
+    prompt_key,
+    run_llm,
+    single_flight,
+    stream_llm,
+    shutdown as shutdown_llm,
+)
+from chat_stream import FormulaStreamSplitter, split_formula_reply, sse
+from sqlalchemy.ext.asyncio import AsyncSession
 
+import json
 import os
+import time
 
 # Database imports
-from database import get_db, init_db
+from database import SessionLocal, ensure_database_exists, get_db
+from field_registry import get_registry
+from http_cache import conditional_get
 import crud
 import schemas
 
+startup.mark("imports")
+
 # Get root path from environment variable (for reverse proxy support)
 ROOT_PATH = os.getenv("ROOT_PATH", "")
 
+# Run migrate.py's create + seed on every worker boot (development convenience)
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() in ("1", "true", "yes")
+
+# Page size of GET /formulas (default and largest allowed `limit`)
+FORMULA_PAGE_SIZE = int(os.getenv("FORMULA_PAGE_SIZE", "100"))
+FORMULA_PAGE_MAX = int(os.getenv("FORMULA_PAGE_MAX", "1000"))
+
 app = FastAPI(
     title="Medical Blockly API",
     root_path=ROOT_PATH,
@@ -23,6 +71,8 @@ app = FastAPI(
     docs_url="/docs",
     redoc_url="/redoc"
 )
+# Per-route latency / in-flight metrics (must precede the route declarations)
+app.router.route_class = metrics.MetricsRoute
 
 # CORS configuration
 app.add_middleware(
@@ -31,424 +81,306 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 # Pydantic models for request validation
 class ParseRequest(BaseModel):
     text: str
+    bypass_cache: Optional[bool] = False
 
 class CalculateRequest(BaseModel):
     ast: Dict[str, Any]
     inputs: Optional[Dict[str, Any]] = {}
 
+class IncrementalCalculateRequest(BaseModel):
+    ast: Dict[str, Any]
+    inputs: Optional[Dict[str, Any]] = {}
+    state_id: Optional[str] = None
+
+class FormulaCalculateRequest(BaseModel):
+    inputs: Optional[Dict[str, Any]] = {}
+
+class BatchCalculateRequest(BaseModel):
+    ast: Dict[str, Any]
+    rows: Optional[List[Dict[str, Any]]] = None
+    columns: Optional[Dict[str, List[Any]]] = None
+
 class ChatRequest(BaseModel):
     message: str
 
+def _profile_mode(http_request: Request, profile: Optional[str]):
+    """Profiling mode a request asked for (see profiling.py), as HTTP errors."""
+    try:
+        return profiling.requested_mode(http_request, profile)
+    except profiling.ProfilingDisabledError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post('/parse')
-async def parse_rule_doc(request: ParseRequest):
+async def parse_rule_doc(
+    request: ParseRequest,
+    http_request: Request,
+    profile: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
     text = request.text
+    mode = _profile_mode(http_request, profile)
+    started = time.perf_counter()
     try:
         # Check if it's a structured format (formula, score, or combined)
         if any(keyword in text.lower() for keyword in ['formula:', 'formula_name:', 'formulas:', 'score_name:']):
             # Parse using local parser
-            ast = parse_formula(text)
+            sections = {} if mode else None
+            with metrics.PARSE_LATENCY.time("dsl"):
+                ast, report = profiling.run(parse_formula, mode, text, sections)
+            if mode:
+                ast = {**ast, "profile": {
+                    "parser": "dsl",
+                    "seconds": time.perf_counter() - started,
+                    "sections": sections,
+                    "cprofile": report,
+                }}
         else:
-            # Use AI Parser for natural language
-            ast = parse_document_ai(text)
+            model_seconds = []
+
+            async def parse_with_model(t):
+                began = time.perf_counter()
+                try:
+                    return await run_llm(
+                        parse_document_ai, t, request=http_request,
+                        key=prompt_key(GEMINI_MODEL, parse_prompt(t)),
+                    )
+                finally:
+                    model_seconds.append(time.perf_counter() - began)
+
+            # Use AI Parser for natural language (cached by text, model and prompt),
+            # off the event loop and shared with identical parses in flight.
+            with metrics.PARSE_LATENCY.time("ai"):
+                ast = await parse_cache.cached_parse(
+                    db, text, parse_with_model,
+                    GEMINI_MODEL, PROMPT_VERSION, bypass=request.bypass_cache,
+                )
+            if mode:
+                # The model call is awaited, so there is no synchronous work to cProfile.
+                ast = {**ast, "profile": {
+                    "parser": "ai",
+                    "seconds": time.perf_counter() - started,
+                    "cache_hit": not model_seconds,
+                    "model_seconds": model_seconds[0] if model_seconds else None,
+                    "cprofile": None,
+                }}
         return ast
+    except DSLSyntaxError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except LLMTimeoutError as e:
+        raise HTTPException(status_code=504, detail=f"AI Parsing timed out: {e}")
+    except LLMCancelledError:
+        raise HTTPException(status_code=499, detail="Client closed request")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def parse_formula(text):
-    """Parse formula, score, or combined score_with_formula format"""
-    lines = text.strip().split('\n')
-    ast = {
-        "variables": {},
-        "type": "formula"
-    }
-    
-    current_section = None
-    current_rule = None
-    current_risk = None
-    
-    for line in lines:
-        line_stripped = line.strip()
-        if not line_stripped:
-            continue
-            
-        if line_stripped.startswith('formula_name:'):
-            ast['formula_name'] = line_stripped.split(':', 1)[1].strip()
-            ast['type'] = 'formula'
-        elif line_stripped.startswith('score_name:'):
-            ast['score_name'] = line_stripped.split(':', 1)[1].strip()
-            ast['type'] = 'score'
-        elif line_stripped.startswith('variables:'):
-            current_section = 'variables'
-        elif line_stripped.startswith('formulas:'):
-            current_section = 'formulas'
-            ast['formulas'] = {}
-            ast['type'] = 'score_with_formula'
-        elif line_stripped.startswith('rules:'):
-            current_section = 'rules'
-            ast['rules'] = []
-        elif line_stripped.startswith('risk_levels:'):
-            current_section = 'risk_levels'
-            ast['risk_levels'] = []
-        elif line_stripped.startswith('formula:') and current_section != 'formulas':
-            ast['formula'] = line_stripped.split(':', 1)[1].strip()
-        elif current_section == 'variables' and ':' in line_stripped:
-            parts = line_stripped.split(':')
-            var_name = parts[0].strip()
-            var_type = parts[1].strip() if len(parts) > 1 else 'int'
-            ast['variables'][var_name] = var_type
-        elif current_section == 'formulas' and ':' in line_stripped:
-            parts = line_stripped.split(':', 1)
-            formula_name = parts[0].strip()
-            formula_expr = parts[1].strip() if len(parts) > 1 else ''
-            ast['formulas'][formula_name] = formula_expr
-        elif current_section == 'rules':
-            if line_stripped.startswith('- if:') or line_stripped.startswith('if:'):
-                # New rule
-                cond_str = line_stripped.split('if:', 1)[1].strip()
-                current_rule = {'condition_str': cond_str}
-                ast['rules'].append(current_rule)
-            elif line_stripped.startswith('add:') and current_rule:
-                add_val = int(line_stripped.split(':', 1)[1].strip())
-                current_rule['action'] = {'type': 'add', 'value': add_val}
-                # Parse condition string
-                cond_str = current_rule.pop('condition_str', '')
-                current_rule['condition'] = parse_condition_str(cond_str)
-        elif current_section == 'risk_levels':
-            if line_stripped.startswith('- if:') or line_stripped.startswith('if:'):
-                cond_str = line_stripped.split('if:', 1)[1].strip()
-                current_risk = {'condition_str': cond_str}
-                ast['risk_levels'].append(current_risk)
-            elif line_stripped.startswith('text:') and current_risk:
-                text_val = line_stripped.split(':', 1)[1].strip()
-                current_risk['text'] = text_val
-                cond_str = current_risk.pop('condition_str', '')
-                current_risk['condition'] = parse_condition_str(cond_str)
-    
-    return ast
-
-def parse_condition_str(cond_str):
-    """Parse condition string like 'BMI >= 25' or 'age > 50 and has_disease' into structured format"""
-    import re
-    cond_str = cond_str.strip()
-    
-    # Check for compound conditions with 'or' (lower precedence)
-    # Split on ' or ' not inside parentheses
-    or_parts = split_on_operator(cond_str, ' or ')
-    if len(or_parts) > 1:
-        return {
-            'compound': 'or',
-            'conditions': [parse_condition_str(part) for part in or_parts]
-        }
-    
-    # Check for compound conditions with 'and' (higher precedence)
-    and_parts = split_on_operator(cond_str, ' and ')
-    if len(and_parts) > 1:
-        return {
-            'compound': 'and',
-            'conditions': [parse_condition_str(part) for part in and_parts]
-        }
-    
-    # Remove parentheses if wrapped
-    if cond_str.startswith('(') and cond_str.endswith(')'):
-        cond_str = cond_str[1:-1].strip()
-    
-    # Single condition: match pattern like BMI >= 25 or diabetes_present is true
-    # Added support for 'is' and 'is not' operators
-    pattern = r'^(\w+)\s*(>=|<=|==|>|<|is\s+not|is)\s*(.+)$'
-    match = re.match(pattern, cond_str, re.IGNORECASE)
-    if match:
-        left = match.group(1)
-        op = match.group(2).strip().lower()
-        right_str = match.group(3).strip()
-        
-        # Map 'is' to '==' and 'is not' to '!='
-        if op == 'is':
-            op = '=='
-        elif op == 'is not':
-            op = '!='
-        
-        # Convert right value
-        if right_str.lower() == 'true':
-            right = True
-        elif right_str.lower() == 'false':
-            right = False
-        else:
-            try:
-                # Try float first (handles both "3" and "3.0")
-                right = float(right_str)
-                # Convert to int if it's a whole number
-                if right == int(right):
-                    right = int(right)
-            except:
-                right = right_str
-        
-        return {'op': op, 'left': left, 'right': right}
-    
-    # Simple boolean variable (e.g., "diabetes_present" alone means == true)
-    if cond_str.isidentifier():
-        return {'op': '==', 'left': cond_str, 'right': True}
-    
-    # Return None for unparseable conditions (will be skipped)
-    print(f"Warning: Could not parse condition: '{cond_str}'")
-    return None
-
-def evaluate_condition(cond, context):
-    """Evaluate condition (simple or compound) against context values"""
-    if not cond:
-        return False
-    
-    # Handle compound conditions (and/or)
-    if 'compound' in cond:
-        compound_type = cond['compound']
-        sub_conditions = cond.get('conditions', [])
-        
-        if compound_type == 'and':
-            return all(evaluate_condition(sub, context) for sub in sub_conditions)
-        elif compound_type == 'or':
-            return any(evaluate_condition(sub, context) for sub in sub_conditions)
-        return False
-    
-    # Simple condition
-    if not cond.get('left') or not cond.get('op'):
-        return False
-    
-    left_val = context.get(cond['left'])
-    right_val = cond.get('right', 0)
-    op = cond['op']
-    
-    if left_val is None:
-        return False
-    
-    try:
-        if op == ">=":
-            return left_val >= right_val
-        elif op == "<=":
-            return left_val <= right_val
-        elif op == "==":
-            return left_val == right_val
-        elif op == ">":
-            return left_val > right_val
-        elif op == "<":
-            return left_val < right_val
-    except TypeError:
-        return False
-    
-    return False
-
-def split_on_operator(s, op):
-    """Split string on operator, respecting parentheses"""
-    parts = []
-    depth = 0
-    current = ""
-    i = 0
-    while i < len(s):
-        if s[i] == '(':
-            depth += 1
-            current += s[i]
-        elif s[i] == ')':
-            depth -= 1
-            current += s[i]
-        elif depth == 0 and s[i:i+len(op)] == op:
-            parts.append(current.strip())
-            current = ""
-            i += len(op) - 1
-        else:
-            current += s[i]
-        i += 1
-    if current.strip():
-        parts.append(current.strip())
-    return parts
+@app.get('/parse/cache')
+async def parse_cache_stats(db: AsyncSession = Depends(get_db)):
+    """Hit statistics of the AI parse cache."""
+    return await parse_cache.stats(db)
+
+async def _patient_fields(db: Optional[AsyncSession] = None):
+    """The cached patient-field registry.
+
+    With ``db`` the snapshot is checked against the shared version counter;
+    without it (/calculate) it is reused for a few seconds, and a database
+    failure only skips the input coercion.
+    """
+    async def load_fields():
+        if db is not None:
+            return await crud.get_patient_fields(db)
+        async with SessionLocal() as session:
+            return await crud.get_patient_fields(session)
+
+    async def load_version():
+        return await crud.get_versions(db, crud.PATIENT_FIELD_TABLES)
+
+    return await get_registry(load_fields, load_version if db is not None else None)
+
+def _evaluate(plan, inputs):
+    """``plan.evaluate(inputs)``, recording its stage timings."""
+    timings = {}
+    result = plan.evaluate(inputs, timings)
+    for stage, seconds in timings.items():
+        metrics.CALCULATE_STAGE.observe(seconds, stage)
+    return result
+
+def _traced_calculate(ast, inputs):
+    """/calculate with its evaluation trace under "profile"."""
+    started = time.perf_counter()
+    plan = get_plan(ast)
+    compiled = time.perf_counter()
+    state, trace = plan.trace(inputs)
+    result = plan.render(state)
+    return {**result, "profile": {
+        **trace,
+        "compile_seconds": compiled - started,
+        "seconds": time.perf_counter() - started,
+    }}
 
 @app.post('/calculate')
-async def calculate_score(request: CalculateRequest):
+async def calculate_score(
+    request: CalculateRequest, http_request: Request, profile: Optional[str] = None
+):
     ast = request.ast
-    inputs = request.inputs or {}
+    inputs = (await _patient_fields()).coerce(request.inputs or {})
+    mode = _profile_mode(http_request, profile)
     
     try:
-        # Setup safe eval environment
-        import math
-        allowed_names = {"__builtins__": {}}
-        allowed_names['sqrt'] = math.sqrt
-        allowed_names['pow'] = pow
-        allowed_names['abs'] = abs
-        allowed_names['True'] = True
-        allowed_names['False'] = False
-        
-        # Create a context with all input values (convert booleans properly)
-        context = {}
-        for k, v in inputs.items():
-            if isinstance(v, bool):
-                context[k] = v
-            elif isinstance(v, str) and v.lower() in ('true', 'false'):
-                context[k] = v.lower() == 'true'
-            else:
-                context[k] = v
-        
-        # Step 1: Evaluate any formulas first (in order, as later formulas may depend on earlier ones)
-        if ast.get('formulas'):
-            for formula_name, formula_expr in ast['formulas'].items():
-                # Replace variables with values
-                expr = formula_expr
-                for var_name, var_value in context.items():
-                    # Convert Python booleans to proper format for eval
-                    if isinstance(var_value, bool):
-                        replacement = 'True' if var_value else 'False'
-                    else:
-                        replacement = str(var_value)
-                    expr = re.sub(r'\b' + var_name + r'\b', replacement, expr)
-                
-                # Handle 'if...else' conditional expressions (convert to Python ternary)
-                # Pattern: "value1 if condition else value2"
-                # This is already valid Python syntax, just needs proper boolean handling
-                expr = expr.replace(' true ', ' True ').replace(' false ', ' False ')
-                expr = expr.replace('(true)', '(True)').replace('(false)', '(False)')
-                
-                # Evaluate and store result
-                try:
-                    result = eval(expr, allowed_names)
-                    context[formula_name] = result
-                except Exception as e:
-                    # If formula fails, store error message but continue
-                    context[formula_name] = 0
-                    print(f"Formula error for {formula_name}: {e}")
-        
-        # Step 2: Check if pure formula type
-        if ast.get('type') == 'formula' and ast.get('formula'):
-            formula = ast['formula']
-            for var_name, var_value in context.items():
-                formula = re.sub(r'\b' + var_name + r'\b', str(var_value), formula)
-            result = eval(formula, allowed_names)
-            result = round(result, 2)
-
-            # Evaluate risk_levels against the computed result (treated as "score")
-            risk_level = None
-            if ast.get('risk_levels'):
-                risk_context = {**context, 'score': result}
-                for risk in ast['risk_levels']:
-                    if not risk or 'condition' not in risk:
-                        continue
-                    if evaluate_condition(risk['condition'], risk_context):
-                        risk_level = risk.get('text', '')
-                        break
-
-            return {"result": result, "score": result, "risk_level": risk_level}
-        
-        # Step 3: Score-based calculation (with formula support)
-        if ast.get('rules'):
-            score = 0
-            for rule in ast.get('rules', []):
-                # Skip invalid rules
-                if not rule or 'condition' not in rule or 'action' not in rule:
-                    continue
-                    
-                cond = rule.get('condition', {})
-                action = rule.get('action', {})
-                
-                # Evaluate condition (supports compound and/or)
-                matched = evaluate_condition(cond, context)
-                    
-                if matched:
-                    if action.get('type') == 'add':
-                        score += action.get('value', 0)
-            
-            # Step 4: Evaluate risk_levels to determine RiskLevel
-            risk_level = None
-            if ast.get('risk_levels'):
-                # Add score to context for risk level evaluation
-                risk_context = {**context, 'score': score}
-                for risk in ast.get('risk_levels', []):
-                    if not risk or 'condition' not in risk:
-                        continue
-                    cond = risk.get('condition', {})
-                    if evaluate_condition(cond, risk_context):
-                        risk_level = risk.get('text', '')
-                        break  # First matching risk level wins
-            
-            # Build computed values
-            computed_values = {k: round(v, 2) if isinstance(v, float) else v for k, v in context.items() if k not in inputs}
-            if risk_level:
-                computed_values['RiskLevel'] = risk_level
-                        
-            return {"score": score, "computed": computed_values, "risk_level": risk_level}
-        
-        # Fallback for pure formula without type field
-        if ast.get('formula'):
-            formula = ast['formula']
-            for var_name, var_value in context.items():
-                formula = re.sub(r'\b' + var_name + r'\b', str(var_value), formula)
-            result = round(eval(formula, allowed_names), 2)
-            risk_level = None
-            if ast.get('risk_levels'):
-                risk_context = {**context, 'score': result}
-                for risk in ast['risk_levels']:
-                    if not risk or 'condition' not in risk:
-                        continue
-                    if evaluate_condition(risk['condition'], risk_context):
-                        risk_level = risk.get('text', '')
-                        break
-            return {"result": result, "score": result, "risk_level": risk_level}
-
-        # Last-resort fallback: if formulas produced a 'score' value, use it
-        if 'score' in context:
-            score = round(context['score'], 2) if isinstance(context['score'], float) else context['score']
-            risk_level = None
-            if ast.get('risk_levels'):
-                risk_context = {**context, 'score': score}
-                for risk in ast.get('risk_levels', []):
-                    if not risk or 'condition' not in risk:
-                        continue
-                    if evaluate_condition(risk['condition'], risk_context):
-                        risk_level = risk.get('text', '')
-                        break
-            return {"result": score, "score": score, "risk_level": risk_level}
-
-        raise HTTPException(status_code=400, detail="Unknown AST type")
-        
-    except HTTPException:
-        raise
+        if mode:
+            result, report = profiling.run(_traced_calculate, mode, ast, inputs)
+            result["profile"]["cprofile"] = report
+            return result
+        return _evaluate(get_plan(ast), inputs)
+    except PlanError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post('/chat')
-async def chat_generate_rules(request: ChatRequest, db: Session = Depends(get_db)):
-    """Mixed-mode chat: general conversation OR formula generation depending on user intent."""
-    import google.generativeai as genai
-    import os
-    from dotenv import load_dotenv
+@app.post('/calculate/incremental')
+async def calculate_incremental(request: IncrementalCalculateRequest):
+    """Like /calculate, but keeps the evaluation state server-side.
+
+    Send back the returned `state_id` with the next full set of inputs and
+    only the formulas, rules and risk levels reading a changed input are
+    recomputed. Every response carries a fresh `state_id`; the one sent is
+    retired.
+    """
+    inputs = (await _patient_fields()).coerce(request.inputs or {})
+    try:
+        plan = get_plan(request.ast)
+        previous = get_state(request.state_id, plan)
+        state = plan.update(previous, inputs) if previous else plan.compute(inputs)
+        state_id = save_state(plan, state, replaces=request.state_id if previous else None)
+        return {**plan.render(state), "state_id": state_id}
+    except PlanError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _score_batch(fields, ast, rows, columns):
+    from batch import evaluate_batch  # NumPy: loaded on first use
+
+    if rows is not None:
+        rows = [fields.coerce(row or {}) for row in rows]
+    else:
+        columns = fields.coerce_columns(columns)
+    return evaluate_batch(ast, rows=rows, columns=columns)
+
+@app.post('/calculate/batch')
+async def calculate_batch(request: BatchCalculateRequest):
+    """Score many patients against one AST, given as `rows` or as `columns`.
+
+    String values of registered patient fields are converted as in /calculate.
+    """
+    if request.rows is None and request.columns is None:
+        raise HTTPException(status_code=400, detail="Provide either 'rows' or 'columns'")
+    fields = await _patient_fields()
+    try:
+        results = await run_in_threadpool(
+            _score_batch, fields, request.ast, request.rows, request.columns
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"count": len(results), "results": results}
+
+class _UploadStreamingResponse(StreamingResponse):
+    """Streams while the request body is still being read.
+
+    ``StreamingResponse`` listens for a disconnect on ``receive`` under
+    ASGI < 2.4, which would swallow body chunks the generator has not read
+    yet; here the body iterator is the only receiver (it raises on a
+    disconnect itself).
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+@app.post('/calculate/stream')
+async def calculate_stream(
+    request: Request,
+    formula_id: Optional[int] = None,
+    ast: Optional[str] = None,
+    input_format: Optional[str] = None,
+    output_format: str = "ndjson",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    db: AsyncSession = Depends(get_db),
+):
+    """Score a CSV / NDJSON cohort sent as the raw request body.
+
+    The AST comes from `formula_id` or from `ast` (JSON text). The body is
+    parsed as it arrives and results are streamed back as NDJSON or CSV
+    chunk by chunk, before the upload has finished.
+    """
+    if formula_id is not None:
+        formula = await crud.get_formula(db, formula_id)
+        if not formula:
+            raise HTTPException(status_code=404, detail="Formula not found")
+        score_ast = formula.ast_data
+    elif ast:
+        try:
+            score_ast = json.loads(ast)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid ast: {e}")
+    else:
+        raise HTTPException(status_code=400, detail="Provide either 'formula_id' or 'ast'")
 
-    load_dotenv()
-    api_key = os.getenv("GEMINI_API_KEY")
-    model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+    input_format = input_format or guess_format(request.headers.get("content-type"))
+    if input_format not in FORMATS or output_format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formats must be one of {FORMATS}")
+    if chunk_size < 1:
+        raise HTTPException(status_code=400, detail="chunk_size must be positive")
+    from batch import get_batch_plan  # NumPy: loaded on first use
 
-    if not api_key:
-        raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
+    try:
+        get_batch_plan(score_ast)
+    except PlanError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    media_type = "text/csv" if output_format == "csv" else "application/x-ndjson"
+    return _UploadStreamingResponse(
+        score_body(score_ast, request.stream(), input_format, output_format, chunk_size),
+        media_type=media_type,
+    )
+
+@app.get('/calculate/cache')
+async def calculate_cache_stats():
+    """Hit/miss/eviction counters of the compiled-plan caches."""
+    return {
+        "ast_plans": plan_cache.stats(),
+        "formula_plans": formula_plan_cache.stats(),
+        "department_plans": department_plan_cache.stats(),
+        "states": state_cache.stats(),
+    }
 
-    genai.configure(api_key=api_key)
+async def _prepare_chat(request: ChatRequest, db: AsyncSession):
+    """Validate a chat request; returns the LLM provider and the prompt."""
+    try:
+        provider = get_provider()
+    except LLMNotConfiguredError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI generation failed: {str(e)}")
 
     user_message = request.message
     if not user_message:
         raise HTTPException(status_code=400, detail="No message provided")
 
-    # Auto-fetch patient fields from DB (include label for unit info)
-    db_fields = crud.get_patient_fields(db)
-
-    # Build optional patient fields hint
-    if db_fields:
-        fields_list = ", ".join(
-            f"{f.field_name} ({f.label})" if f.label else f.field_name
-            for f in db_fields
-        )
-        patient_fields_hint = (
-            f"\n\nAVAILABLE PATIENT FIELDS with units (optional hint): {fields_list}\n"
-            f"Use the exact field_name as the variable name in formulas. The label shows the unit."
-        )
-    else:
-        patient_fields_hint = ""
+    # Optional patient fields hint (field names with their unit labels)
+    patient_fields_hint = (await _patient_fields(db)).hint
+    # Hand the pooled connection back while the model runs.
+    await db.close()
 
     prompt = f"""You are a helpful medical formula assistant. You can have general conversations AND generate medical scoring formulas.
 
@@ -532,65 +464,102 @@ risk_levels:
 FORMULA_END
 
 Your conversational reply (in 繁體中文):"""
+    return provider, prompt
 
-    try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
-        full_text = response.text.strip()
 
+@app.post('/chat')
+async def chat_generate_rules(
+    request: ChatRequest, http_request: Request, db: AsyncSession = Depends(get_db)
+):
+    """Mixed-mode chat: general conversation OR formula generation depending on user intent."""
+    provider, prompt = await _prepare_chat(request, db)
+    try:
+        response = await run_llm(
+            provider.generate, prompt,
+            request=http_request, key=prompt_key(provider.model_name, prompt),
+        )
         # Parse: split conversational reply from formula block
-        if "FORMULA_START" in full_text and "FORMULA_END" in full_text:
-            before = full_text[:full_text.index("FORMULA_START")].strip()
-            formula_raw = full_text[full_text.index("FORMULA_START") + len("FORMULA_START"):full_text.index("FORMULA_END")].strip()
-            after = full_text[full_text.index("FORMULA_END") + len("FORMULA_END"):].strip()
+        return split_formula_reply(response.text.strip())
 
-            # Clean markdown fences inside formula block
-            formula_lines = [l for l in formula_raw.split("\n") if not l.strip().startswith("```")]
-            formula_text = "\n".join(formula_lines).strip()
+    except LLMTimeoutError as e:
+        raise HTTPException(status_code=504, detail=f"AI generation timed out: {e}")
+    except LLMCancelledError:
+        raise HTTPException(status_code=499, detail="Client closed request")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI generation failed: {str(e)}")
 
-            reply_parts = [p for p in [before, after] if p]
-            reply_text = "\n".join(reply_parts) if reply_parts else "公式已生成，請點擊「載入到編輯器」使用。"
 
-            return {"reply": reply_text, "generated_rules": formula_text}
-        else:
-            # Conversational reply only
-            return {"reply": full_text}
+@app.post('/chat/stream')
+async def chat_stream(request: ChatRequest, db: AsyncSession = Depends(get_db)):
+    """Like /chat, but streamed as Server-Sent Events.
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"AI generation failed: {str(e)}")
+    ``token`` events carry reply text as it arrives, one ``formula`` event
+    carries the DSL once ``FORMULA_END`` is seen, and ``done`` carries the
+    same payload /chat would return (``error`` on failure).
+    """
+    provider, prompt = await _prepare_chat(request, db)
+
+    def start():
+        return (chunk.text for chunk in provider.generate(prompt, stream=True))
+
+    async def events():
+        splitter = FormulaStreamSplitter()
+        pieces = []
+        try:
+            async for text in stream_llm(start):
+                pieces.append(text)
+                for event, data in splitter.feed(text):
+                    yield sse(event, {"text": data} if event == "token" else {"generated_rules": data})
+            for _, data in splitter.finish():
+                yield sse("token", {"text": data})
+            yield sse("done", split_formula_reply("".join(pieces).strip()))
+        except LLMTimeoutError as e:
+            yield sse("error", {"detail": f"AI generation timed out: {e}"})
+        except Exception as e:
+            yield sse("error", {"detail": f"AI generation failed: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Request, evaluation, Gemini, pool and cache metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get('/llm/stats')
+async def llm_stats():
+    """Upstream Gemini calls made and calls saved by coalescing."""
+    return {**single_flight.stats(), "max_workers": LLM_MAX_WORKERS}
 
 
 # ──────────────────────────────────────────────
-# Database Initialization
+# Startup
 # ──────────────────────────────────────────────
 
 @app.on_event("startup")
-def on_startup():
-    init_db()
-    _seed_default_patient_fields()
-
-
-def _seed_default_patient_fields():
-    """Insert default patient fields (from PatientPanel sample data) if empty."""
-    from schemas import PatientFieldCreate
-    DEFAULT_FIELDS = [
-        PatientFieldCreate(field_name="age",         label="年齡 (歲)",      field_type="int"),
-        PatientFieldCreate(field_name="height",      label="身高 (公尺)",    field_type="float"),
-        PatientFieldCreate(field_name="weight",      label="體重 (公斤)",    field_type="float"),
-        PatientFieldCreate(field_name="cholesterol", label="膽固醇 (mg/dL)", field_type="float"),
-        PatientFieldCreate(field_name="has_disease", label="是否患有常見疾病", field_type="boolean"),
-    ]
-    db = next(get_db())
-    try:
-        if crud.get_patient_fields(db):
-            return  # already seeded
-        for f in DEFAULT_FIELDS:
-            try:
-                crud.create_patient_field(db, f)
-            except Exception:
-                pass  # skip duplicate
-    finally:
-        db.close()
+async def on_startup():
+    """Cheap by design: the schema is created by migrate.py (or with
+    AUTO_MIGRATE), and the Gemini client on its first call."""
+    startup.mark("server")
+    if AUTO_MIGRATE:
+        from migrate import migrate
+
+        await run_in_threadpool(ensure_database_exists)
+        await migrate()
+        startup.mark("migrate")
+    check_configured()
+    startup.mark("startup hook")
+    print(startup.report())
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    shutdown_llm()
 
 
 # ──────────────────────────────────────────────
@@ -598,24 +567,37 @@ def _seed_default_patient_fields():
 # ──────────────────────────────────────────────
 
 @app.post('/departments', response_model=schemas.DepartmentListItem, status_code=201)
-async def create_department(data: schemas.DepartmentCreate, db: Session = Depends(get_db)):
+async def create_department(data: schemas.DepartmentCreate, db: AsyncSession = Depends(get_db)):
     """Create a new department."""
     try:
-        return crud.create_department(db, data)
+        return await crud.create_department(db, data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get('/departments', response_model=List[schemas.DepartmentListItem])
-async def list_departments(db: Session = Depends(get_db)):
+async def list_departments(
+    request: Request, response: Response, db: AsyncSession = Depends(get_db)
+):
     """List all departments."""
-    return crud.get_departments(db)
+    not_modified = await conditional_get(request, response, db, crud.DEPARTMENT_TABLES)
+    if not_modified:
+        return not_modified
+    return await crud.get_departments(db)
 
 
 @app.get('/departments/{department_id}', response_model=schemas.DepartmentResponse)
-async def get_department(department_id: int, db: Session = Depends(get_db)):
-    """Get a single department with its formulas."""
-    dept = crud.get_department(db, department_id)
+async def get_department(
+    department_id: int,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+):
+    """Get a single department with its formula count and formula summaries."""
+    not_modified = await conditional_get(request, response, db, crud.DEPARTMENT_TABLES)
+    if not_modified:
+        return not_modified
+    dept = await crud.get_department(db, department_id, with_formulas=True)
     if not dept:
         raise HTTPException(status_code=404, detail="Department not found")
     return dept
@@ -625,24 +607,62 @@ async def get_department(department_id: int, db: Session = Depends(get_db)):
 async def update_department(
     department_id: int,
     data: schemas.DepartmentUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Update a department."""
-    dept = crud.update_department(db, department_id, data)
+    dept = await crud.update_department(db, department_id, data)
     if not dept:
         raise HTTPException(status_code=404, detail="Department not found")
     return dept
 
 
 @app.delete('/departments/{department_id}')
-async def delete_department(department_id: int, db: Session = Depends(get_db)):
+async def delete_department(department_id: int, db: AsyncSession = Depends(get_db)):
     """Delete a department and all its formulas."""
-    success = crud.delete_department(db, department_id)
+    success = await crud.delete_department(db, department_id)
     if not success:
         raise HTTPException(status_code=404, detail="Department not found")
     return {"detail": "Department deleted"}
 
 
+@app.post('/departments/{department_id}/calculate')
+async def calculate_department(
+    department_id: int,
+    request: FormulaCalculateRequest,
+    db: AsyncSession = Depends(get_db),
+):
+    """Compute every formula of a department against one patient in a single fused pass."""
+    dept = await crud.get_department(db, department_id)
+    if not dept:
+        raise HTTPException(status_code=404, detail="Department not found")
+
+    rows = await crud.get_formula_versions(db, department_id)
+    names = {row.id: row.name for row in rows}
+    # updated_at alone can miss two edits within one second (MySQL DATETIME);
+    # the shared formulas counter also catches writes made by other workers.
+    versions = (
+        await crud.get_versions(db, ("formulas",)),
+        tuple((row.id, row.updated_at) for row in rows),
+    )
+
+    async def load_asts():
+        return [(f.id, f.ast_data) for f in await crud.get_formulas(db, department_id)]
+
+    plan = await get_department_plan(department_id, versions, load_asts)
+    try:
+        results = plan.evaluate((await _patient_fields(db)).coerce(request.inputs or {}))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "department_id": department_id,
+        "results": [
+            {"formula_id": formula_id, "name": names.get(formula_id), **result}
+            for formula_id, result in results
+        ],
+        "fused": plan.stats(),
+    }
+
+
 # ──────────────────────────────────────────────
 # Formula CRUD Endpoints
 # ──────────────────────────────────────────────
@@ -655,32 +675,138 @@ async def delete_department(department_id: int, db: Session = Depends(get_db)):
 async def create_formula(
     department_id: int,
     data: schemas.FormulaCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Create a formula under a specific department."""
     # Verify department exists
-    dept = crud.get_department(db, department_id)
+    dept = await crud.get_department(db, department_id)
+    if not dept:
+        raise HTTPException(status_code=404, detail="Department not found")
+    try:
+        return await crud.create_formula(db, department_id, data)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get('/departments/{department_id}/formulas/export')
+async def export_formulas(department_id: int, db: AsyncSession = Depends(get_db)):
+    """Stream a department's formulas, with ASTs and source text, as NDJSON."""
+    dept = await crud.get_department(db, department_id)
+    if not dept:
+        raise HTTPException(status_code=404, detail="Department not found")
+    return StreamingResponse(
+        formula_io.export_formulas(SessionLocal, department_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="department-{department_id}-formulas.ndjson"'},
+    )
+
+
+@app.post('/departments/{department_id}/formulas/import')
+async def import_formulas(
+    department_id: int,
+    request: Request,
+    upsert: bool = False,
+    db: AsyncSession = Depends(get_db),
+):
+    """Create many formulas in one transaction from an NDJSON body (or a JSON array).
+
+    Items look like export lines; `ast_data` may be left out when `raw_text`
+    holds the DSL. With `upsert=true` an item named like an existing formula
+    of the department replaces it. Any invalid item rejects the whole import
+    with 422 and a per-item error list.
+    """
+    dept = await crud.get_department(db, department_id)
     if not dept:
         raise HTTPException(status_code=404, detail="Department not found")
+    body = await request.body()
+    json_array = "application/json" in request.headers.get("content-type", "")
     try:
-        return crud.create_formula(db, department_id, data)
+        # Parsing and compiling thousands of items is CPU work; keep it off the loop.
+        items, errors = await run_in_threadpool(formula_io.validate_items, body, json_array)
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Body is not UTF-8: {e}")
+
+    existing = await crud.get_formula_ids_by_name(db, department_id)
+    if not upsert:
+        errors.extend(
+            {"item": number, "name": item.name, "error": "formula already exists (use upsert=true to replace it)"}
+            for number, item in items if item.name in existing
+        )
+        errors.sort(key=lambda error: error["item"])
+    if errors:
+        raise HTTPException(status_code=422, detail={"imported": 0, "errors": errors})
+    try:
+        result = await crud.import_formulas(db, department_id, [item for _, item in items], existing)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    return {"imported": len(items), **result}
 
 
-@app.get('/formulas', response_model=List[schemas.FormulaResponse])
+@app.get(
+    '/formulas',
+    response_model=List[schemas.FormulaListItem],
+    response_model_exclude_unset=True,
+)
 async def list_formulas(
+    request: Request,
+    response: Response,
     department_id: Optional[int] = None,
-    db: Session = Depends(get_db),
+    after: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=FORMULA_PAGE_MAX),
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
 ):
-    """List all formulas. Optionally filter by department_id."""
-    return crud.get_formulas(db, department_id)
+    """List formulas by id. Optionally filter by department_id.
+
+    Without `limit` or `after` every formula is returned, as before paging
+    existed. With either, one page comes back (`limit` defaults to
+    FORMULA_PAGE_SIZE); pass the `X-Next-Cursor` response header back as
+    `after` for the next page (it is absent on the last one). `fields` is a comma-separated
+    subset of the formula's fields; leaving out `ast_data` and `raw_text`
+    keeps them out of the query.
+    """
+    if fields is None:
+        selected = schemas.FORMULA_FIELDS
+    else:
+        selected = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+        unknown = [f for f in selected if f not in schemas.FORMULA_FIELDS]
+        if unknown or not selected:
+            raise HTTPException(
+                status_code=400,
+                detail=f"fields must be a comma-separated subset of {', '.join(schemas.FORMULA_FIELDS)}",
+            )
+    not_modified = await conditional_get(request, response, db, crud.FORMULA_TABLES)
+    if not_modified:
+        return not_modified
+    paged = limit is not None or after is not None
+    if paged and limit is None:
+        limit = FORMULA_PAGE_SIZE
+    # One extra row tells whether another page follows.
+    formulas = await crud.get_formulas(
+        db, department_id, after=after, limit=limit + 1 if paged else None,
+        fields=None if fields is None else selected,
+    )
+    if paged and len(formulas) > limit:
+        formulas = formulas[:limit]
+        response.headers["X-Next-Cursor"] = str(formulas[-1].id)
+    return [
+        schemas.FormulaListItem(**{name: getattr(formula, name) for name in selected})
+        for formula in formulas
+    ]
 
 
 @app.get('/formulas/{formula_id}', response_model=schemas.FormulaResponse)
-async def get_formula(formula_id: int, db: Session = Depends(get_db)):
+async def get_formula(
+    formula_id: int,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+):
     """Get a single formula."""
-    formula = crud.get_formula(db, formula_id)
+    not_modified = await conditional_get(request, response, db, crud.FORMULA_TABLES)
+    if not_modified:
+        return not_modified
+    formula = await crud.get_formula(db, formula_id)
     if not formula:
         raise HTTPException(status_code=404, detail="Formula not found")
     return formula
@@ -690,19 +816,45 @@ async def get_formula(formula_id: int, db: Session = Depends(get_db)):
 async def update_formula(
     formula_id: int,
     data: schemas.FormulaUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Update a formula."""
-    formula = crud.update_formula(db, formula_id, data)
+    formula = await crud.update_formula(db, formula_id, data)
     if not formula:
         raise HTTPException(status_code=404, detail="Formula not found")
     return formula
 
 
+@app.post('/formulas/{formula_id}/calculate')
+async def calculate_formula(
+    formula_id: int,
+    request: FormulaCalculateRequest,
+    db: AsyncSession = Depends(get_db),
+):
+    """Compute a stored formula's score from inputs only (no AST in the payload)."""
+    version = await crud.get_formula_version(db, formula_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Formula not found")
+
+    async def load_ast():
+        formula = await crud.get_formula(db, formula_id)
+        return formula.ast_data if formula else None
+
+    plan = await get_formula_plan(formula_id, version.updated_at, load_ast)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Formula not found")
+    try:
+        return _evaluate(plan, (await _patient_fields(db)).coerce(request.inputs or {}))
+    except PlanError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.delete('/formulas/{formula_id}')
-async def delete_formula(formula_id: int, db: Session = Depends(get_db)):
+async def delete_formula(formula_id: int, db: AsyncSession = Depends(get_db)):
     """Delete a formula."""
-    success = crud.delete_formula(db, formula_id)
+    success = await crud.delete_formula(db, formula_id)
     if not success:
         raise HTTPException(status_code=404, detail="Formula not found")
     return {"detail": "Formula deleted"}
@@ -713,16 +865,21 @@ async def delete_formula(formula_id: int, db: Session = Depends(get_db)):
 # ──────────────────────────────────────────────
 
 @app.get('/patient-fields', response_model=List[schemas.PatientFieldResponse])
-async def list_patient_fields(db: Session = Depends(get_db)):
+async def list_patient_fields(
+    request: Request, response: Response, db: AsyncSession = Depends(get_db)
+):
     """List all registered patient field names."""
-    return crud.get_patient_fields(db)
+    not_modified = await conditional_get(request, response, db, crud.PATIENT_FIELD_TABLES)
+    if not_modified:
+        return not_modified
+    return (await _patient_fields(db)).fields
 
 
 @app.post('/patient-fields', response_model=schemas.PatientFieldResponse, status_code=201)
-async def create_patient_field(data: schemas.PatientFieldCreate, db: Session = Depends(get_db)):
+async def create_patient_field(data: schemas.PatientFieldCreate, db: AsyncSession = Depends(get_db)):
     """Register a new patient field name."""
     try:
-        return crud.create_patient_field(db, data)
+        return await crud.create_patient_field(db, data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -731,24 +888,27 @@ async def create_patient_field(data: schemas.PatientFieldCreate, db: Session = D
 async def update_patient_field(
     field_id: int,
     data: schemas.PatientFieldUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Update a patient field's label or type."""
-    field = crud.update_patient_field(db, field_id, data)
+    field = await crud.update_patient_field(db, field_id, data)
     if not field:
         raise HTTPException(status_code=404, detail="Patient field not found")
     return field
 
 
 @app.delete('/patient-fields/{field_id}')
-async def delete_patient_field(field_id: int, db: Session = Depends(get_db)):
+async def delete_patient_field(field_id: int, db: AsyncSession = Depends(get_db)):
     """Remove a patient field from the registry."""
-    success = crud.delete_patient_field(db, field_id)
+    success = await crud.delete_patient_field(db, field_id)
     if not success:
         raise HTTPException(status_code=404, detail="Patient field not found")
     return {"detail": "Patient field deleted"}
 
 
+startup.mark("routes")
+
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,572 @@
+"""Vectorised evaluation of one AST over many input rows.
+
+Formulas, rule conditions and risk levels are evaluated as NumPy array
+operations over the whole batch. Rows the array path cannot reproduce
+exactly (missing or non-numeric operands, non-finite results) fall back
+to the scalar ``CompiledExpression`` / condition semantics used by
+``/calculate``, so every row gets the same value it would get alone
+(integers may come back as floats when a column mixes ints and floats).
+"""
+import ast as pyast
+
+import numpy as np
+
+from engine import (
+    _BASE_SCOPE,
+    _COMPARATORS,
+    CompiledExpression,
+    ThresholdIndex,
+    UnknownASTError,
+    _bind_operand,
+    formula_order,
+    group_rules,
+)
+from plan_cache import LRUCache, ast_fingerprint
+
+_ABSENT = object()
+
+
+# ──────────────────────────────────────────────
+# Columns
+# ──────────────────────────────────────────────
+
+def _is_number(value):
+    return isinstance(value, (bool, int, float))
+
+
+# Integers past 2**53 are not exact as float64 (nor in the float64
+# threshold tables), so such rows are scored one by one like non-numbers.
+_MAX_EXACT_INT = 2 ** 53
+
+
+def _fits_column(value):
+    """Whether a number can live in a NumPy column without losing precision."""
+    return type(value) is not int or -_MAX_EXACT_INT <= value <= _MAX_EXACT_INT
+
+
+class Column:
+    """One variable across the batch.
+
+    ``values`` holds the numeric value of every row flagged in ``numeric``
+    (0 elsewhere); rows that are bound to a non-numeric, non-None value are
+    flagged in ``other`` and read back through ``raw_at``.
+    """
+
+    __slots__ = ("values", "numeric", "bound", "other", "raw", "overrides")
+
+    def __init__(self, values, numeric, bound, other, raw=None, overrides=None):
+        self.values = values
+        self.numeric = numeric
+        self.bound = bound
+        self.other = other
+        self.raw = raw
+        self.overrides = overrides or {}
+
+    @classmethod
+    def from_values(cls, raw):
+        """Build a column from Python values (``_ABSENT`` marks unbound rows)."""
+        n = len(raw)
+        numeric = np.zeros(n, dtype=bool)
+        bound = np.zeros(n, dtype=bool)
+        other = np.zeros(n, dtype=bool)
+        kinds = set()
+        for i, v in enumerate(raw):
+            if v is _ABSENT:
+                continue
+            bound[i] = True
+            if _is_number(v) and _fits_column(v):
+                numeric[i] = True
+                kinds.add(type(v))
+            elif v is not None:
+                other[i] = True
+
+        if kinds <= {bool}:
+            dtype = bool
+        elif float in kinds:
+            dtype = np.float64
+        else:
+            dtype = np.int64
+        try:
+            values = np.array([v if numeric[i] else 0 for i, v in enumerate(raw)], dtype=dtype)
+        except OverflowError:
+            values = np.zeros(n, dtype=np.float64)
+            other |= numeric
+            numeric[:] = False
+        return cls(values, numeric, bound, other, raw=raw)
+
+    def raw_at(self, i):
+        if i in self.overrides:
+            return self.overrides[i]
+        if self.raw is not None:
+            return self.raw[i]
+        return self.values[i].item()
+
+    def tolist(self):
+        if self.raw is not None:
+            return list(self.raw)
+        out = self.values.tolist()
+        for i, v in self.overrides.items():
+            out[i] = v
+        return out
+
+
+def _normalise(value):
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    return value
+
+
+def columns_from_rows(rows):
+    """Pivot a list of input dicts into columns, keeping first-seen key order."""
+    names = {}
+    for row in rows:
+        for k in row:
+            names.setdefault(k, None)
+    return {
+        name: Column.from_values([_normalise(row[name]) if name in row else _ABSENT for row in rows])
+        for name in names
+    }
+
+
+def columns_from_dict(data):
+    """Wrap a columnar ``{name: [values...]}`` payload; all columns must be equally long."""
+    lengths = {len(v) for v in data.values()}
+    if len(lengths) > 1:
+        raise ValueError("All input columns must have the same length")
+    return {name: Column.from_values([_normalise(v) for v in values]) for name, values in data.items()}
+
+
+# ──────────────────────────────────────────────
+# Expressions
+# ──────────────────────────────────────────────
+
+def _truthy(x):
+    return np.asarray(x) != 0
+
+
+def _arith(x):
+    # Python treats booleans as ints in arithmetic; NumPy would use logical ops.
+    if isinstance(x, np.ndarray) and x.dtype == bool:
+        return x.astype(np.int64)
+    if isinstance(x, (bool, np.bool_)):
+        return int(x)
+    return x
+
+
+_VECTOR_SCOPE = {
+    "__builtins__": {},
+    "sqrt": np.sqrt,
+    "pow": np.power,
+    "abs": np.abs,
+    "True": True,
+    "False": False,
+    "true": True,
+    "false": False,
+    "_arith": _arith,
+    "_where": lambda test, a, b: np.where(_truthy(test), a, b),
+    "_and": lambda a, b: np.where(_truthy(a), b, a),
+    "_or": lambda a, b: np.where(_truthy(a), a, b),
+    "_not": np.logical_not,
+    "_all": np.logical_and,
+}
+
+
+def _call(name, *args):
+    return pyast.Call(func=pyast.Name(id=name, ctx=pyast.Load()), args=list(args), keywords=[])
+
+
+class _Vectorize(pyast.NodeTransformer):
+    """Rewrite a whitelisted expression so it is valid over NumPy arrays."""
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        node.left = _call("_arith", node.left)
+        node.right = _call("_arith", node.right)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, pyast.Not):
+            return _call("_not", node.operand)
+        node.operand = _call("_arith", node.operand)
+        return node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        helper = "_and" if isinstance(node.op, pyast.And) else "_or"
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = _call(helper, result, value)
+        return result
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return _call("_where", node.test, node.body, node.orelse)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        operands = [node.left] + node.comparators
+        pairs = [
+            pyast.Compare(left=operands[i], ops=[op], comparators=[operands[i + 1]])
+            for i, op in enumerate(node.ops)
+        ]
+        result = pairs[0]
+        for pair in pairs[1:]:
+            result = _call("_all", result, pair)
+        return result
+
+
+class VectorExpression:
+    """A ``CompiledExpression`` plus an array-friendly code object."""
+
+    def __init__(self, source):
+        self.scalar = CompiledExpression(source)
+        self.names = self.scalar.names
+        self.code = None
+        if self.scalar.error is None:
+            tree = _Vectorize().visit(pyast.parse(str(source).strip(), mode="eval"))
+            self.code = compile(pyast.fix_missing_locations(tree), "<formula>", "eval")
+
+    def evaluate(self, columns, n):
+        """Return (column, errors) where ``errors`` maps row index -> exception."""
+        vectorised = np.ones(n, dtype=bool)
+        scope = dict(_VECTOR_SCOPE)
+        for name in self.names:
+            col = columns.get(name)
+            if col is None:
+                vectorised[:] = False
+                break
+            vectorised &= col.numeric
+            scope[name] = col.values
+
+        values = None
+        if self.code is not None and vectorised.any():
+            try:
+                with np.errstate(all="ignore"):
+                    values = np.asarray(eval(self.code, scope))
+                if values.ndim == 0:
+                    values = np.full(n, values.item())
+                if values.shape != (n,) or values.dtype.kind not in "biuf":
+                    values = None
+            except Exception:
+                values = None
+        if values is None:
+            values = np.zeros(n, dtype=np.int64)
+            vectorised[:] = False
+        elif values.dtype.kind == "f":
+            vectorised &= np.isfinite(values)
+
+        numeric = vectorised.copy()
+        other = np.zeros(n, dtype=bool)
+        overrides = {}
+        errors = {}
+        for i in np.flatnonzero(~vectorised).tolist():
+            row_scope = dict(_BASE_SCOPE)
+            for name in self.names:
+                col = columns.get(name)
+                if col is not None and col.bound[i]:
+                    _bind_operand(row_scope, name, col.raw_at(i))
+            try:
+                result = self.scalar.evaluate(row_scope)
+            except Exception as e:
+                errors[i] = e
+                continue
+            overrides[i] = result
+            if _is_number(result) and _fits_column(result):
+                numeric[i] = True
+            elif result is not None:
+                other[i] = True
+
+        # Make room for scalar results that do not fit the vector dtype.
+        fallback_kinds = {type(overrides[i]) for i in overrides if numeric[i]}
+        if float in fallback_kinds and values.dtype.kind != "f":
+            values = values.astype(np.float64)
+        elif int in fallback_kinds and values.dtype.kind == "b":
+            values = values.astype(np.int64)
+        for i, v in overrides.items():
+            if numeric[i]:
+                try:
+                    values[i] = v
+                except OverflowError:
+                    numeric[i] = False
+                    other[i] = True
+
+        bound = np.ones(n, dtype=bool)
+        for i in errors:
+            bound[i] = False
+        return Column(values, numeric, bound, other, overrides=overrides), errors
+
+
+# ──────────────────────────────────────────────
+# Conditions
+# ──────────────────────────────────────────────
+
+def _never(columns, n):
+    return np.zeros(n, dtype=bool)
+
+
+def compile_vector_condition(cond):
+    """Turn a condition dict into a ``(columns, n) -> bool array`` function.
+
+    Per row this matches ``evaluate_condition``: a missing (``None``) value
+    makes a simple condition false, as does a comparison between
+    incompatible types.
+    """
+    if not cond:
+        return _never
+
+    if "compound" in cond:
+        subs = [compile_vector_condition(sub) for sub in cond.get("conditions", [])]
+        if cond["compound"] == "and":
+            def check_all(columns, n):
+                out = np.ones(n, dtype=bool)
+                for sub in subs:
+                    out &= sub(columns, n)
+                return out
+            return check_all
+        if cond["compound"] == "or":
+            def check_any(columns, n):
+                out = np.zeros(n, dtype=bool)
+                for sub in subs:
+                    out |= sub(columns, n)
+                return out
+            return check_any
+        return _never
+
+    left = cond.get("left")
+    if not left or not cond.get("op"):
+        return _never
+    compare = _COMPARATORS.get(cond["op"])
+    if compare is None:
+        return _never
+    right = cond.get("right", 0)
+    right_is_number = _is_number(right)
+
+    def check(columns, n):
+        col = columns.get(left)
+        if col is None:
+            return np.zeros(n, dtype=bool)
+        if right_is_number:
+            out = np.asarray(compare(col.values, right), dtype=bool) & col.numeric
+        else:
+            out = np.zeros(n, dtype=bool)
+        for i in np.flatnonzero(col.other).tolist():
+            try:
+                out[i] = bool(compare(col.raw_at(i), right))
+            except TypeError:
+                pass
+        return out
+
+    return check
+
+
+# ──────────────────────────────────────────────
+# Batch plans
+# ──────────────────────────────────────────────
+
+def _round_score(value):
+    return round(value, 2) if isinstance(value, float) else value
+
+
+class BatchPlan:
+    """Array-oriented counterpart of ``engine.CompiledPlan``."""
+
+    def __init__(self, ast):
+        self.formulas = [
+            (name, VectorExpression(expr))
+            for name, expr in (ast.get('formulas') or {}).items()
+        ]
+        expressions = dict(self.formulas)
+        self.order = [
+            (name, expressions[name])
+            for name in formula_order({name: expr.names for name, expr in self.formulas})
+        ]
+        self.formula = VectorExpression(ast['formula']) if ast.get('formula') else None
+        tables, general = group_rules([
+            rule for rule in ast.get('rules') or []
+            if rule and 'condition' in rule and 'action' in rule
+        ])
+        self.rule_tables = [
+            (table, np.array(table.thresholds, dtype=np.float64), np.array(table.totals))
+            for table in tables
+        ]
+        self.rules = [(compile_vector_condition(cond), value) for cond, value in general]
+        risks = [risk for risk in ast.get('risk_levels') or [] if risk and 'condition' in risk]
+        self.risk_levels = [
+            (compile_vector_condition(risk['condition']), risk.get('text', ''))
+            for risk in risks
+        ]
+        risk_index = ThresholdIndex.build([risk['condition'] for risk in risks])
+        if risk_index is not None:
+            self.risk_thresholds = np.array(risk_index.thresholds, dtype=np.float64)
+            self.risk_answers = np.array(
+                [-1 if a is None else a for a in risk_index.answers], dtype=np.int64
+            )
+        else:
+            self.risk_thresholds = self.risk_answers = None
+
+        if self.formula is not None and (ast.get('type') == 'formula' or not ast.get('rules')):
+            self.mode = 'formula'
+        elif ast.get('rules'):
+            self.mode = 'rules'
+        else:
+            self.mode = 'score'
+
+    def run_formulas(self, columns, n):
+        columns = dict(columns)
+        for name, expr in self.order:
+            column, errors = expr.evaluate(columns, n)
+            if errors:
+                # Failed formulas evaluate to 0, as in /calculate
+                for i in errors:
+                    column.overrides[i] = 0
+                    column.numeric[i] = True
+                    column.other[i] = False
+                    column.values[i] = 0
+                first = next(iter(errors.values()))
+                print(f"Formula error for {name}: {first} ({len(errors)} rows)")
+            column.bound[:] = True
+            columns[name] = column
+        return columns
+
+    def match_risk_levels(self, columns, score, n):
+        """Index of the first matching risk level per row (-1 when none match)."""
+        matched = np.full(n, -1, dtype=np.int64)
+        if not self.risk_levels:
+            return matched
+        general = np.ones(n, dtype=bool)
+        if self.risk_answers is not None:
+            # Plain score thresholds: one searchsorted over the whole batch.
+            values = score.values.astype(np.float64)
+            region = self._regions(self.risk_thresholds, values)
+            indexed = score.numeric & ~np.isnan(values)
+            matched[indexed] = self.risk_answers[region[indexed]]
+            # Only non-numeric scores (e.g. strings) still need the conditions.
+            general = score.other
+            if not general.any():
+                return matched
+        risk_columns = {**columns, 'score': score}
+        for index, (condition, _) in enumerate(self.risk_levels):
+            hit = condition(risk_columns, n) & (matched == -1) & general
+            matched[hit] = index
+        return matched
+
+    @staticmethod
+    def _regions(thresholds, values):
+        """Vectorised ``engine._region``: index of the region each value falls in."""
+        i = np.searchsorted(thresholds, values, side="left")
+        on_threshold = np.zeros(len(values), dtype=bool)
+        inside = i < len(thresholds)
+        on_threshold[inside] = thresholds[i[inside]] == values[inside]
+        return 2 * i + on_threshold
+
+    def _table_contribution(self, table, thresholds, totals, columns, n):
+        """Score contribution of one ``RuleTable`` for every row."""
+        out = np.zeros(n, dtype=totals.dtype)
+        col = columns.get(table.name)
+        if col is None:
+            return out
+        values = col.values.astype(np.float64)
+        indexed = col.numeric & ~np.isnan(values)
+        out[indexed] = totals[self._regions(thresholds, values)[indexed]]
+        for i in np.flatnonzero(col.other).tolist():
+            out[i] = table.contribution({table.name: col.raw_at(i)})
+        return out
+
+    def _risk_text(self, matched, i):
+        index = matched[i]
+        return self.risk_levels[index][1] if index >= 0 else None
+
+    def evaluate(self, columns, n):
+        """Evaluate every row; returns one ``/calculate``-shaped dict per row."""
+        inputs = columns
+        columns = self.run_formulas(columns, n)
+
+        if self.mode == 'formula':
+            column, errors = self.formula.evaluate(columns, n)
+            results = [None] * n
+            scores = [_ABSENT] * n
+            raw = column.tolist()
+            for i in range(n):
+                if i in errors:
+                    results[i] = {"error": str(errors[i])}
+                    continue
+                try:
+                    scores[i] = round(raw[i], 2)
+                except Exception as e:
+                    results[i] = {"error": str(e)}
+            matched = self.match_risk_levels(columns, Column.from_values(scores), n)
+            for i in range(n):
+                if results[i] is None:
+                    results[i] = {"result": scores[i], "score": scores[i],
+                                  "risk_level": self._risk_text(matched, i)}
+            return results
+
+        if self.mode == 'rules':
+            score = np.zeros(n, dtype=np.int64)
+            for table, thresholds, totals in self.rule_tables:
+                score = score + self._table_contribution(table, thresholds, totals, columns, n)
+            for condition, value in self.rules:
+                score = score + np.where(condition(columns, n), value, 0)
+            score_column = Column(score, np.ones(n, dtype=bool), np.ones(n, dtype=bool),
+                                  np.zeros(n, dtype=bool))
+            matched = self.match_risk_levels(columns, score_column, n)
+            formula_values = [
+                (name, columns[name].tolist(), inputs[name].bound if name in inputs else None)
+                for name, _ in self.formulas
+            ]
+            results = []
+            for i, row_score in enumerate(score.tolist()):
+                risk_level = self._risk_text(matched, i)
+                computed_values = {
+                    name: _round_score(values[i])
+                    for name, values, shadowed in formula_values
+                    if shadowed is None or not shadowed[i]
+                }
+                if risk_level:
+                    computed_values['RiskLevel'] = risk_level
+                results.append({"score": row_score, "computed": computed_values,
+                                "risk_level": risk_level})
+            return results
+
+        score_column = columns.get('score')
+        if score_column is None:
+            return [{"error": str(UnknownASTError("Unknown AST type"))}] * n
+        scores = [
+            _round_score(v) if score_column.bound[i] else _ABSENT
+            for i, v in enumerate(score_column.tolist())
+        ]
+        matched = self.match_risk_levels(columns, Column.from_values(scores), n)
+        return [
+            {"result": s, "score": s, "risk_level": self._risk_text(matched, i)}
+            if s is not _ABSENT else {"error": "Unknown AST type"}
+            for i, s in enumerate(scores)
+        ]
+
+
+batch_plan_cache = LRUCache(max_entries=64)
+
+
+def get_batch_plan(ast):
+    """Return the (cached) ``BatchPlan`` for ``ast``."""
+    key, size = ast_fingerprint(ast)
+    plan = batch_plan_cache.get(key)
+    if plan is None:
+        plan = BatchPlan(ast)
+        batch_plan_cache.put(key, plan, cost=size)
+    return plan
+
+
+def evaluate_batch(ast, rows=None, columns=None):
+    """Score ``rows`` (list of input dicts) or ``columns`` (name -> values) against ``ast``."""
+    if rows is not None:
+        data = columns_from_rows(rows)
+        n = len(rows)
+    else:
+        data = columns_from_dict(columns or {})
+        n = len(next(iter(data.values())).bound) if data else 0
+    if n == 0:
+        return []
+    return get_batch_plan(ast).evaluate(data, n)
@@ -0,0 +1,285 @@
+"""Microbenchmarks of the parser and evaluator hot paths.
+
+Cases are the README's SOFA and HEART scores plus generated stress
+scores (hundreds of rules, deeply nested ``and`` / ``or`` conditions,
+dozens of chained formulas), built from a fixed seed so every run
+measures the same work. Results can be saved as a JSON baseline and
+later runs compared against it; a benchmark slower than the baseline by
+more than ``--threshold`` is flagged and makes the run exit with 1.
+
+Usage:
+    python bench.py                                  # run and print
+    python bench.py --save bench_baseline.json       # record a baseline
+    python bench.py --compare bench_baseline.json    # flag regressions
+    python bench.py --filter evaluate --repeat 9
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import timeit
+
+from dsl import parse_condition_str, parse_formula, tokenize
+from engine import compile_condition, compile_plan, evaluate_condition
+
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10
+TARGET_SECONDS = 0.05  # per repeat; sets how many calls each repeat makes
+SEED = 20240501
+
+
+# ──────────────────────────────────────────────
+# Cases
+# ──────────────────────────────────────────────
+
+SOFA = """score_name: SOFA_Score
+variables:
+  pao2_fio2: int
+  platelets: int
+  gcs: int
+  map: int
+  dopamine: int
+  creatinine: int
+formulas:
+  dummy: 0
+rules:
+  - if: pao2_fio2 < 400
+    add: 1
+  - if: platelets < 150
+    add: 1
+  - if: gcs < 15
+    add: 1
+  - if: map < 70 or dopamine > 0
+    add: 1
+  - if: creatinine >= 2
+    add: 1
+risk_levels:
+  - if: score >= 10
+    text: ⚠️ Critical - Mortality >50%
+  - if: score >= 6
+    text: ⚡ Moderate - Mortality 20-30%
+  - if: score < 6
+    text: ✓ Low - Mortality <15%
+"""
+SOFA_INPUTS = {"pao2_fio2": 280, "platelets": 90, "gcs": 13, "map": 65, "dopamine": 0, "creatinine": 2.4}
+
+HEART = """score_name: HEART_Score
+variables:
+  history: int
+  ecg: int
+  age: int
+  risk_factors: int
+  troponin: int
+formulas:
+  age_factor: (age - 45) / 20
+rules:
+  - if: history >= 2
+    add: 2
+  - if: ecg >= 2
+    add: 2
+  - if: age_factor >= 1
+    add: 2
+  - if: risk_factors >= 3
+    add: 2
+  - if: troponin >= 2
+    add: 2
+risk_levels:
+  - if: score >= 7
+    text: ⚠️ High - Intervention needed
+  - if: score >= 4
+    text: ⚡ Medium - Admit for observation
+  - if: score < 4
+    text: ✓ Low - Consider discharge
+"""
+HEART_INPUTS = {"history": 2, "ecg": 1, "age": 67, "risk_factors": 3, "troponin": 1}
+
+OPS = (">=", "<=", ">", "<", "==", "!=")
+
+
+def many_rules(rng, variables=30, rules=400):
+    """Threshold ladders and mixed comparisons over ``variables`` inputs."""
+    names = [f"v{i}" for i in range(variables)]
+    lines = ["score_name: ManyRules", "variables:"]
+    lines += [f"  {name}: int" for name in names]
+    lines.append("rules:")
+    for _ in range(rules):
+        if rng.random() < 0.2:
+            a, b = rng.sample(names, 2)
+            cond = f"{a} {rng.choice(OPS)} {rng.randint(0, 100)} or {b} {rng.choice(OPS)} {rng.randint(0, 100)}"
+        else:
+            cond = f"{rng.choice(names)} {rng.choice(OPS)} {rng.randint(0, 100)}"
+        lines += [f"  - if: {cond}", f"    add: {rng.randint(1, 3)}"]
+    lines += ["risk_levels:"]
+    for threshold in (300, 200, 100):
+        lines += [f"  - if: score >= {threshold}", f"    text: >= {threshold}"]
+    inputs = {name: rng.randint(0, 100) for name in names}
+    return "\n".join(lines) + "\n", inputs
+
+
+def nested_condition(rng, names, depth):
+    """A condition string alternating ``and`` / ``or`` ``depth`` levels deep."""
+    if depth == 0:
+        return f"{rng.choice(names)} {rng.choice(OPS)} {rng.randint(0, 100)}"
+    joiner = " and " if depth % 2 else " or "
+    parts = [nested_condition(rng, names, depth - 1) for _ in range(2)]
+    return "(" + joiner.join(parts) + ")"
+
+
+def nested_rules(rng, variables=12, rules=20, depth=6):
+    names = [f"n{i}" for i in range(variables)]
+    lines = ["score_name: NestedConditions", "variables:"]
+    lines += [f"  {name}: int" for name in names]
+    lines.append("rules:")
+    for _ in range(rules):
+        lines += [f"  - if: {nested_condition(rng, names, depth)}", "    add: 1"]
+    inputs = {name: rng.randint(0, 100) for name in names}
+    return "\n".join(lines) + "\n", inputs
+
+
+def chained_formulas(rng, length=48):
+    """Formulas each reading the previous one, declared in reverse order."""
+    lines = ["score_name: ChainedFormulas", "variables:", "  x: int", "  y: int", "formulas:"]
+    chain = ["x + y"] + [
+        f"f{i - 1} * {rng.randint(1, 3)} - {rng.choice(['x', 'y'])} / {rng.randint(2, 9)}"
+        for i in range(1, length)
+    ]
+    lines += [f"  f{i}: {expr}" for i, expr in reversed(list(enumerate(chain)))]
+    lines += ["rules:", f"  - if: f{length - 1} > 0", "    add: 1",
+              "risk_levels:", "  - if: score >= 1", "    text: positive"]
+    return "\n".join(lines) + "\n", {"x": 7, "y": 3}
+
+
+def build_cases():
+    """``{name: (dsl_text, inputs)}`` of every benchmarked score."""
+    rng = random.Random(SEED)
+    return {
+        "sofa": (SOFA, SOFA_INPUTS),
+        "heart": (HEART, HEART_INPUTS),
+        "many_rules": many_rules(rng),
+        "nested": nested_rules(rng),
+        "chained": chained_formulas(rng),
+    }
+
+
+def benchmarks():
+    """``{name: zero-argument callable}`` of every benchmark."""
+    rng = random.Random(SEED + 1)
+    cases = build_cases()
+    benches = {}
+    for case, (text, inputs) in cases.items():
+        ast = parse_formula(text)
+        plan = compile_plan(ast)
+        benches[f"parse_formula/{case}"] = lambda text=text: parse_formula(text)
+        # calculate_score = compiling the AST (a plan-cache miss) and evaluating it.
+        benches[f"calculate_score/cold/{case}"] = lambda ast=ast, inputs=inputs: compile_plan(ast).evaluate(inputs)
+        benches[f"calculate_score/warm/{case}"] = lambda plan=plan, inputs=inputs: plan.evaluate(inputs)
+
+    names = [f"n{i}" for i in range(12)]
+    context = {name: rng.randint(0, 100) for name in names}
+    conditions = {
+        "simple": "age >= 65",
+        "compound": "map < 70 or dopamine > 0",
+        "nested_d4": nested_condition(rng, names, 4),
+        "nested_d8": nested_condition(rng, names, 8),
+    }
+    context.update(age=70, map=65, dopamine=0)
+    for label, text in conditions.items():
+        cond = parse_condition_str(text)
+        compiled = compile_condition(cond)
+        benches[f"tokenize/{label}"] = lambda text=text: tokenize(text)
+        benches[f"parse_condition_str/{label}"] = lambda text=text: parse_condition_str(text)
+        benches[f"evaluate_condition/{label}"] = lambda cond=cond: evaluate_condition(cond, context)
+        benches[f"compiled_condition/{label}"] = lambda compiled=compiled: compiled(context)
+    return benches
+
+
+# ──────────────────────────────────────────────
+# Running and comparing
+# ──────────────────────────────────────────────
+
+def measure(fn, repeat=DEFAULT_REPEAT):
+    """Per-call seconds of ``fn``: ``repeat`` samples of a calibrated loop."""
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        if timer.timeit(number) >= TARGET_SECONDS / 5 or number >= 10 ** 7:
+            break
+        number *= 2
+    number = max(1, int(number * TARGET_SECONDS / max(timer.timeit(number), 1e-9)))
+    samples = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "median_us": statistics.median(samples) * 1e6,
+        "min_us": min(samples) * 1e6,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def run(filter_text=None, repeat=DEFAULT_REPEAT, out=sys.stdout):
+    results = {}
+    for name, fn in benchmarks().items():
+        if filter_text and filter_text not in name:
+            continue
+        results[name] = measure(fn, repeat)
+        out.write(f"{name:<40} {results[name]['median_us']:>12.2f} µs  (min {results[name]['min_us']:.2f})\n")
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD, out=sys.stdout):
+    """Print current vs baseline medians; returns the names that regressed."""
+    regressions = []
+    out.write(f"\n{'benchmark':<40} {'baseline µs':>12} {'current µs':>12} {'change':>8}\n")
+    for name, result in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            out.write(f"{name:<40} {'-':>12} {result['median_us']:>12.2f}      new\n")
+            continue
+        ratio = result["median_us"] / base["median_us"] if base["median_us"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        out.write(f"{name:<40} {base['median_us']:>12.2f} {result['median_us']:>12.2f} "
+                  f"{(ratio - 1) * 100:>+7.1f}%{flag}\n")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parser / evaluator microbenchmarks.")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown flagged as a regression (default: 0.10)")
+    args = parser.parse_args(argv)
+
+    current = run(args.filter, args.repeat)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
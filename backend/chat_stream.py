@@ -0,0 +1,94 @@
+"""Splitting /chat model output into the conversational reply and the
+``FORMULA_START`` … ``FORMULA_END`` block, for whole and streamed replies.
+"""
+import json
+
+FORMULA_START = "FORMULA_START"
+FORMULA_END = "FORMULA_END"
+DEFAULT_REPLY = "公式已生成，請點擊「載入到編輯器」使用。"
+
+
+def clean_formula(formula_raw):
+    """Drop markdown fences the model sometimes puts inside the formula block."""
+    formula_lines = [l for l in formula_raw.strip().split("\n") if not l.strip().startswith("```")]
+    return "\n".join(formula_lines).strip()
+
+
+def split_formula_reply(full_text):
+    """``{"reply", "generated_rules"}`` for a reply with a formula block, else ``{"reply"}``."""
+    if FORMULA_START in full_text and FORMULA_END in full_text:
+        before = full_text[:full_text.index(FORMULA_START)].strip()
+        formula_raw = full_text[full_text.index(FORMULA_START) + len(FORMULA_START):full_text.index(FORMULA_END)]
+        after = full_text[full_text.index(FORMULA_END) + len(FORMULA_END):].strip()
+
+        reply_parts = [p for p in [before, after] if p]
+        reply_text = "\n".join(reply_parts) if reply_parts else DEFAULT_REPLY
+        return {"reply": reply_text, "generated_rules": clean_formula(formula_raw)}
+    # Conversational reply only
+    return {"reply": full_text}
+
+
+def _partial_marker(text, marker):
+    """Length of the longest suffix of ``text`` that is a proper prefix of ``marker``."""
+    for k in range(min(len(marker) - 1, len(text)), 0, -1):
+        if text.endswith(marker[:k]):
+            return k
+    return 0
+
+
+class FormulaStreamSplitter:
+    """Incremental counterpart of ``split_formula_reply``.
+
+    ``feed`` takes streamed text and returns ``(event, text)`` pairs:
+    ``("token", text)`` for reply text as soon as it cannot be part of a
+    marker, and one ``("formula", dsl)`` once ``FORMULA_END`` has arrived.
+    Only a marker-sized tail is ever held back, so each chunk is scanned once.
+    """
+
+    def __init__(self):
+        self.pending = ""       # unclassified tail (a possible partial marker)
+        self.formula = []       # pieces of the open formula block
+        self.in_formula = False
+        self.finished = False   # a formula block was emitted; the rest is reply text
+
+    def feed(self, text):
+        events = []
+        self.pending += text
+        while not self.finished:
+            marker = FORMULA_END if self.in_formula else FORMULA_START
+            i = self.pending.find(marker)
+            if i < 0:
+                break
+            before, self.pending = self.pending[:i], self.pending[i + len(marker):]
+            if self.in_formula:
+                self.formula.append(before)
+                events.append(("formula", clean_formula("".join(self.formula))))
+                self.in_formula, self.finished = False, True
+            else:
+                if before:
+                    events.append(("token", before))
+                self.in_formula = True
+
+        keep = 0 if self.finished else _partial_marker(
+            self.pending, FORMULA_END if self.in_formula else FORMULA_START
+        )
+        ready, self.pending = self.pending[:len(self.pending) - keep], self.pending[len(self.pending) - keep:]
+        if ready:
+            if self.in_formula:
+                self.formula.append(ready)
+            else:
+                events.append(("token", ready))
+        return events
+
+    def finish(self):
+        """Flush held-back text; an unterminated formula block is plain reply text."""
+        text = self.pending
+        if self.in_formula:
+            text = FORMULA_START + "".join(self.formula) + text
+        self.pending, self.formula, self.in_formula = "", [], False
+        return [("token", text)] if text else []
+
+
+def sse(event, data):
+    """One Server-Sent Events frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,368 @@
+"""Streaming cohort scoring: CSV / NDJSON rows in, NDJSON / CSV results out.
+
+Rows are parsed incrementally and scored in fixed-size chunks with the
+vectorised batch evaluator, so memory stays constant whatever the input
+size. Bad rows are reported in place and never stop the run; a summary
+with throughput is written at the end.
+
+Usage (CLI):
+    python cohort.py --ast score.json --input patients.csv --output scores.ndjson
+    python cohort.py --formula-id 3 --input patients.ndjson --output-format csv
+"""
+import argparse
+import codecs
+import csv
+import io
+import json
+import math
+import re
+import sys
+import time
+
+DEFAULT_CHUNK_SIZE = 5000
+FORMATS = ("csv", "ndjson")
+CSV_COLUMNS = ["row", "score", "risk_level", "computed", "error"]
+
+
+# ──────────────────────────────────────────────
+# Input
+# ──────────────────────────────────────────────
+
+def _coerce_cell(value):
+    """CSV cells are text: empty means missing, numbers become numbers."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value == "":
+        return None
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _csv_row(fieldnames, values):
+    """(inputs, error) of one CSV record, paired with the header like ``csv.DictReader``."""
+    if len(values) > len(fieldnames):
+        return None, "too many fields"
+    return {name: _coerce_cell(values[i] if i < len(values) else None)
+            for i, name in enumerate(fieldnames)}, None
+
+
+def _ndjson_row(line):
+    """(inputs, error) of one NDJSON line."""
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        return None, f"invalid JSON: {e}"
+    if not isinstance(record, dict):
+        return None, "row is not a JSON object"
+    return record, None
+
+
+def iter_csv_rows(lines):
+    """Yield (row_number, inputs, error) for every data row of a CSV stream."""
+    reader = csv.reader(lines)
+    fieldnames = next(reader, None)
+    number = 0
+    for values in reader:
+        if not values:
+            continue
+        number += 1
+        yield (number, *_csv_row(fieldnames, values))
+
+
+def iter_ndjson_rows(lines):
+    """Yield (row_number, inputs, error) for every non-blank NDJSON line."""
+    number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        number += 1
+        yield (number, *_ndjson_row(line))
+
+
+def iter_rows(lines, input_format):
+    if input_format == "csv":
+        return iter_csv_rows(lines)
+    return iter_ndjson_rows(lines)
+
+
+# Line ends as ``newline=""`` text files see them; a trailing "\r" waits
+# for the next chunk in case it is half of a "\r\n".
+_LINE = re.compile(r"[^\r\n]*(?:\r\n|\n|\r(?!\Z))")
+
+
+class _RecordSplitter:
+    """Cut a byte stream into complete records as the bytes arrive.
+
+    A record is one line; for CSV, lines are joined while a quoted field
+    is still open (an odd number of ``"`` so far), so a record never ends
+    inside a cell.
+    """
+
+    def __init__(self, input_format, encoding="utf-8"):
+        self.csv = input_format == "csv"
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.tail = ""
+        self.pending = []
+        self.quotes = 0
+
+    def feed(self, data, final=False):
+        text = self.tail + self.decoder.decode(data, final)
+        end = 0
+        lines = []
+        for match in _LINE.finditer(text):
+            lines.append(match.group())
+            end = match.end()
+        self.tail = text[end:]
+        if final and self.tail:
+            lines.append(self.tail)
+            self.tail = ""
+        if not self.csv:
+            return lines
+        records = []
+        for line in lines:
+            self.pending.append(line)
+            self.quotes += line.count('"')
+            if self.quotes % 2 == 0:
+                records.append("".join(self.pending))
+                self.pending, self.quotes = [], 0
+        if final and self.pending:
+            records.append("".join(self.pending))
+            self.pending, self.quotes = [], 0
+        return records
+
+
+# ──────────────────────────────────────────────
+# Output
+# ──────────────────────────────────────────────
+
+def _finite(value):
+    """``value`` with NaN / ±Infinity replaced by None, which JSON can carry."""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(v) for v in value]
+    return value
+
+
+def _format_ndjson(number, result):
+    return json.dumps(_finite({"row": number, **result}), ensure_ascii=False, allow_nan=False,
+                      default=str) + "\n"
+
+
+def _format_csv(number, result):
+    buffer = io.StringIO()
+    result = _finite(result)
+    computed = result.get("computed")
+    score = result.get("score", "")
+    csv.writer(buffer).writerow([
+        number,
+        "" if score is None else score,
+        result.get("risk_level") or "",
+        json.dumps(computed, ensure_ascii=False, allow_nan=False) if computed is not None else "",
+        result.get("error", ""),
+    ])
+    return buffer.getvalue()
+
+
+# ──────────────────────────────────────────────
+# Scoring
+# ──────────────────────────────────────────────
+
+class StreamScorer:
+    """Chunked scoring state shared by ``score_stream`` and ``score_body``.
+
+    ``add`` / ``feed`` return the output text of every chunk they fill
+    (often ``""``); ``finish`` flushes the last chunk and the summary.
+    """
+
+    def __init__(self, ast, input_format="ndjson", output_format="ndjson",
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        from batch import columns_from_rows, get_batch_plan  # NumPy: loaded on first use
+
+        self.plan = get_batch_plan(ast)
+        self.columns_from_rows = columns_from_rows
+        self.input_format = input_format
+        self.output_format = output_format
+        self.write = _format_csv if output_format == "csv" else _format_ndjson
+        self.chunk_size = chunk_size
+        self.chunk = []  # (row_number, inputs, parse_error)
+        self.total = self.errors = 0
+        self.started = time.perf_counter()
+        self.splitter = None
+        self.fieldnames = None
+
+    def header(self):
+        if self.output_format != "csv":
+            return ""
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(CSV_COLUMNS)
+        return buffer.getvalue()
+
+    def _flush(self):
+        valid = [inputs for _, inputs, error in self.chunk if error is None]
+        results = iter(self.plan.evaluate(self.columns_from_rows(valid), len(valid)) if valid else [])
+        out = []
+        for number, _, error in self.chunk:
+            result = {"error": error} if error is not None else next(results)
+            if "error" in result:
+                self.errors += 1
+            out.append(self.write(number, result))
+        self.chunk.clear()
+        return "".join(out)
+
+    def add(self, row):
+        """Queue one (row_number, inputs, error) row."""
+        self.total += 1
+        self.chunk.append(row)
+        return self._flush() if len(self.chunk) >= self.chunk_size else ""
+
+    def _parse(self, record):
+        if self.input_format == "csv":
+            values = next(csv.reader([record]), [])
+            if self.fieldnames is None:
+                self.fieldnames = values
+                return None
+            if not values:
+                return None
+            return _csv_row(self.fieldnames, values)
+        if not record.strip():
+            return None
+        return _ndjson_row(record)
+
+    def feed(self, data, final=False):
+        """Parse and queue the rows completed by raw input bytes ``data``."""
+        if self.splitter is None:
+            self.splitter = _RecordSplitter(self.input_format)
+        out = []
+        for record in self.splitter.feed(data, final):
+            row = self._parse(record)
+            if row is not None:
+                out.append(self.add((self.total + 1, *row)))
+        return "".join(out)
+
+    def finish(self):
+        out = self.feed(b"", final=True) if self.splitter is not None else ""
+        if self.chunk:
+            out += self._flush()
+        elapsed = time.perf_counter() - self.started
+        summary = {
+            "rows": self.total,
+            "errors": self.errors,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(self.total / elapsed, 1) if elapsed > 0 else None,
+        }
+        if self.output_format == "csv":
+            return out + "# " + json.dumps({"summary": summary}) + "\n"
+        return out + json.dumps({"summary": summary}) + "\n"
+
+
+def score_stream(ast, lines, input_format="ndjson", output_format="ndjson",
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """Score a stream of text lines against ``ast``; yields output text pieces.
+
+    The last piece is a summary: a JSON object for NDJSON output, or a
+    ``#``-prefixed line for CSV output.
+    """
+    scorer = StreamScorer(ast, input_format, output_format, chunk_size)
+    if scorer.header():
+        yield scorer.header()
+    for row in iter_rows(lines, input_format):
+        out = scorer.add(row)
+        if out:
+            yield out
+    yield scorer.finish()
+
+
+async def score_body(ast, body, input_format="ndjson", output_format="ndjson",
+                     chunk_size=DEFAULT_CHUNK_SIZE):
+    """``score_stream`` over an async iterator of raw bytes (a request body).
+
+    Rows are scored as soon as their chunk fills, while the rest of the
+    body is still arriving; parsing and scoring run in the threadpool.
+    """
+    from starlette.concurrency import run_in_threadpool
+
+    scorer = StreamScorer(ast, input_format, output_format, chunk_size)
+    if scorer.header():
+        yield scorer.header()
+    async for data in body:
+        out = await run_in_threadpool(scorer.feed, data)
+        if out:
+            yield out
+    yield await run_in_threadpool(scorer.finish)
+
+
+def guess_format(name, default="ndjson"):
+    """Pick csv / ndjson from a file name or content type."""
+    name = (name or "").lower()
+    if name.endswith(".csv") or "csv" in name:
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in name or "jsonl" in name:
+        return "ndjson"
+    return default
+
+
+# ──────────────────────────────────────────────
+# CLI
+# ──────────────────────────────────────────────
+
+def _load_formula_ast(formula_id):
+    import asyncio
+    from database import SessionLocal, engine
+    import crud
+
+    async def load():
+        try:
+            async with SessionLocal() as db:
+                return await crud.get_formula(db, formula_id)
+        finally:
+            await engine.dispose()
+
+    formula = asyncio.run(load())
+    if not formula:
+        raise SystemExit(f"Formula {formula_id} not found")
+    return formula.ast_data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a CSV / NDJSON cohort file.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--ast", help="path to an AST JSON file")
+    source.add_argument("--formula-id", type=int, help="id of a stored formula")
+    parser.add_argument("--input", default="-", help="input file (default: stdin)")
+    parser.add_argument("--output", default="-", help="output file (default: stdout)")
+    parser.add_argument("--input-format", choices=FORMATS)
+    parser.add_argument("--output-format", choices=FORMATS)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.ast:
+        with open(args.ast, encoding="utf-8") as f:
+            ast = json.load(f)
+    else:
+        ast = _load_formula_ast(args.formula_id)
+
+    input_format = args.input_format or guess_format(args.input)
+    output_format = args.output_format or guess_format(args.output)
+
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8", newline="")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        for piece in score_stream(ast, src, input_format, output_format, args.chunk_size):
+            dst.write(piece)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""pytest setup: the app under test runs against a throwaway SQLite database."""
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# Must be set before ``database`` is imported (it builds the engine on import).
+_db_dir = tempfile.mkdtemp(prefix="medical-blockly-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ["AUTO_MIGRATE"] = "1"
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from app import app
+
+    with TestClient(app) as c:
+        yield c
+
+
+@pytest.fixture
+def department(client):
+    """A fresh department, deleted (with its formulas) afterwards."""
+    dept = client.post("/departments", json={"name": f"test-{uuid.uuid4().hex[:8]}"}).json()
+    yield dept
+    client.delete(f"/departments/{dept['id']}")
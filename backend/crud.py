@@ -1,7 +1,14 @@
-from sqlalchemy.orm import Session
-from typing import Optional, List
-
-from models import Department, Formula, PatientField
+from datetime import datetime
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from typing import Optional, List, Sequence
+
+from models import Department, Formula, ParseCacheEntry, PatientField, TableVersion, utcnow
+from plan_cache import invalidate_department, invalidate_formula
+from field_registry import invalidate_patient_fields
 from schemas import (
     DepartmentCreate,
     DepartmentUpdate,
@@ -12,47 +19,130 @@ from schemas import (
 )
 
 
+# ──────────────────────────────────────────────
+# Table versions  (ETags of the GET endpoints)
+# ──────────────────────────────────────────────
+
+# Department responses embed formula summaries, so formula writes bump both.
+DEPARTMENT_TABLES = ("departments", "formulas")
+FORMULA_TABLES = ("formulas", "departments")
+PATIENT_FIELD_TABLES = ("patient_fields",)
+
+
+async def bump_versions(db: AsyncSession, names) -> None:
+    """Increment the change counters of ``names`` within the current transaction."""
+    # Surface errors of the pending write itself before the savepoint below,
+    # and lock the counter rows in one global order.
+    await db.flush()
+    for name in sorted(names):
+        increment = (
+            update(TableVersion)
+            .where(TableVersion.name == name)
+            .values(version=TableVersion.version + 1)
+        )
+        result = await db.execute(increment)
+        if result.rowcount:
+            continue
+        try:
+            async with db.begin_nested():
+                db.add(TableVersion(name=name, version=1))
+        except IntegrityError:
+            # Another writer created the row first.
+            await db.execute(increment)
+
+
+async def _commit_existing(db: AsyncSession, names) -> bool:
+    """Bump ``names`` and commit a write to a row loaded earlier in this session.
+
+    A concurrent DELETE of that row surfaces at the flush: the UPDATE /
+    DELETE matches nothing (``StaleDataError``) or a cascade removed its
+    parent (``IntegrityError``). The session is rolled back and False
+    returned, so the caller answers as if the row had never been found.
+    """
+    try:
+        await bump_versions(db, names)
+        await db.commit()
+    except (StaleDataError, IntegrityError):
+        await db.rollback()
+        return False
+    return True
+
+
+async def _refresh_existing(db: AsyncSession, obj) -> bool:
+    """Reload ``obj`` after a commit; False if it was deleted meanwhile."""
+    try:
+        await db.refresh(obj)
+    except InvalidRequestError:
+        return False
+    return True
+
+
+async def get_versions(db: AsyncSession, names) -> tuple:
+    """Current counters of ``names`` (0 for a table never written)."""
+    rows = dict((await db.execute(
+        select(TableVersion.name, TableVersion.version).where(TableVersion.name.in_(names))
+    )).all())
+    return tuple(rows.get(name, 0) for name in names)
+
+
 # ──────────────────────────────────────────────
 # Department CRUD
 # ──────────────────────────────────────────────
 
-def create_department(db: Session, data: DepartmentCreate) -> Department:
+async def create_department(db: AsyncSession, data: DepartmentCreate) -> Department:
     dept = Department(name=data.name, description=data.description)
     db.add(dept)
-    db.commit()
-    db.refresh(dept)
+    await bump_versions(db, DEPARTMENT_TABLES)
+    await db.commit()
+    await db.refresh(dept)
     return dept
 
 
-def get_departments(db: Session) -> List[Department]:
-    return db.query(Department).order_by(Department.id).all()
+async def get_departments(db: AsyncSession) -> List[Department]:
+    return list(await db.scalars(select(Department).order_by(Department.id)))
 
 
-def get_department(db: Session, department_id: int) -> Optional[Department]:
-    return db.query(Department).filter(Department.id == department_id).first()
-
-
-def update_department(
-    db: Session, department_id: int, data: DepartmentUpdate
+async def get_department(
+    db: AsyncSession, department_id: int, with_formulas: bool = False
+) -> Optional[Department]:
+    """``with_formulas`` loads ``Department.formulas`` up front (it cannot be
+    loaded lazily from an async session) in one extra query, without the
+    formulas' ASTs and source text."""
+    query = select(Department).where(Department.id == department_id)
+    if with_formulas:
+        query = query.options(
+            selectinload(Department.formulas).load_only(*FORMULA_SUMMARY_COLUMNS, raiseload=True)
+        )
+    return await db.scalar(query)
+
+
+async def update_department(
+    db: AsyncSession, department_id: int, data: DepartmentUpdate
 ) -> Optional[Department]:
-    dept = get_department(db, department_id)
+    dept = await get_department(db, department_id)
     if not dept:
         return None
     if data.name is not None:
         dept.name = data.name
     if data.description is not None:
         dept.description = data.description
-    db.commit()
-    db.refresh(dept)
+    await bump_versions(db, DEPARTMENT_TABLES)
+    await db.commit()
+    await db.refresh(dept)
     return dept
 
 
-def delete_department(db: Session, department_id: int) -> bool:
-    dept = get_department(db, department_id)
+async def delete_department(db: AsyncSession, department_id: int) -> bool:
+    dept = await get_department(db, department_id, with_formulas=True)
     if not dept:
         return False
-    db.delete(dept)
-    db.commit()
+    formula_ids = [f.id for f in dept.formulas]
+    await db.delete(dept)
+    await bump_versions(db, DEPARTMENT_TABLES)
+    await db.commit()
+    for formula_id in formula_ids:
+        invalidate_formula(formula_id)
+    invalidate_department(department_id)
     return True
 
 
@@ -60,8 +150,19 @@ def delete_department(db: Session, department_id: int) -> bool:
 # Formula CRUD
 # ──────────────────────────────────────────────
 
-def create_formula(
-    db: Session, department_id: int, data: FormulaCreate
+# Everything but the heavy ``ast_data`` / ``raw_text`` columns.
+FORMULA_SUMMARY_COLUMNS = (
+    Formula.id,
+    Formula.department_id,
+    Formula.name,
+    Formula.description,
+    Formula.created_at,
+    Formula.updated_at,
+)
+
+
+async def create_formula(
+    db: AsyncSession, department_id: int, data: FormulaCreate
 ) -> Formula:
     formula = Formula(
         department_id=department_id,
@@ -71,28 +172,65 @@ def create_formula(
         raw_text=data.raw_text,
     )
     db.add(formula)
-    db.commit()
-    db.refresh(formula)
+    await bump_versions(db, FORMULA_TABLES)
+    await db.commit()
+    await db.refresh(formula)
+    invalidate_department(department_id)
     return formula
 
 
-def get_formulas(
-    db: Session, department_id: Optional[int] = None
+async def get_formulas(
+    db: AsyncSession,
+    department_id: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: Optional[int] = None,
+    fields: Optional[Sequence[str]] = None,
 ) -> List[Formula]:
-    query = db.query(Formula)
+    """Formulas ordered by id.
+
+    ``after`` / ``limit`` select a keyset page (ids greater than ``after``).
+    ``fields`` names the columns to load; the others are left out of the
+    SELECT and raise if accessed.
+    """
+    query = select(Formula)
     if department_id is not None:
-        query = query.filter(Formula.department_id == department_id)
-    return query.order_by(Formula.id).all()
+        query = query.where(Formula.department_id == department_id)
+    if after is not None:
+        query = query.where(Formula.id > after)
+    if fields is not None:
+        query = query.options(load_only(*(getattr(Formula, f) for f in fields), raiseload=True))
+    query = query.order_by(Formula.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return list(await db.scalars(query))
+
 
+async def get_formula(db: AsyncSession, formula_id: int) -> Optional[Formula]:
+    return await db.scalar(select(Formula).where(Formula.id == formula_id))
 
-def get_formula(db: Session, formula_id: int) -> Optional[Formula]:
-    return db.query(Formula).filter(Formula.id == formula_id).first()
+
+async def get_formula_version(db: AsyncSession, formula_id: int):
+    """Return the (id, updated_at) row of a formula without loading its AST."""
+    result = await db.execute(
+        select(Formula.id, Formula.updated_at).where(Formula.id == formula_id)
+    )
+    return result.first()
+
+
+async def get_formula_versions(db: AsyncSession, department_id: int):
+    """Return (id, name, updated_at) rows of a department's formulas, without ASTs."""
+    result = await db.execute(
+        select(Formula.id, Formula.name, Formula.updated_at)
+        .where(Formula.department_id == department_id)
+        .order_by(Formula.id)
+    )
+    return result.all()
 
 
-def update_formula(
-    db: Session, formula_id: int, data: FormulaUpdate
+async def update_formula(
+    db: AsyncSession, formula_id: int, data: FormulaUpdate
 ) -> Optional[Formula]:
-    formula = get_formula(db, formula_id)
+    formula = await get_formula(db, formula_id)
     if not formula:
         return None
     if data.name is not None:
@@ -103,63 +241,210 @@ def update_formula(
         formula.ast_data = data.ast_data
     if data.raw_text is not None:
         formula.raw_text = data.raw_text
-    db.commit()
-    db.refresh(formula)
+    if not await _commit_existing(db, FORMULA_TABLES):
+        return None
+    invalidate_formula(formula_id)
+    invalidate_department(formula.department_id)
+    if not await _refresh_existing(db, formula):
+        return None
     return formula
 
 
-def delete_formula(db: Session, formula_id: int) -> bool:
-    formula = get_formula(db, formula_id)
+async def delete_formula(db: AsyncSession, formula_id: int) -> bool:
+    formula = await get_formula(db, formula_id)
     if not formula:
         return False
-    db.delete(formula)
-    db.commit()
+    department_id = formula.department_id
+    await db.delete(formula)
+    if not await _commit_existing(db, FORMULA_TABLES):
+        return False
+    invalidate_formula(formula_id)
+    invalidate_department(department_id)
     return True
 
 
+async def get_formula_ids_by_name(db: AsyncSession, department_id: int) -> dict:
+    """``{name: id}`` of a department's formulas."""
+    result = await db.execute(
+        select(Formula.name, Formula.id).where(Formula.department_id == department_id)
+    )
+    return dict(result.all())
+
+
+async def import_formulas(
+    db: AsyncSession,
+    department_id: int,
+    items: Sequence[FormulaCreate],
+    existing: Optional[dict] = None,
+) -> dict:
+    """Write ``items`` into a department in one transaction.
+
+    Items named in ``existing`` (``{name: id}``, see
+    ``get_formula_ids_by_name``) overwrite that formula; the rest are
+    created. Each group is one batched statement.
+    """
+    existing = existing or {}
+    now = utcnow()
+    new_rows, changed_rows = [], []
+    for item in items:
+        values = {
+            "name": item.name,
+            "description": item.description,
+            "ast_data": item.ast_data,
+            "raw_text": item.raw_text,
+            "updated_at": now,
+        }
+        if item.name in existing:
+            changed_rows.append({"id": existing[item.name], **values})
+        else:
+            new_rows.append({"department_id": department_id, "created_at": now, **values})
+
+    if new_rows:
+        await db.execute(insert(Formula), new_rows)
+    if changed_rows:
+        await db.execute(update(Formula), changed_rows)
+    await bump_versions(db, FORMULA_TABLES)
+    await db.commit()
+    for row in changed_rows:
+        invalidate_formula(row["id"])
+    invalidate_department(department_id)
+    return {"created": len(new_rows), "updated": len(changed_rows)}
+
+
 # ──────────────────────────────────────────────
 # PatientField CRUD  (field-name registry)
 # ──────────────────────────────────────────────
 
-def create_patient_field(db: Session, data: PatientFieldCreate) -> PatientField:
+async def create_patient_field(db: AsyncSession, data: PatientFieldCreate) -> PatientField:
     field = PatientField(
         field_name=data.field_name.strip(),
         label=data.label,
         field_type=data.field_type,
     )
     db.add(field)
-    db.commit()
-    db.refresh(field)
+    await bump_versions(db, PATIENT_FIELD_TABLES)
+    await db.commit()
+    await db.refresh(field)
+    invalidate_patient_fields()
     return field
 
 
-def get_patient_fields(db: Session) -> List[PatientField]:
-    return db.query(PatientField).order_by(PatientField.id).all()
+async def get_patient_fields(db: AsyncSession) -> List[PatientField]:
+    return list(await db.scalars(select(PatientField).order_by(PatientField.id)))
 
 
-def get_patient_field(db: Session, field_id: int) -> Optional[PatientField]:
-    return db.query(PatientField).filter(PatientField.id == field_id).first()
+async def get_patient_field(db: AsyncSession, field_id: int) -> Optional[PatientField]:
+    return await db.scalar(select(PatientField).where(PatientField.id == field_id))
 
 
-def update_patient_field(
-    db: Session, field_id: int, data: PatientFieldUpdate
+async def update_patient_field(
+    db: AsyncSession, field_id: int, data: PatientFieldUpdate
 ) -> Optional[PatientField]:
-    field = get_patient_field(db, field_id)
+    field = await get_patient_field(db, field_id)
     if not field:
         return None
     if data.label is not None:
         field.label = data.label
     if data.field_type is not None:
         field.field_type = data.field_type
-    db.commit()
-    db.refresh(field)
+    if not await _commit_existing(db, PATIENT_FIELD_TABLES):
+        return None
+    invalidate_patient_fields()
+    if not await _refresh_existing(db, field):
+        return None
     return field
 
 
-def delete_patient_field(db: Session, field_id: int) -> bool:
-    field = get_patient_field(db, field_id)
+async def delete_patient_field(db: AsyncSession, field_id: int) -> bool:
+    field = await get_patient_field(db, field_id)
     if not field:
         return False
-    db.delete(field)
-    db.commit()
+    await db.delete(field)
+    if not await _commit_existing(db, PATIENT_FIELD_TABLES):
+        return False
+    invalidate_patient_fields()
     return True
+
+
+# ──────────────────────────────────────────────
+# Parse cache  (AI parse results)
+# ──────────────────────────────────────────────
+
+async def get_parse_cache_entry(
+    db: AsyncSession, key: str, created_after: Optional[datetime] = None
+) -> Optional[ParseCacheEntry]:
+    """Return a live cache entry and record the hit; expired entries are deleted."""
+    entry = await db.scalar(select(ParseCacheEntry).where(ParseCacheEntry.key == key))
+    if not entry:
+        return None
+    if created_after is not None and entry.created_at < created_after.replace(tzinfo=None):
+        await db.delete(entry)
+        await db.commit()
+        return None
+    entry.hits += 1
+    entry.last_used_at = utcnow()
+    await db.commit()
+    return entry
+
+
+async def save_parse_cache_entry(
+    db: AsyncSession, key: str, model_name: str, prompt_version: str, ast_data, size: int
+) -> ParseCacheEntry:
+    """Insert or replace the entry for ``key`` and return it (detached).
+
+    Identical parses can finish concurrently (in other workers too), so a
+    key inserted meanwhile is updated instead of failing on the primary key.
+    """
+    now = utcnow()
+    values = dict(
+        model_name=model_name,
+        prompt_version=prompt_version,
+        ast_data=ast_data,
+        size=size,
+        hits=0,
+        created_at=now,
+        last_used_at=now,
+    )
+    try:
+        async with db.begin_nested():
+            await db.execute(insert(ParseCacheEntry).values(key=key, **values))
+    except IntegrityError:
+        # Another parse stored the same key first.
+        await db.execute(
+            update(ParseCacheEntry).where(ParseCacheEntry.key == key).values(**values)
+        )
+    await db.commit()
+    return ParseCacheEntry(key=key, **values)
+
+
+async def prune_parse_cache(
+    db: AsyncSession, max_entries: int, created_after: Optional[datetime] = None
+) -> int:
+    """Delete expired entries, then the least recently used beyond ``max_entries``."""
+    removed = 0
+    if created_after is not None:
+        result = await db.execute(
+            delete(ParseCacheEntry)
+            .where(ParseCacheEntry.created_at < created_after.replace(tzinfo=None))
+            .execution_options(synchronize_session=False)
+        )
+        removed += result.rowcount
+    excess = await count_parse_cache_entries(db) - max_entries
+    if excess > 0:
+        keys = list(await db.scalars(
+            select(ParseCacheEntry.key)
+            .order_by(ParseCacheEntry.last_used_at, ParseCacheEntry.created_at)
+            .limit(excess)
+        ))
+        result = await db.execute(
+            delete(ParseCacheEntry)
+            .where(ParseCacheEntry.key.in_(keys))
+            .execution_options(synchronize_session=False)
+        )
+        removed += result.rowcount
+    await db.commit()
+    return removed
+
+
+async def count_parse_cache_entries(db: AsyncSession) -> int:
+    return await db.scalar(select(func.count(ParseCacheEntry.key))) or 0
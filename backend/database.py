@@ -1,7 +1,13 @@
 import os
+import time
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from metrics import DB_POOL_CHECKOUT
 
 load_dotenv()
 
@@ -16,10 +22,15 @@ if not DATABASE_URL:
     )
 
 
-def _ensure_database_exists():
-    """Auto-create the database if it doesn't exist (MySQL / PostgreSQL)."""
+def ensure_database_exists():
+    """Create the database if it doesn't exist (MySQL / PostgreSQL).
+
+    Run by ``migrate.py``, not on import: it opens a connection of its own.
+    """
     from urllib.parse import urlparse
 
+    if make_url(DATABASE_URL).get_backend_name() == "sqlite":
+        return  # the file is created on first connect
     parsed = urlparse(DATABASE_URL)
     db_name = parsed.path.lstrip("/")  # e.g. "blocky_ai"
 
@@ -50,24 +61,89 @@ def _ensure_database_exists():
         print(f"Could not auto-create database: {e}")
 
 
-_ensure_database_exists()
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# ──────────────────────────────────────────────
+# Async engine
+# ──────────────────────────────────────────────
+
+# asyncio driver used for each backend when DATABASE_URL names a sync one.
+ASYNC_DRIVERS = {
+    "mysql": "aiomysql",
+    "postgresql": "asyncpg",
+    "sqlite": "aiosqlite",
+}
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def async_database_url(url):
+    """``url`` with its driver swapped for the asyncio one of its backend
+    (``mysql+pymysql`` → ``mysql+aiomysql``, ``postgresql+psycopg2`` →
+    ``postgresql+asyncpg``, ``sqlite`` → ``sqlite+aiosqlite``)."""
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None:
+        return url
+    return parsed.set(drivername=f"{parsed.get_backend_name()}+{driver}").render_as_string(hide_password=False)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool recording how long each checkout waits (``DB_POOL_CHECKOUT``)."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT.observe(time.perf_counter() - start)
+
+
+def _pool_options(url):
+    """Pool class and sizing for ``create_async_engine``; in-memory SQLite
+    uses a single shared connection and takes none."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        return {}
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or async_database_url(DATABASE_URL)
+
+engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=True, **_pool_options(ASYNC_DATABASE_URL))
+# Objects stay readable after commit: an async session cannot lazily
+# reload expired attributes when a response is serialized.
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
 
-def get_db():
-    """FastAPI dependency: yields a DB session and closes it after use."""
-    db = SessionLocal()
-    try:
+async def get_db():
+    """FastAPI dependency: yields an ``AsyncSession`` and closes it after use."""
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def init_db():
-    """Create all tables defined by ORM models."""
+def _create_missing_indexes(conn):
+    # create_all skips tables that already exist, so indexes added to a
+    # model later are created here.
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+async def init_db():
+    """Create all tables (and any missing indexes) defined by ORM models."""
     import models  # noqa: F401 – ensure models are registered with Base
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_missing_indexes)
+
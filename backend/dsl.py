@@ -0,0 +1,395 @@
+"""Lexer and recursive-descent parser for the scoring DSL.
+
+The document is scanned once, line by line; every condition and formula
+is tokenized by a single precompiled regex and parsed by precedence
+climbing, so parsing is linear in the size of the document. Problems are
+raised as ``DSLSyntaxError`` with the line and column they occur at.
+
+Condition grammar (keywords are case-insensitive)::
+
+    condition  := and_cond ('or' and_cond)*
+    and_cond   := primary ('and' primary)*
+    primary    := '(' condition ')' | NAME [compare literal]
+    compare    := '>=' | '<=' | '==' | '!=' | '>' | '<' | 'is' ['not']
+    literal    := ['+' | '-'] NUMBER | 'true' | 'false' | NAME | STRING
+
+Formulas are Python-style expressions (ternaries, ``and`` / ``or`` /
+``not``, comparisons, ``+ - * / // % **`` and function calls); they are
+checked here and stored as text for ``engine.CompiledExpression``.
+"""
+import re
+import time
+
+
+class DSLSyntaxError(ValueError):
+    """A DSL document that cannot be parsed; ``line`` / ``column`` are 1-based."""
+
+    def __init__(self, message, line=1, column=1):
+        super().__init__(f"line {line}, column {column}: {message}")
+        self.message = message
+        self.line = line
+        self.column = column
+
+
+# ──────────────────────────────────────────────
+# Lexer
+# ──────────────────────────────────────────────
+
+_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[^\W\d]\w*)
+  | (?P<string>"[^"]*"|'[^']*')
+  | (?P<op>\*\*|//|>=|<=|==|!=|[-+*/%<>(),])
+""", re.VERBOSE)
+
+
+class Token:
+    __slots__ = ("kind", "value", "line", "column")
+
+    def __init__(self, kind, value, line, column):
+        self.kind = kind      # 'name', 'number', 'string', 'op' or 'end'
+        self.value = value
+        self.line = line
+        self.column = column
+
+    def __repr__(self):
+        return f"Token({self.kind}, {self.value!r}, {self.line}:{self.column})"
+
+
+def tokenize(text, line=1, column=1):
+    """Split ``text`` into tokens; ``line`` / ``column`` locate its first character."""
+    tokens = []
+    pos = 0
+    end = len(text)
+    while pos < end:
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            char = text[pos]
+            if char in "\"'":
+                raise DSLSyntaxError("unterminated string", line, column + pos)
+            raise DSLSyntaxError(f"unexpected character {char!r}", line, column + pos)
+        kind = match.lastgroup
+        if kind != "space":
+            tokens.append(Token(kind, match.group(), line, column + pos))
+        pos = match.end()
+    tokens.append(Token("end", "", line, column + end))
+    return tokens
+
+
+# ──────────────────────────────────────────────
+# Parser
+# ──────────────────────────────────────────────
+
+_COMPARE_OPS = (">=", "<=", "==", "!=", ">", "<")
+_KEYWORDS = {"and", "or", "not", "is", "if", "else"}
+
+
+def _describe(token):
+    return "end of line" if token.kind == "end" else repr(token.value)
+
+
+def _literal_number(text):
+    """Numbers keep the old ``parse_condition_str`` typing: whole values become ints."""
+    if re.fullmatch(r"\d+", text):
+        return int(text)
+    value = float(text)
+    if value != value or value in (float("inf"), float("-inf")):
+        return text
+    return int(value) if value == int(value) else value
+
+
+class _Parser:
+    def __init__(self, tokens, ignore_case=False):
+        self.tokens = tokens
+        self.pos = 0
+        self.ignore_case = ignore_case
+
+    @property
+    def token(self):
+        return self.tokens[self.pos]
+
+    def advance(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def error(self, message):
+        return DSLSyntaxError(message, self.token.line, self.token.column)
+
+    def keyword(self, word):
+        token = self.token
+        if token.kind != "name":
+            return False
+        value = token.value.lower() if self.ignore_case else token.value
+        return value == word
+
+    def op(self, *values):
+        return self.token.kind == "op" and self.token.value in values
+
+    def expect_op(self, value):
+        if not self.op(value):
+            raise self.error(f"expected {value!r}, found {_describe(self.token)}")
+        return self.advance()
+
+    def expect_end(self):
+        if self.token.kind != "end":
+            raise self.error(f"unexpected {_describe(self.token)}")
+
+    # Conditions ------------------------------------------------------
+
+    def condition(self):
+        parts = [self.and_condition()]
+        while self.keyword("or"):
+            self.advance()
+            parts.append(self.and_condition())
+        return parts[0] if len(parts) == 1 else {"compound": "or", "conditions": parts}
+
+    def and_condition(self):
+        parts = [self.primary_condition()]
+        while self.keyword("and"):
+            self.advance()
+            parts.append(self.primary_condition())
+        return parts[0] if len(parts) == 1 else {"compound": "and", "conditions": parts}
+
+    def primary_condition(self):
+        if self.op("("):
+            self.advance()
+            cond = self.condition()
+            self.expect_op(")")
+            return cond
+        token = self.token
+        if token.kind != "name" or token.value.lower() in _KEYWORDS:
+            raise self.error(f"expected a condition, found {_describe(token)}")
+        left = self.advance().value
+
+        if self.op(*_COMPARE_OPS):
+            op = self.advance().value
+        elif self.keyword("is"):
+            self.advance()
+            op = "=="
+            if self.keyword("not"):
+                self.advance()
+                op = "!="
+        else:
+            # A bare boolean variable means ``name == true``
+            return {"op": "==", "left": left, "right": True}
+        return {"op": op, "left": left, "right": self.literal()}
+
+    def literal(self):
+        token = self.token
+        if self.op("-", "+"):
+            sign = self.advance().value
+            if self.token.kind != "number":
+                raise self.error(f"expected a number after {sign!r}")
+            value = _literal_number(self.advance().value)
+            if isinstance(value, str):
+                return sign + value if sign == "-" else value
+            return -value if sign == "-" else value
+        if token.kind == "number":
+            return _literal_number(self.advance().value)
+        if token.kind == "string":
+            return self.advance().value[1:-1]
+        if token.kind == "name":
+            value = self.advance().value
+            if value.lower() == "true":
+                return True
+            if value.lower() == "false":
+                return False
+            return value
+        raise self.error(f"expected a value, found {_describe(token)}")
+
+    # Expressions ------------------------------------------------------
+
+    def expression(self):
+        self.or_expression()
+        if self.keyword("if"):
+            self.advance()
+            self.or_expression()
+            if not self.keyword("else"):
+                raise self.error(f"expected 'else', found {_describe(self.token)}")
+            self.advance()
+            self.expression()
+
+    def or_expression(self):
+        self.and_expression()
+        while self.keyword("or"):
+            self.advance()
+            self.and_expression()
+
+    def and_expression(self):
+        self.not_expression()
+        while self.keyword("and"):
+            self.advance()
+            self.not_expression()
+
+    def not_expression(self):
+        if self.keyword("not"):
+            self.advance()
+            self.not_expression()
+            return
+        self.arithmetic()
+        while self.op(*_COMPARE_OPS):
+            self.advance()
+            self.arithmetic()
+
+    def arithmetic(self):
+        self.term()
+        while self.op("+", "-"):
+            self.advance()
+            self.term()
+
+    def term(self):
+        self.factor()
+        while self.op("*", "/", "//", "%"):
+            self.advance()
+            self.factor()
+
+    def factor(self):
+        if self.op("+", "-"):
+            self.advance()
+            self.factor()
+            return
+        self.atom()
+        if self.op("**"):
+            self.advance()
+            self.factor()
+
+    def atom(self):
+        token = self.token
+        if token.kind in ("number", "string"):
+            self.advance()
+            return
+        if token.kind == "name" and token.value not in _KEYWORDS:
+            self.advance()
+            if self.op("("):
+                self.advance()
+                if not self.op(")"):
+                    self.expression()
+                    while self.op(","):
+                        self.advance()
+                        self.expression()
+                self.expect_op(")")
+            return
+        if self.op("("):
+            self.advance()
+            self.expression()
+            self.expect_op(")")
+            return
+        raise self.error(f"expected an expression, found {_describe(token)}")
+
+
+def parse_condition_str(cond_str, line=1, column=1):
+    """Parse a condition like ``BMI >= 25`` or ``age > 50 and (a or b)``."""
+    parser = _Parser(tokenize(cond_str, line, column), ignore_case=True)
+    cond = parser.condition()
+    parser.expect_end()
+    return cond
+
+
+def parse_expression(text, line=1, column=1):
+    """Check the syntax of a formula expression and return it stripped."""
+    parser = _Parser(tokenize(text, line, column))
+    parser.expression()
+    parser.expect_end()
+    return text.strip()
+
+
+def _parse_int(text, line, column):
+    tokens = tokenize(text, line, column)
+    sign = 1
+    if tokens[0].kind == "op" and tokens[0].value in ("-", "+"):
+        sign = -1 if tokens[0].value == "-" else 1
+        tokens = tokens[1:]
+    if tokens[0].kind != "number" or not tokens[0].value.isdigit() or tokens[1].kind != "end":
+        raise DSLSyntaxError(f"expected an integer, found {text!r}", line, column)
+    return sign * int(tokens[0].value)
+
+
+# ──────────────────────────────────────────────
+# Documents
+# ──────────────────────────────────────────────
+
+_KEY = re.compile(r"(-\s*)?([^\W\d]\w*)\s*:\s*")
+
+
+def parse_formula(text, timings=None):
+    """Parse a formula, score, or combined score_with_formula document.
+
+    ``timings``, if given, receives the seconds spent per section
+    (``header`` for lines before the first section).
+    """
+    ast = {
+        "variables": {},
+        "type": "formula"
+    }
+    section = None
+    pending = None  # (kind, entry, line, column) of an ``if:`` awaiting add / text
+
+    def close_pending():
+        nonlocal pending
+        if pending is not None:
+            kind, _, line, column = pending
+            missing = "add" if kind == "rules" else "text"
+            raise DSLSyntaxError(f"'if:' has no '{missing}:'", line, column)
+
+    if timings is not None:
+        mark, timed = time.perf_counter(), "header"
+
+    for number, raw in enumerate(text.split("\n"), start=1):
+        if timings is not None:
+            now = time.perf_counter()
+            timings[timed] = timings.get(timed, 0.0) + now - mark
+            mark, timed = now, section or "header"
+        stripped = raw.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        indent = len(raw) - len(raw.lstrip())
+        match = _KEY.match(raw, indent)
+        if match is None:
+            raise DSLSyntaxError(f"expected 'key: value', found {stripped!r}", number, indent + 1)
+        key = match.group(2)
+        value = raw[match.end():].rstrip()
+        column = match.end() + 1
+
+        if key == "formula_name":
+            ast["formula_name"] = value
+            ast["type"] = "formula"
+        elif key == "score_name":
+            ast["score_name"] = value
+            ast["type"] = "score"
+        elif key in ("variables", "formulas", "rules", "risk_levels"):
+            close_pending()
+            section = key
+            if key == "formulas":
+                ast["formulas"] = {}
+                ast["type"] = "score_with_formula"
+            elif key != "variables":
+                ast[key] = []
+        elif key == "formula" and section != "formulas":
+            ast["formula"] = parse_expression(value, number, column)
+        elif section == "variables":
+            ast["variables"][key] = value
+        elif section == "formulas":
+            ast["formulas"][key] = parse_expression(value, number, column)
+        elif section in ("rules", "risk_levels") and key == "if":
+            close_pending()
+            entry = {"condition": parse_condition_str(value, number, column)}
+            ast[section].append(entry)
+            pending = (section, entry, number, match.start(2) + 1)
+        elif section == "rules" and key == "add":
+            if pending is None:
+                raise DSLSyntaxError("'add:' must follow an 'if:'", number, indent + 1)
+            pending[1]["action"] = {"type": "add", "value": _parse_int(value, number, column)}
+            pending = None
+        elif section == "risk_levels" and key == "text":
+            if pending is None:
+                raise DSLSyntaxError("'text:' must follow an 'if:'", number, indent + 1)
+            pending[1]["text"] = value
+            pending = None
+        # Anything else (e.g. ``dummy: 0`` under rules) is ignored.
+
+    close_pending()
+    if timings is not None:
+        timings[timed] = timings.get(timed, 0.0) + time.perf_counter() - mark
+    return ast
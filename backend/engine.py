@@ -0,0 +1,997 @@
+"""Evaluation engine for score / formula ASTs.
+
+An AST is compiled once into a ``CompiledPlan``: every formula expression is
+parsed a single time into a whitelisted Python expression tree and compiled
+to a code object, and every condition dict is turned into a closure.
+Variables are bound by name when the plan is evaluated, so no string
+substitution or re-parsing happens per request.
+"""
+import ast as pyast
+import bisect
+import heapq
+import math
+import operator
+import time
+
+
+class PlanError(ValueError):
+    """Raised when an AST cannot be compiled or evaluated as a whole."""
+
+
+class UnknownASTError(PlanError):
+    """Raised when an AST has nothing to evaluate (no formula, rules or score)."""
+
+
+class FormulaDependencyError(PlanError):
+    """Raised when ``formulas`` reference each other in a cycle."""
+
+
+# ──────────────────────────────────────────────
+# Expressions
+# ──────────────────────────────────────────────
+
+# Names every formula may use besides the bound variables.
+_BASE_SCOPE = {
+    "__builtins__": {},
+    "sqrt": math.sqrt,
+    "pow": pow,
+    "abs": abs,
+    "True": True,
+    "False": False,
+    "true": True,
+    "false": False,
+}
+
+_ALLOWED_FUNCTIONS = {"sqrt", "pow", "abs"}
+
+_ALLOWED_NODES = (
+    pyast.Expression,
+    pyast.BinOp, pyast.UnaryOp, pyast.BoolOp, pyast.Compare, pyast.IfExp,
+    pyast.Call, pyast.Name, pyast.Load, pyast.Constant,
+    pyast.Add, pyast.Sub, pyast.Mult, pyast.Div, pyast.FloorDiv, pyast.Mod, pyast.Pow,
+    pyast.UAdd, pyast.USub, pyast.Not,
+    pyast.And, pyast.Or,
+    pyast.Eq, pyast.NotEq, pyast.Lt, pyast.LtE, pyast.Gt, pyast.GtE,
+)
+
+
+class CompiledExpression:
+    """A formula string parsed and compiled once, evaluated against a scope dict."""
+
+    __slots__ = ("source", "code", "names", "error")
+
+    def __init__(self, source):
+        self.source = source
+        self.code = None
+        self.names = frozenset()
+        self.error = None
+        try:
+            tree = pyast.parse(str(source).strip(), mode="eval")
+            names = set()
+            for node in pyast.walk(tree):
+                if not isinstance(node, _ALLOWED_NODES):
+                    raise SyntaxError(
+                        f"unsupported syntax '{type(node).__name__}' in expression"
+                    )
+                if isinstance(node, pyast.Call):
+                    if not (isinstance(node.func, pyast.Name)
+                            and node.func.id in _ALLOWED_FUNCTIONS) or node.keywords:
+                        raise SyntaxError("only sqrt(), pow() and abs() may be called")
+                elif isinstance(node, pyast.Name) and node.id not in _BASE_SCOPE:
+                    names.add(node.id)
+            self.names = frozenset(names)
+            self.code = compile(tree, "<formula>", "eval")
+        except SyntaxError as e:
+            self.error = e
+
+    def evaluate(self, scope):
+        if self.error is not None:
+            raise self.error
+        return eval(self.code, scope)
+
+
+def _bind_operand(scope, name, value):
+    """Bind input ``name`` into a formula scope, as if its text were written
+    into the expression: numeric strings bind as numbers, and any other
+    string stays unbound, so a formula reading it fails (and scores 0)
+    instead of computing with text."""
+    if isinstance(value, str):
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        else:
+            if name in _BASE_SCOPE:
+                scope[name] = _BASE_SCOPE[name]
+            else:
+                scope.pop(name, None)
+            return
+    scope[name] = value
+
+
+# ──────────────────────────────────────────────
+# Conditions
+# ──────────────────────────────────────────────
+
+_COMPARATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+
+# Comparisons that are false for NaN, which the threshold tables below rely
+# on; "!=" holds for NaN, so it always goes through the general evaluator.
+_THRESHOLD_OPS = frozenset(_COMPARATORS) - {"!="}
+
+
+def _never(context):
+    return False
+
+
+def compile_condition(cond):
+    """Turn a condition dict into a ``context -> bool`` closure.
+
+    Semantics match ``evaluate_condition`` exactly.
+    """
+    if not cond:
+        return _never
+
+    if "compound" in cond:
+        subs = tuple(compile_condition(sub) for sub in cond.get("conditions", []))
+        if cond["compound"] == "and":
+            return lambda context: all(sub(context) for sub in subs)
+        if cond["compound"] == "or":
+            return lambda context: any(sub(context) for sub in subs)
+        return _never
+
+    left = cond.get("left")
+    if not left or not cond.get("op"):
+        return _never
+    compare = _COMPARATORS.get(cond["op"])
+    if compare is None:
+        return _never
+    right = cond.get("right", 0)
+
+    def check(context):
+        value = context.get(left)
+        if value is None:
+            return False
+        try:
+            return compare(value, right)
+        except TypeError:
+            return False
+
+    return check
+
+
+def evaluate_condition(cond, context):
+    """Evaluate condition (simple or compound) against context values"""
+    if not cond:
+        return False
+
+    # Handle compound conditions (and/or)
+    if 'compound' in cond:
+        compound_type = cond['compound']
+        sub_conditions = cond.get('conditions', [])
+
+        if compound_type == 'and':
+            return all(evaluate_condition(sub, context) for sub in sub_conditions)
+        elif compound_type == 'or':
+            return any(evaluate_condition(sub, context) for sub in sub_conditions)
+        return False
+
+    # Simple condition
+    if not cond.get('left') or not cond.get('op'):
+        return False
+
+    left_val = context.get(cond['left'])
+    right_val = cond.get('right', 0)
+    compare = _COMPARATORS.get(cond['op'])
+
+    if left_val is None or compare is None:
+        return False
+
+    try:
+        return compare(left_val, right_val)
+    except TypeError:
+        return False
+
+
+class _ScoreContext:
+    """Read-only view of a context with ``score`` overlaid, without copying it."""
+
+    __slots__ = ("context", "score")
+
+    def __init__(self, context, score):
+        self.context = context
+        self.score = score
+
+    def get(self, key, default=None):
+        if key == 'score':
+            return self.score
+        return self.context.get(key, default)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float))
+
+
+class ThresholdIndex:
+    """Risk levels that only compare ``score`` with constants, as a sorted index.
+
+    The distinct thresholds split the number line into points and open
+    intervals; the first matching risk level is precomputed for each
+    region, so a lookup is one bisect and keeps first-match-wins semantics.
+    """
+
+    __slots__ = ("thresholds", "answers")
+
+    def __init__(self, tests):
+        """``tests`` holds one (compare, right) pair per risk level; ``None`` never matches."""
+        self.thresholds = sorted({test[1] for test in tests if test})
+        self.answers = [self._first_match(tests, value) for value in _region_probes(self.thresholds)]
+
+    @staticmethod
+    def _first_match(tests, value):
+        for index, test in enumerate(tests):
+            if test and test[0](value, test[1]):
+                return index
+        return None
+
+    @classmethod
+    def build(cls, conditions):
+        """Return an index for ``conditions``, or ``None`` if any of them is not
+        a plain comparison of ``score`` (those need the general evaluator)."""
+        tests = []
+        for cond in conditions:
+            if cond and ('compound' in cond or cond.get('left') != 'score'):
+                return None
+            if cond and cond.get('op') in _COMPARATORS and cond.get('op') not in _THRESHOLD_OPS:
+                return None
+            compare = _COMPARATORS.get(cond.get('op')) if cond else None
+            right = cond.get('right', 0) if cond else None
+            # Comparing a number with a non-number is always false.
+            tests.append((compare, right) if compare and _is_number(right) else None)
+        return cls(tests)
+
+    def lookup(self, score):
+        """Index of the first risk level matching a numeric ``score``, or ``None``."""
+        if score != score:  # NaN matches nothing
+            return None
+        return self.answers[_region(self.thresholds, score)]
+
+
+class RuleTable:
+    """Threshold rules on one variable, as a sorted breakpoint table.
+
+    ``totals`` holds the summed ``add`` values of the rules matching each
+    region between / on the thresholds, so the variable's contribution to
+    the score is one bisect however many rules test it.
+    """
+
+    __slots__ = ("name", "rules", "thresholds", "totals")
+
+    def __init__(self, name, rules):
+        """``rules`` holds one (compare, right, value) triple per rule."""
+        self.name = name
+        self.rules = rules
+        self.thresholds = sorted({right for _, right, _ in rules})
+        self.totals = [
+            sum(value for compare, right, value in rules if compare(probe, right))
+            for probe in _region_probes(self.thresholds)
+        ]
+
+    def contribution(self, context):
+        value = context.get(self.name)
+        if _is_number(value):
+            if value != value:  # NaN matches nothing
+                return 0
+            return self.totals[_region(self.thresholds, value)]
+        if value is None:
+            return 0
+        # Strings and other JSON values: same per-rule semantics as evaluate_condition.
+        total = 0
+        for compare, right, add in self.rules:
+            try:
+                if compare(value, right):
+                    total += add
+            except TypeError:
+                pass
+        return total
+
+
+def _region_probes(thresholds):
+    """One sample value per region: below / between the thresholds and on each one."""
+    probes = []
+    previous = None
+    for t in thresholds:
+        probes.append(t - 1 if previous is None else (previous + t) / 2)
+        probes.append(t)
+        previous = t
+    probes.append(previous + 1 if previous is not None else 0)
+    return probes
+
+
+def _region(thresholds, value):
+    """Region of a (non-NaN) number, indexing the list ``_region_probes`` returns."""
+    i = bisect.bisect_left(thresholds, value)
+    if i < len(thresholds) and thresholds[i] == value:
+        return 2 * i + 1
+    return 2 * i
+
+
+def _rule_value(rule):
+    action = rule.get('action', {})
+    return action.get('value', 0) if action.get('type') == 'add' else 0
+
+
+def group_rules(rules):
+    """Split score rules into per-variable ``RuleTable``s and the rest.
+
+    A rule joins its variable's table when its condition is a single
+    comparison with a numeric constant and the variable has at least two
+    such rules. Tables are only built when every ``add`` value is an
+    integer, so summing per table cannot change the score. Returns
+    ``(tables, general)`` where ``general`` lists ``(condition, value)``
+    pairs in rule order.
+    """
+    values = [_rule_value(rule) for rule in rules]
+    if not all(isinstance(value, int) for value in values):
+        return [], [(rule.get('condition', {}), value) for rule, value in zip(rules, values)]
+
+    simple = {}
+    for position, (rule, value) in enumerate(zip(rules, values)):
+        cond = rule.get('condition', {})
+        if not cond or 'compound' in cond or not cond.get('left'):
+            continue
+        compare = _COMPARATORS.get(cond.get('op')) if cond.get('op') in _THRESHOLD_OPS else None
+        right = cond.get('right', 0)
+        if compare and _is_number(right) and right == right:
+            simple.setdefault(cond['left'], []).append((position, (compare, right, value)))
+
+    tables, grouped = [], set()
+    for name, entries in simple.items():
+        if len(entries) < 2:
+            continue
+        tables.append(RuleTable(name, [entry for _, entry in entries]))
+        grouped.update(position for position, _ in entries)
+    general = [
+        (rule.get('condition', {}), value)
+        for position, (rule, value) in enumerate(zip(rules, values))
+        if position not in grouped
+    ]
+    return tables, general
+
+
+# ──────────────────────────────────────────────
+# Dependencies
+# ──────────────────────────────────────────────
+
+def condition_names(cond):
+    """Names a condition dict reads."""
+    if not cond:
+        return set()
+    if 'compound' in cond:
+        names = set()
+        for sub in cond.get('conditions', []):
+            names |= condition_names(sub)
+        return names
+    return {cond['left']} if cond.get('left') else set()
+
+
+def formula_order(dependencies):
+    """Order formulas so each one runs after the formulas it reads.
+
+    ``dependencies`` maps formula name -> names it reads, in declaration
+    order; declaration order is kept wherever the graph allows it. A formula
+    reading its own name reads the input of that name. Raises
+    ``FormulaDependencyError`` on a cycle.
+    """
+    position = {name: i for i, name in enumerate(dependencies)}
+    edges = {
+        name: {dep for dep in deps if dep in position and dep != name}
+        for name, deps in dependencies.items()
+    }
+    readers = {name: [] for name in dependencies}
+    for name, deps in edges.items():
+        for dep in deps:
+            readers[dep].append(name)
+
+    pending = {name: len(deps) for name, deps in edges.items()}
+    ready = [position[name] for name, count in pending.items() if count == 0]
+    heapq.heapify(ready)
+    names = list(dependencies)
+    order = []
+    while ready:
+        name = names[heapq.heappop(ready)]
+        order.append(name)
+        for reader in readers[name]:
+            pending[reader] -= 1
+            if pending[reader] == 0:
+                heapq.heappush(ready, position[reader])
+
+    if len(order) < len(names):
+        # Walk unresolved edges from any blocked formula until a name repeats.
+        path = [next(name for name in names if pending[name] > 0)]
+        while path.count(path[-1]) < 2:
+            path.append(next(dep for dep in sorted(edges[path[-1]], key=position.get)
+                             if pending[dep] > 0))
+        cycle = path[path.index(path[-1]):]
+        raise FormulaDependencyError("Formula cycle: " + " -> ".join(cycle))
+    return order
+
+
+# ──────────────────────────────────────────────
+# Plans
+# ──────────────────────────────────────────────
+
+def build_context(inputs):
+    """Normalise raw inputs: 'true'/'false' strings become booleans."""
+    context = {}
+    for k, v in inputs.items():
+        if isinstance(v, str) and v.lower() in ('true', 'false'):
+            context[k] = v.lower() == 'true'
+        else:
+            context[k] = v
+    return context
+
+
+class PlanState:
+    """Everything one evaluation of a ``CompiledPlan`` produced.
+
+    Kept between calls so ``CompiledPlan.update`` can recompute only the
+    formulas, rules and risk levels an input change reaches.
+    """
+
+    __slots__ = ("inputs", "context", "scope", "value", "error", "contributions", "score", "risk")
+
+    def __init__(self, inputs, context, scope):
+        self.inputs = inputs
+        self.context = context
+        self.scope = scope
+        self.value = None     # raw result of ``formula`` (formula mode)
+        self.error = None     # exception raised by ``formula``
+        self.contributions = []  # per-rule-unit score contributions (rules mode)
+        self.score = None
+        self.risk = None      # index of the matching risk level
+
+    def copy(self):
+        state = PlanState(dict(self.inputs), dict(self.context), dict(self.scope))
+        state.value = self.value
+        state.error = self.error
+        state.contributions = list(self.contributions)
+        state.score = self.score
+        state.risk = self.risk
+        return state
+
+
+def _same(a, b):
+    return type(a) is type(b) and a == b
+
+
+class CompiledPlan:
+    """Precompiled evaluation plan for one AST.
+
+    ``evaluate`` returns the same payload ``/calculate`` has always returned:
+    ``{"result", "score", "risk_level"}`` for formula ASTs and
+    ``{"score", "computed", "risk_level"}`` for rule-based scores.
+
+    Formulas run in dependency order (see ``formula_order``), and the plan
+    records which names every formula, rule and risk level reads so that
+    ``update`` can recompute only what an input change affects.
+    """
+
+    def __init__(self, ast):
+        self.formulas = [
+            (name, CompiledExpression(expr))
+            for name, expr in (ast.get('formulas') or {}).items()
+        ]
+        expressions = dict(self.formulas)
+        self.order = [
+            (name, expressions[name])
+            for name in formula_order({name: expr.names for name, expr in self.formulas})
+        ]
+        self.formula = CompiledExpression(ast['formula']) if ast.get('formula') else None
+        rules = [
+            rule for rule in ast.get('rules') or []
+            if rule and 'condition' in rule and 'action' in rule
+        ]
+        # Threshold ladders on one variable become tables; the rest stay
+        # as (condition, value) pairs. Each unit yields a score contribution.
+        self.rule_sources = [(rule['condition'], _rule_value(rule)) for rule in rules]
+        tables, general = group_rules(rules)
+        self.rules = [
+            ({table.name}, table.contribution) for table in tables
+        ] + [
+            (condition_names(cond), self._rule_contribution(compile_condition(cond), value))
+            for cond, value in general
+        ]
+        risks = [risk for risk in ast.get('risk_levels') or [] if risk and 'condition' in risk]
+        self.risk_levels = [
+            (compile_condition(risk['condition']), risk.get('text', ''))
+            for risk in risks
+        ]
+        self.risk_index = ThresholdIndex.build([risk['condition'] for risk in risks])
+
+        # Dependency graph: what each node reads.
+        self.risk_reads = set().union(*(condition_names(r['condition']) for r in risks)) | {'score'}
+
+        # Dispatch mirrors the original branch order in calculate_score.
+        if self.formula is not None and (ast.get('type') == 'formula' or not ast.get('rules')):
+            self.mode = 'formula'
+        elif ast.get('rules'):
+            self.mode = 'rules'
+        else:
+            self.mode = 'score'
+
+    @staticmethod
+    def _rule_contribution(condition, value):
+        return lambda context: value if condition(context) else 0
+
+    def _run_formula(self, name, expr, state):
+        try:
+            result = expr.evaluate(state.scope)
+        except Exception as e:
+            # If formula fails, store 0 but continue
+            result = 0
+            print(f"Formula error for {name}: {e}")
+        state.context[name] = result
+        state.scope[name] = result
+        return result
+
+    def _bind(self, inputs):
+        context = build_context(inputs)
+        scope = dict(_BASE_SCOPE)
+        for k, v in context.items():
+            _bind_operand(scope, k, v)
+        # Reserve declaration order for formula names that are not inputs.
+        for name, _ in self.formulas:
+            context.setdefault(name, None)
+        return PlanState(dict(inputs), context, scope)
+
+    def run_formulas(self, inputs):
+        """Bind inputs and evaluate ``formulas``; returns a fresh ``PlanState``."""
+        state = self._bind(inputs)
+        for name, expr in self.order:
+            self._run_formula(name, expr, state)
+        return state
+
+    def match_risk_level(self, context, score):
+        """First matching risk level wins; ``score`` shadows any context value."""
+        if not self.risk_levels:
+            return None
+        if self.risk_index is not None and _is_number(score):
+            return self.risk_index.lookup(score)
+        risk_context = _ScoreContext(context, score)
+        for index, (condition, _) in enumerate(self.risk_levels):
+            if condition(risk_context):
+                return index
+        return None
+
+    def _score(self, state, changed=None):
+        """(Re)compute result, score and risk level.
+
+        With ``changed`` (names whose values changed), only the rules and
+        risk levels reading one of those names are re-evaluated.
+        """
+        old_score = state.score
+        self._compute_score(state, changed)
+        self._match_risk(state, old_score, changed)
+
+    def _compute_score(self, state, changed=None):
+        if self.mode == 'formula':
+            if changed is None or changed & self.formula.names:
+                try:
+                    state.value, state.error = self.formula.evaluate(state.scope), None
+                    state.score = round(state.value, 2)
+                except Exception as e:
+                    state.value, state.error, state.score = None, e, None
+        elif self.mode == 'rules':
+            if changed is None:
+                state.contributions = [unit(state.context) for _, unit in self.rules]
+            else:
+                for i, (reads, unit) in enumerate(self.rules):
+                    if reads & changed:
+                        state.contributions[i] = unit(state.context)
+            score = 0
+            for contribution in state.contributions:
+                score += contribution
+            state.score = score
+        else:
+            score = state.context.get('score')
+            state.score = round(score, 2) if isinstance(score, float) else score
+
+    def _match_risk(self, state, old_score, changed=None):
+        if state.error is not None:
+            state.risk = None
+        elif changed is None or not _same(old_score, state.score) or changed & self.risk_reads:
+            state.risk = self.match_risk_level(state.context, state.score)
+
+    def compute(self, inputs, timings=None):
+        """Evaluate the plan from scratch; returns a ``PlanState``.
+
+        ``timings``, if given, receives the seconds spent in the
+        ``formulas``, ``rules`` (the score) and ``risk_levels`` stages.
+        """
+        if timings is None:
+            state = self.run_formulas(inputs)
+            self._score(state)
+            return state
+        clock = time.perf_counter
+        start = clock()
+        state = self.run_formulas(inputs)
+        formulas_done = clock()
+        self._compute_score(state)
+        score_done = clock()
+        self._match_risk(state, None)
+        timings["formulas"] = formulas_done - start
+        timings["rules"] = score_done - formulas_done
+        timings["risk_levels"] = clock() - score_done
+        return state
+
+    def update(self, state, inputs):
+        """Re-evaluate ``state`` for new ``inputs``, recomputing only affected nodes.
+
+        Returns a new ``PlanState``; ``state`` itself is left untouched.
+        """
+        changed = {
+            k for k in state.inputs.keys() | inputs.keys()
+            if k not in state.inputs or k not in inputs or not _same(state.inputs[k], inputs[k])
+        }
+        if not changed:
+            return state
+        if any(name in changed for name, _ in self.formulas):
+            # An input shadowed by a formula of the same name: start over.
+            return self.compute(inputs)
+
+        new = state.copy()
+        new.inputs = dict(inputs)
+        normalised = build_context({k: inputs[k] for k in changed if k in inputs})
+        for k in changed:
+            if k in normalised:
+                new.context[k] = normalised[k]
+                _bind_operand(new.scope, k, normalised[k])
+            else:
+                new.context.pop(k, None)
+                new.scope.pop(k, None)
+
+        for name, expr in self.order:
+            if expr.names & changed:
+                old = state.context.get(name)
+                if not _same(old, self._run_formula(name, expr, new)):
+                    changed.add(name)
+
+        self._score(new, changed)
+        return new
+
+    def render(self, state):
+        """Build the ``/calculate`` response for a ``PlanState``."""
+        risk_level = self.risk_levels[state.risk][1] if state.risk is not None else None
+
+        if self.mode == 'formula':
+            if state.error is not None:
+                raise state.error
+            return {"result": state.score, "score": state.score, "risk_level": risk_level}
+
+        if self.mode == 'rules':
+            computed_values = {
+                k: round(v, 2) if isinstance(v, float) else v
+                for k, v in state.context.items() if k not in state.inputs
+            }
+            if risk_level:
+                computed_values['RiskLevel'] = risk_level
+            return {"score": state.score, "computed": computed_values, "risk_level": risk_level}
+
+        # Last-resort fallback: if formulas produced a 'score' value, use it
+        if 'score' in state.context:
+            return {"result": state.score, "score": state.score, "risk_level": risk_level}
+
+        raise UnknownASTError("Unknown AST type")
+
+    def evaluate(self, inputs, timings=None):
+        return self.render(self.compute(inputs, timings))
+
+    def trace(self, inputs):
+        """Evaluate like ``compute`` and explain it; returns ``(state, trace)``.
+
+        The trace lists every formula with its value (or error) and time,
+        every rule with whether it matched, what it added and its time, and
+        the risk level that fired. Rules are timed one by one as written,
+        even where the plan itself evaluates them through a ``RuleTable``.
+        """
+        clock = time.perf_counter
+        start = clock()
+        formulas = []
+        state = self._bind(inputs)
+        for name, expr in self.order:
+            began = clock()
+            try:
+                value, error = expr.evaluate(state.scope), None
+            except Exception as e:
+                value, error = 0, str(e)
+            state.context[name] = value
+            state.scope[name] = value
+            formulas.append({"name": name, "value": value, "error": error, "seconds": clock() - began})
+        formulas_done = clock()
+        self._compute_score(state)
+        score_done = clock()
+        self._match_risk(state, None)
+        risk_done = clock()
+
+        rules = []
+        if self.mode == 'rules':
+            for index, (cond, value) in enumerate(self.rule_sources):
+                condition = compile_condition(cond)
+                began = clock()
+                matched = bool(condition(state.context))
+                rules.append({
+                    "index": index,
+                    "condition": cond,
+                    "matched": matched,
+                    "added": value if matched else 0,
+                    "seconds": clock() - began,
+                })
+        return state, {
+            "mode": self.mode,
+            "formulas": formulas,
+            "rules": rules,
+            "risk_level": None if state.risk is None else {
+                "index": state.risk, "text": self.risk_levels[state.risk][1],
+            },
+            "stages": {
+                "formulas": formulas_done - start,
+                "rules": score_done - formulas_done,
+                "risk_levels": risk_done - score_done,
+            },
+        }
+
+
+class FusedPlan:
+    """One evaluation plan over several ASTs evaluated against the same inputs.
+
+    Formula expressions and conditions are interned: two expressions with the
+    same syntax tree whose names resolve to the same inputs or the same
+    upstream expressions share one node, and likewise for conditions, so each
+    distinct piece is computed once per call. Each member's result has the
+    same shape ``CompiledPlan.evaluate`` returns.
+    """
+
+    def __init__(self, members):
+        """``members`` is an iterable of (key, ast) pairs; keys label the results."""
+        self.expressions = []  # (CompiledExpression, {name: binding})
+        self.conditions = []   # ('leaf', binding, compare, right) | ('and'|'or', children) | ('never',)
+        self._expression_ids = {}
+        self._condition_ids = {}
+        self.expression_refs = 0
+        self.condition_refs = 0
+        self.members = [self._add_member(key, ast) for key, ast in members]
+
+    # Interning ─────────────────────────────────
+
+    def _expression(self, source, bindings):
+        self.expression_refs += 1
+        expr = CompiledExpression(source)
+        if expr.error is not None:
+            shape = ('error', str(source))
+        else:
+            shape = pyast.dump(pyast.parse(str(source).strip(), mode="eval"))
+        names = {name: bindings.get(name, ('in', name)) for name in expr.names}
+        key = (shape, tuple(sorted(names.items())))
+        if key not in self._expression_ids:
+            self._expression_ids[key] = len(self.expressions)
+            self.expressions.append((expr, names))
+        return self._expression_ids[key]
+
+    def _condition(self, cond, bindings):
+        self.condition_refs += 1
+        if not cond:
+            key = ('never',)
+        elif 'compound' in cond:
+            children = tuple(self._condition(sub, bindings) for sub in cond.get('conditions', []))
+            key = (cond['compound'], children) if cond['compound'] in ('and', 'or') else ('never',)
+        else:
+            left = cond.get('left')
+            compare = _COMPARATORS.get(cond.get('op')) if left and cond.get('op') else None
+            right = cond.get('right', 0)
+            if compare is None:
+                key = ('never',)
+            else:
+                key = ('leaf', bindings.get(left, ('in', left)), cond['op'],
+                       (type(right).__name__, repr(right)))
+        if key not in self._condition_ids:
+            self._condition_ids[key] = len(self.conditions)
+            if key[0] == 'leaf':
+                self.conditions.append(('leaf', key[1], _COMPARATORS[key[2]], cond.get('right', 0)))
+            else:
+                self.conditions.append(key)
+        return self._condition_ids[key]
+
+    def _add_member(self, key, ast):
+        sources = ast.get('formulas') or {}
+        try:
+            order = formula_order({
+                name: CompiledExpression(source).names for name, source in sources.items()
+            })
+        except FormulaDependencyError as e:
+            return {"key": key, "mode": 'error', "error": str(e)}
+        bindings = {}
+        formulas = []
+        for name in order:
+            node = self._expression(sources[name], bindings)
+            bindings[name] = ('f', node)
+            formulas.append((name, node))
+        declared = [(name, bindings[name][1]) for name in sources]
+        formula = self._expression(ast['formula'], bindings) if ast.get('formula') else None
+        rules = [
+            (self._condition(rule.get('condition', {}), bindings),
+             rule.get('action', {}).get('value', 0)
+             if rule.get('action', {}).get('type') == 'add' else 0)
+            for rule in ast.get('rules') or []
+            if rule and 'condition' in rule and 'action' in rule
+        ]
+        risk_index = ThresholdIndex.build([
+            risk['condition'] for risk in ast.get('risk_levels') or []
+            if risk and 'condition' in risk
+        ])
+        risk_bindings = {**bindings, 'score': ('score', key)}
+        risk_levels = [
+            (self._condition(risk['condition'], risk_bindings), risk.get('text', ''))
+            for risk in ast.get('risk_levels') or []
+            if risk and 'condition' in risk
+        ]
+        if formula is not None and (ast.get('type') == 'formula' or not ast.get('rules')):
+            mode = 'formula'
+        elif ast.get('rules'):
+            mode = 'rules'
+        else:
+            mode = 'score'
+        return {"key": key, "formulas": formulas, "declared": declared, "formula": formula,
+                "rules": rules, "risk_levels": risk_levels, "risk_index": risk_index,
+                "mode": mode}
+
+    def stats(self):
+        return {
+            "expressions": self.expression_refs,
+            "distinct_expressions": len(self.expressions),
+            "conditions": self.condition_refs,
+            "distinct_conditions": len(self.conditions),
+        }
+
+    # Evaluation ────────────────────────────────
+
+    def _value(self, binding, context, values, scores):
+        kind, ref = binding
+        if kind == 'in':
+            return context.get(ref)
+        if kind == 'f':
+            return values[ref]
+        return scores.get(ref)
+
+    def _compute(self, index, context, values, errors):
+        """Evaluate expression ``index`` once; failures are recorded in ``errors``."""
+        expr, names = self.expressions[index]
+        scope = dict(_BASE_SCOPE)
+        for name, binding in names.items():
+            if binding[0] == 'f':
+                scope[name] = values[binding[1]]
+            elif name in context:
+                _bind_operand(scope, name, context[name])
+        try:
+            values[index] = expr.evaluate(scope)
+        except Exception as e:
+            values[index] = 0
+            errors[index] = e
+
+    def _check(self, index, context, values, scores, memo):
+        result = memo[index]
+        if result is not None:
+            return result
+        node = self.conditions[index]
+        if node[0] == 'leaf':
+            _, binding, compare, right = node
+            value = self._value(binding, context, values, scores)
+            if value is None:
+                result = False
+            else:
+                try:
+                    result = compare(value, right)
+                except TypeError:
+                    result = False
+        elif node[0] == 'and':
+            result = all(self._check(i, context, values, scores, memo) for i in node[1])
+        elif node[0] == 'or':
+            result = any(self._check(i, context, values, scores, memo) for i in node[1])
+        else:
+            result = False
+        memo[index] = result
+        return result
+
+    def _risk_level(self, member, context, values, scores, memo):
+        score = scores.get(member["key"])
+        if member["risk_index"] is not None and _is_number(score):
+            index = member["risk_index"].lookup(score)
+            return member["risk_levels"][index][1] if index is not None else None
+        for condition, text in member["risk_levels"]:
+            if self._check(condition, context, values, scores, memo):
+                return text
+        return None
+
+    def evaluate(self, inputs):
+        """Return a list of (key, result) pairs; a failing member gets ``{"error": ...}``."""
+        context = build_context(inputs)
+        values = [None] * len(self.expressions)
+        done = [False] * len(self.expressions)
+        errors = {}
+        memo = [None] * len(self.conditions)
+        scores = {}
+        results = []
+        for member in self.members:
+            key = member["key"]
+            if member["mode"] == 'error':
+                results.append((key, {"error": member["error"]}))
+                continue
+            for name, node in member["formulas"]:
+                if not done[node]:
+                    self._compute(node, context, values, errors)
+                    done[node] = True
+                    if node in errors:
+                        # If formula fails, store 0 but continue
+                        print(f"Formula error for {name}: {errors[node]}")
+
+            member_context = dict(context)
+            for name, node in member["declared"]:
+                member_context[name] = values[node]
+
+            if member["mode"] == 'formula':
+                node = member["formula"]
+                if not done[node]:
+                    self._compute(node, context, values, errors)
+                    done[node] = True
+                try:
+                    if node in errors:
+                        raise errors[node]
+                    score = round(values[node], 2)
+                except Exception as e:
+                    results.append((key, {"error": str(e)}))
+                    continue
+                scores[key] = score
+                results.append((key, {"result": score, "score": score,
+                                      "risk_level": self._risk_level(member, context, values, scores, memo)}))
+                continue
+
+            if member["mode"] == 'rules':
+                score = 0
+                for condition, value in member["rules"]:
+                    if self._check(condition, context, values, scores, memo):
+                        score += value
+                scores[key] = score
+                risk_level = self._risk_level(member, context, values, scores, memo)
+                computed_values = {
+                    k: round(v, 2) if isinstance(v, float) else v
+                    for k, v in member_context.items() if k not in inputs
+                }
+                if risk_level:
+                    computed_values['RiskLevel'] = risk_level
+                results.append((key, {"score": score, "computed": computed_values,
+                                      "risk_level": risk_level}))
+                continue
+
+            if 'score' not in member_context:
+                results.append((key, {"error": "Unknown AST type"}))
+                continue
+            score = member_context['score']
+            score = round(score, 2) if isinstance(score, float) else score
+            scores[key] = score
+            results.append((key, {"result": score, "score": score,
+                                  "risk_level": self._risk_level(member, context, values, scores, memo)}))
+        return results
+
+
+def compile_plan(ast):
+    """Compile an AST dict into a reusable ``CompiledPlan``."""
+    return CompiledPlan(ast)
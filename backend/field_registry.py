@@ -0,0 +1,170 @@
+"""Cached view of the patient-field registry (``patient_fields`` table).
+
+The table almost never changes but is read on every /chat call, so the
+rows, the prompt hint built from them and a name → type map are kept in
+memory. Readers holding a session check the snapshot against the shared
+``patient_fields`` version counter, so writes made by any worker are
+seen at once; /calculate, which otherwise never touches the database,
+reuses it for up to ``PATIENT_FIELD_CACHE_TTL`` seconds.
+"""
+import os
+import threading
+import time
+
+FIELD_ROW_KEYS = ("id", "field_name", "label", "field_type", "created_at")
+
+PATIENT_FIELD_CACHE_TTL = float(os.getenv("PATIENT_FIELD_CACHE_TTL", "30"))
+
+
+def build_hint(fields):
+    """The optional AVAILABLE PATIENT FIELDS hint of the /chat prompt."""
+    if not fields:
+        return ""
+    fields_list = ", ".join(
+        f"{f['field_name']} ({f['label']})" if f['label'] else f['field_name']
+        for f in fields
+    )
+    return (
+        f"\n\nAVAILABLE PATIENT FIELDS with units (optional hint): {fields_list}\n"
+        f"Use the exact field_name as the variable name in formulas. The label shows the unit."
+    )
+
+
+# ──────────────────────────────────────────────
+# Input coercion
+# ──────────────────────────────────────────────
+
+def _to_int(text):
+    try:
+        return int(text)
+    except ValueError:
+        value = float(text)
+        return int(value) if value.is_integer() else value
+
+
+def _to_bool(text):
+    lowered = text.strip().lower()
+    if lowered in ("true", "1", "yes"):
+        return True
+    if lowered in ("false", "0", "no"):
+        return False
+    raise ValueError(text)
+
+
+_COERCERS = {
+    "int": _to_int,
+    "float": float,
+    "boolean": _to_bool,
+    "bool": _to_bool,
+}
+
+
+class FieldRegistry:
+    """Immutable snapshot of the registry."""
+
+    __slots__ = ("fields", "types", "hint")
+
+    def __init__(self, fields):
+        self.fields = fields  # list of row dicts, ordered by id
+        self.types = {f["field_name"]: f["field_type"] for f in fields}
+        self.hint = build_hint(fields)
+
+    def coerce(self, inputs):
+        """Convert string inputs of registered fields to the field's type.
+
+        Only strings are touched (form posts send everything as text);
+        empty strings of typed fields count as missing, and text that does
+        not parse is left for the evaluator to handle as before.
+        """
+        if not self.types or not inputs:
+            return inputs
+        coerced = None
+        for name, value in inputs.items():
+            convert = _COERCERS.get(self.types.get(name))
+            new = _coerce_value(convert, value)
+            if new is value:
+                continue
+            if coerced is None:
+                coerced = dict(inputs)
+            coerced[name] = new
+        return coerced if coerced is not None else inputs
+
+    def coerce_columns(self, columns):
+        """``coerce`` for column-wise inputs (name -> list of values)."""
+        if not self.types or not columns:
+            return columns
+        coerced = dict(columns)
+        for name, values in columns.items():
+            convert = _COERCERS.get(self.types.get(name))
+            if convert is not None and values:
+                coerced[name] = [_coerce_value(convert, value) for value in values]
+        return coerced
+
+
+def _coerce_value(convert, value):
+    """``value`` converted by ``convert`` if it is a string; returns ``value``
+    itself when there is nothing to convert or the text does not parse."""
+    if convert is None or not isinstance(value, str):
+        return value
+    if value.strip() == "":
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        return value
+
+
+# ──────────────────────────────────────────────
+# Cache
+# ──────────────────────────────────────────────
+
+_snapshot = None  # (FieldRegistry, version or None, loaded at)
+_generation = 0
+_lock = threading.Lock()
+
+
+async def get_registry(load_fields, load_version=None):
+    """Return the cached ``FieldRegistry``.
+
+    ``load_fields()`` is a coroutine function returning ``PatientField``
+    rows. With ``load_version()`` (a coroutine function returning the
+    table's version counter) the snapshot is reloaded whenever the counter
+    moved; without it, once it is ``PATIENT_FIELD_CACHE_TTL`` seconds old.
+
+    If loading fails, the previous snapshot is served, or an empty one
+    that coerces nothing, and loading is retried after the TTL.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    now = time.monotonic()
+    try:
+        if load_version is not None:
+            version = await load_version()
+            if snapshot is not None and snapshot[1] == version:
+                return snapshot[0]
+        else:
+            version = None
+            if snapshot is not None and now - snapshot[2] < PATIENT_FIELD_CACHE_TTL:
+                return snapshot[0]
+        with _lock:
+            generation = _generation
+        rows = [{key: getattr(row, key) for key in FIELD_ROW_KEYS} for row in await load_fields()]
+    except Exception as e:
+        print(f"Could not load patient fields, inputs are not coerced: {str(e).splitlines()[0]}")
+        registry = snapshot[0] if snapshot is not None else FieldRegistry([])
+        _snapshot = (registry, None, now)
+        return registry
+    registry = FieldRegistry(rows)
+    with _lock:
+        # A write that happened while loading wins; the next reader reloads.
+        if generation == _generation:
+            _snapshot = (registry, version, now)
+    return registry
+
+
+def invalidate_patient_fields():
+    """Drop the cached registry after a patient field was created, changed or deleted."""
+    global _snapshot, _generation
+    with _lock:
+        _generation += 1
+        _snapshot = None
@@ -0,0 +1,132 @@
+"""Bulk export and import of a department's formulas.
+
+Export streams one NDJSON line per formula (AST and source text
+included), reading the table in keyset pages so memory stays flat.
+Import validates every item up front and writes them all in one
+transaction with batched statements; a single bad item rejects the
+whole import with a per-item error report.
+"""
+import json
+
+from pydantic import ValidationError
+
+import crud
+from dsl import DSLSyntaxError, parse_formula
+from engine import compile_plan
+from schemas import FormulaCreate
+
+EXPORT_PAGE_SIZE = 500
+EXPORT_FIELDS = ("id", "name", "description", "ast_data", "raw_text", "created_at", "updated_at")
+
+
+# ──────────────────────────────────────────────
+# Export
+# ──────────────────────────────────────────────
+
+def export_line(formula):
+    record = {name: getattr(formula, name) for name in EXPORT_FIELDS}
+    for name in ("created_at", "updated_at"):
+        if record[name] is not None:
+            record[name] = record[name].isoformat()
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+async def export_formulas(session_factory, department_id, page_size=EXPORT_PAGE_SIZE):
+    """Yield the department's formulas as NDJSON lines, ordered by id.
+
+    Uses its own session: the response body is produced after the
+    endpoint (and its request-scoped session) has returned.
+    """
+    after = None
+    async with session_factory() as db:
+        while True:
+            page = await crud.get_formulas(db, department_id, after=after, limit=page_size)
+            for formula in page:
+                yield export_line(formula)
+            if len(page) < page_size:
+                return
+            after = page[-1].id
+
+
+# ──────────────────────────────────────────────
+# Import
+# ──────────────────────────────────────────────
+
+def read_items(body, json_array=False):
+    """Yield ``(item_number, object, error)`` from an NDJSON body, or from a
+    JSON array with ``json_array``."""
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    if json_array:
+        try:
+            items = json.loads(text)
+        except ValueError as e:
+            yield 1, None, f"invalid JSON: {e}"
+            return
+        if not isinstance(items, list):
+            yield 1, None, "expected a JSON array of formulas"
+            return
+        yield from ((n, item, None) for n, item in enumerate(items, start=1))
+        return
+    number = 0
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, f"invalid JSON: {e}"
+
+
+def validate_item(obj):
+    """A ``FormulaCreate`` for one import item.
+
+    Items without ``ast_data`` are parsed from ``raw_text``; every AST must
+    compile. Raises ``ValueError`` with a readable message otherwise.
+    """
+    if not isinstance(obj, dict):
+        raise ValueError("expected a JSON object")
+    if obj.get("ast_data") is None and isinstance(obj.get("raw_text"), str):
+        try:
+            obj = {**obj, "ast_data": parse_formula(obj["raw_text"])}
+        except DSLSyntaxError as e:
+            raise ValueError(f"raw_text: {e}") from None
+    try:
+        item = FormulaCreate.model_validate(obj)
+    except ValidationError as e:
+        raise ValueError("; ".join(
+            f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()
+        )) from None
+    if not item.name.strip():
+        raise ValueError("name: must not be empty")
+    try:
+        compile_plan(item.ast_data)
+    except Exception as e:  # PlanError, or a malformed AST the compiler trips over
+        raise ValueError(f"ast_data: {e}") from None
+    return item
+
+
+def validate_items(body, json_array=False):
+    """Validate a whole import body; returns ``(items, errors)``.
+
+    ``items`` are ``(item_number, FormulaCreate)`` pairs; ``errors`` lists
+    ``{"item", "name", "error"}`` entries, including names repeated within
+    the import.
+    """
+    items, errors, seen = [], [], {}
+    for number, obj, error in read_items(body, json_array):
+        name = obj.get("name") if isinstance(obj, dict) else None
+        if error is None:
+            try:
+                item = validate_item(obj)
+            except ValueError as e:
+                error = str(e)
+            else:
+                if item.name in seen:
+                    error = f"duplicate name (also item {seen[item.name]})"
+                else:
+                    seen[item.name] = number
+                    items.append((number, item))
+        if error is not None:
+            errors.append({"item": number, "name": name, "error": error})
+    return items, errors
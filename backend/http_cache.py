@@ -0,0 +1,49 @@
+"""ETags and conditional GETs for the department, formula and patient-field
+endpoints.
+
+A response's ETag is a hash of the request URL and the change counters
+(``crud.get_versions``) of the tables it reads, so it changes whenever
+any of those tables is written and a matching ``If-None-Match`` can be
+answered with ``304 Not Modified`` before the listing is queried or
+serialized.
+"""
+import hashlib
+import os
+
+from fastapi import Response
+
+import crud
+
+# Clients may keep responses but must revalidate them before each use.
+CACHE_CONTROL = os.getenv("HTTP_CACHE_CONTROL", "private, no-cache")
+
+
+def make_etag(url, versions):
+    """Strong ETag of ``url`` at the given table ``versions``."""
+    blob = f"{url}\0{','.join(str(v) for v in versions)}"
+    return '"' + hashlib.sha256(blob.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an ``If-None-Match`` header value matches ``etag`` (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+
+async def conditional_get(request, response, db, tables):
+    """Tag ``response`` for the current state of ``tables``.
+
+    Returns a ``304 Not Modified`` response to send instead when the
+    client already holds this state, else ``None``.
+    """
+    url = f"{request.url.path}?{request.url.query}"
+    etag = make_etag(url, await crud.get_versions(db, tables))
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
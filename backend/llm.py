@@ -0,0 +1,305 @@
+"""Access to the Gemini client.
+
+``LLMProvider`` configures the client once and keeps model handles for
+the configured model and its fallback; every request shares it through
+``get_provider()``.
+
+``generate_content`` blocks for seconds; called directly from an
+``async def`` endpoint it freezes every other request on the worker.
+Calls are therefore run on a dedicated, bounded thread pool and awaited
+with a timeout, and are abandoned as soon as the client disconnects.
+Identical calls in flight at the same time share one upstream request.
+"""
+import asyncio
+import functools
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from metrics import LLM_ERRORS, LLM_LATENCY, LLM_TOKENS
+
+load_dotenv()
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+GEMINI_FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL", "gemini-pro")
+
+LLM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "8"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
+_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="llm")
+
+
+class LLMTimeoutError(Exception):
+    """The model did not answer within ``LLM_TIMEOUT`` seconds."""
+
+
+class LLMCancelledError(Exception):
+    """The client went away before the model answered."""
+
+
+class LLMNotConfiguredError(RuntimeError):
+    """No ``GEMINI_API_KEY`` is set."""
+
+
+def request_options(timeout=None):
+    """``request_options`` for ``generate_content`` so the HTTP call itself is
+    bounded too (a running thread cannot be interrupted from outside)."""
+    return {"timeout": LLM_TIMEOUT if timeout is None else timeout}
+
+
+# ──────────────────────────────────────────────
+# Provider
+# ──────────────────────────────────────────────
+
+class LLMProvider:
+    """The configured Gemini client plus prebuilt model handles.
+
+    ``genai.configure`` resets the library's cached transport, so it is
+    called once here instead of per request; the handles below then share
+    one client and its open connections.
+    """
+
+    def __init__(self, api_key, model_name=GEMINI_MODEL, fallback_model_name=GEMINI_FALLBACK_MODEL):
+        import google.generativeai as genai
+        from google.api_core import exceptions
+
+        genai.configure(api_key=api_key)
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name)
+        self.fallback_model_name = fallback_model_name
+        self.fallback = (
+            genai.GenerativeModel(fallback_model_name)
+            if fallback_model_name and fallback_model_name != model_name else None
+        )
+        self._not_found = exceptions.NotFound
+
+    def generate(self, prompt, stream=False, timeout=None):
+        """``generate_content`` on the configured model; a model the API does not
+        know is replaced by the fallback for this and every later call."""
+        start = time.perf_counter()
+        model = self.model
+        try:
+            try:
+                response = model.generate_content(prompt, stream=stream, request_options=request_options(timeout))
+            except self._not_found:
+                if self.fallback is None or model is self.fallback:
+                    raise
+                print(f"Model {self.model_name} not found, falling back to {self.fallback_model_name}")
+                self.model = model = self.fallback
+                response = model.generate_content(prompt, stream=stream, request_options=request_options(timeout))
+        except Exception as e:
+            LLM_ERRORS.inc(type(e).__name__)
+            raise
+        name = self.fallback_model_name if model is self.fallback else self.model_name
+        if stream:
+            return self._record_stream(response, name, start)
+        LLM_LATENCY.observe(time.perf_counter() - start, name, "generate")
+        _record_tokens(name, response)
+        return response
+
+    @staticmethod
+    def _record_stream(response, model_name, start):
+        last = None
+        try:
+            for chunk in response:
+                last = chunk
+                yield chunk
+        except Exception as e:
+            LLM_ERRORS.inc(type(e).__name__)
+            raise
+        LLM_LATENCY.observe(time.perf_counter() - start, model_name, "stream")
+        if last is not None:
+            # The final chunk carries the usage totals of the whole stream.
+            _record_tokens(model_name, last)
+
+
+def _record_tokens(model_name, response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, field in (("prompt", "prompt_token_count"), ("completion", "candidates_token_count")):
+        count = getattr(usage, field, 0) or 0
+        if count:
+            LLM_TOKENS.inc(model_name, kind, amount=count)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider():
+    """The process-wide ``LLMProvider``, created on first use."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                if not GEMINI_API_KEY:
+                    raise LLMNotConfiguredError("GEMINI_API_KEY not configured")
+                _provider = LLMProvider(GEMINI_API_KEY)
+    return _provider
+
+
+def check_configured():
+    """Warn at startup when no API key is set.
+
+    The provider itself (and the Gemini SDK, a slow import) is only
+    created by the first call that needs it.
+    """
+    if _provider is None and not GEMINI_API_KEY:
+        print("WARNING: GEMINI_API_KEY not found in environment variables.")
+
+
+# ──────────────────────────────────────────────
+# Running calls off the event loop
+# ──────────────────────────────────────────────
+
+async def _until_disconnected(request, interval=0.25):
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+
+
+async def _call(fn, args, kwargs, timeout):
+    loop = asyncio.get_running_loop()
+    call = loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+    try:
+        # On timeout wait_for cancels ``call``, dropping it if still queued.
+        return await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        LLM_ERRORS.inc("LLMTimeoutError")
+        raise LLMTimeoutError(f"model did not answer within {timeout:g}s") from None
+
+
+class SingleFlight:
+    """Coalesces identical in-flight LLM calls.
+
+    Concurrent callers with the same key share one upstream call and all
+    receive its result or error. The shared call is cancelled only when
+    every caller waiting on it has gone away.
+    """
+
+    def __init__(self):
+        self._flights = {}  # key -> [task, waiters]
+        self.calls = 0      # upstream calls started
+        self.coalesced = 0  # callers served by a call already in flight
+
+    async def run(self, key, start, request=None):
+        flight = self._flights.get(key) if key is not None else None
+        if flight is None or flight[0].cancelled():
+            flight = [asyncio.ensure_future(start()), 0]
+            self.calls += 1
+            if key is not None:
+                self._flights[key] = flight
+                flight[0].add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            self.coalesced += 1
+        task = flight[0]
+        flight[1] += 1
+        watcher = asyncio.ensure_future(_until_disconnected(request)) if request is not None else None
+        try:
+            done, _ = await asyncio.wait(
+                [task] if watcher is None else [task, watcher],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if task in done:
+                return task.result()
+            raise LLMCancelledError("client disconnected")
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                task.cancel()
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self):
+        return {
+            "upstream_calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+        }
+
+
+single_flight = SingleFlight()
+
+
+def prompt_key(model_name, prompt):
+    """Single-flight key of a call: the hash of the final prompt and its model."""
+    return hashlib.sha256(f"{model_name}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+async def run_llm(fn, *args, request=None, timeout=None, key=None, **kwargs):
+    """Run the blocking ``fn(*args, **kwargs)`` on the LLM pool and await it.
+
+    Raises ``LLMTimeoutError`` after ``timeout`` (default ``LLM_TIMEOUT``)
+    seconds and ``LLMCancelledError`` once ``request`` (a Starlette request)
+    is disconnected. A call still queued for a worker is dropped; one
+    already running ends at its own HTTP timeout. Calls given the same
+    ``key`` (see ``prompt_key``) while one is in flight share its result.
+    """
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    return await single_flight.run(key, lambda: _call(fn, args, kwargs, timeout), request)
+
+
+_END = object()
+
+
+async def stream_llm(start, timeout=None):
+    """Iterate the blocking iterable returned by ``start()`` on the LLM pool.
+
+    Items are handed to the event loop as they arrive. Raises
+    ``LLMTimeoutError`` when no item arrives for ``timeout`` seconds.
+    Closing the generator (e.g. when a streaming client disconnects)
+    stops the worker before its next item.
+    """
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def put(item, error=None):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+        except RuntimeError:
+            pass  # event loop already closed
+
+    def produce():
+        try:
+            for item in start():
+                if stop.is_set():
+                    return
+                put(item)
+        except Exception as e:
+            put(_END, e)
+        else:
+            put(_END)
+
+    worker = loop.run_in_executor(_executor, produce)
+    try:
+        while True:
+            try:
+                item, error = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                LLM_ERRORS.inc("LLMTimeoutError")
+                raise LLMTimeoutError(f"model did not answer within {timeout:g}s") from None
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        if not worker.done():
+            worker.cancel()
+
+
+def shutdown():
+    """Stop accepting LLM calls and drop queued ones (at application shutdown)."""
+    _executor.shutdown(wait=False, cancel_futures=True)
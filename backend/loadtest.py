@@ -0,0 +1,429 @@
+"""Offline load test of the API.
+
+Boots ``app`` in-process against a throwaway SQLite database and a fake
+LLM provider (configurable latency, error rate and canned replies, no
+network), seeds a department with formulas, then drives a weighted mix
+of requests from ``--concurrency`` concurrent clients over the ASGI
+transport. Reports throughput and latency percentiles per endpoint.
+
+Workloads: ``calculate`` (scoring-heavy), ``crud`` (department / formula
+reads and writes), ``chat`` (/chat, /chat/stream and AI /parse) and
+``mixed``.
+
+Usage:
+    python loadtest.py --workload mixed --concurrency 32 --duration 20
+    python loadtest.py --workload chat --llm-latency 0.8 --llm-error-rate 0.05
+    python loadtest.py --workload calculate --requests 5000 --json report.json
+
+Client and server share one event loop, so the numbers are best compared
+between runs of this harness rather than read as production capacity.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from bench import HEART, HEART_INPUTS, SOFA, SOFA_INPUTS
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_DURATION = 10.0
+SEED = 20240501
+PERCENTILES = (50, 90, 95, 99)
+
+
+# ──────────────────────────────────────────────
+# Fake LLM provider
+# ──────────────────────────────────────────────
+
+CHAT_REPLIES = (
+    "這是 HEART 評分，用於評估胸痛病人的主要心血管事件風險。\n"
+    f"FORMULA_START\n{HEART}FORMULA_END\n可以直接載入到編輯器使用。",
+    f"以下是 SOFA 評分：\nFORMULA_START\n{SOFA}FORMULA_END",
+    "SOFA 評分用於評估加護病房病人的器官衰竭程度，分數越高死亡率越高。",
+)
+
+PARSE_REPLY = json.dumps({
+    "score_name": "Parsed_Score",
+    "variables": [{"name": "age", "type": "int"}, {"name": "hr", "type": "int"}],
+    "rules": [
+        {"condition": {"op": ">=", "left": "age", "right": 65}, "action": {"type": "add", "value": 1}},
+        {"condition": {"op": ">", "left": "hr", "right": 100}, "action": {"type": "add", "value": 1}},
+    ],
+    "risk_levels": [{"condition": {"op": ">=", "left": "score", "right": 2}, "text": "High"}],
+})
+
+
+class FakeLLMError(RuntimeError):
+    """Injected upstream failure."""
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, completion_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = completion_tokens
+
+
+class _Response:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class FakeLLMProvider:
+    """Stands in for ``llm.LLMProvider``: same ``generate`` signature, no network.
+
+    Each call sleeps ``latency`` ± ``jitter`` seconds (on the LLM thread
+    pool, like a blocking SDK call) and fails with ``FakeLLMError`` with
+    probability ``error_rate``. Chat prompts get the next of ``replies``
+    in turn; other prompts (the AI parser's) get ``parse_reply``. Draws
+    come from one seeded generator, so a run with the same call order
+    sees the same latencies and failures.
+    """
+
+    model_name = "fake-llm"
+
+    def __init__(self, latency=0.2, jitter=0.05, error_rate=0.0, replies=CHAT_REPLIES,
+                 parse_reply=PARSE_REPLY, stream_chunks=8, seed=SEED):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.replies = tuple(replies)
+        self.parse_reply = parse_reply
+        self.stream_chunks = max(1, stream_chunks)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def _draw(self):
+        with self._lock:
+            self._calls += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            fail = self._rng.random() < self.error_rate
+            return self._calls, delay, fail
+
+    def _reply(self, prompt, call):
+        if "FORMULA_START" in prompt:
+            return self.replies[call % len(self.replies)]
+        return self.parse_reply
+
+    def generate(self, prompt, stream=False, timeout=None):
+        call, delay, fail = self._draw()
+        text = self._reply(prompt, call)
+        usage = _Usage(len(prompt) // 4, len(text) // 4)
+        if not stream:
+            time.sleep(delay)
+            if fail:
+                raise FakeLLMError("injected upstream error")
+            return _Response(text, usage)
+        return self._stream(text, usage, delay, fail)
+
+    def _stream(self, text, usage, delay, fail):
+        size = -(-len(text) // self.stream_chunks)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        for n, piece in enumerate(pieces):
+            time.sleep(delay / len(pieces))
+            if fail and n == len(pieces) // 2:
+                raise FakeLLMError("injected upstream error mid-stream")
+            yield _Response(piece, usage if n == len(pieces) - 1 else None)
+
+
+# ──────────────────────────────────────────────
+# Workloads
+# ──────────────────────────────────────────────
+
+class Fixture:
+    """Ids created during setup and by the workload itself."""
+
+    def __init__(self, department_id, formulas, asts):
+        self.department_id = department_id
+        self.formulas = list(formulas)   # (id, "sofa" | "heart")
+        self.created = []          # formulas the workload created (and may delete)
+        self.asts = asts
+        self.counter = 0
+
+
+def _pick_inputs(rng, ast_name):
+    inputs = dict(SOFA_INPUTS if ast_name == "sofa" else HEART_INPUTS)
+    key = rng.choice(list(inputs))
+    inputs[key] = inputs[key] + rng.randint(-2, 2)
+    return inputs
+
+
+async def op_calculate(client, rng, fx):
+    name = rng.choice(("sofa", "heart"))
+    body = {"ast": fx.asts[name], "inputs": _pick_inputs(rng, name)}
+    return "POST /calculate", await client.post("/calculate", json=body)
+
+
+async def op_formula_calculate(client, rng, fx):
+    formula_id, name = rng.choice(fx.formulas)
+    body = {"inputs": _pick_inputs(rng, name)}
+    return "POST /formulas/{id}/calculate", await client.post(f"/formulas/{formula_id}/calculate", json=body)
+
+
+async def op_department_calculate(client, rng, fx):
+    body = {"inputs": {**SOFA_INPUTS, **HEART_INPUTS}}
+    return ("POST /departments/{id}/calculate",
+            await client.post(f"/departments/{fx.department_id}/calculate", json=body))
+
+
+async def op_list_departments(client, rng, fx):
+    return "GET /departments", await client.get("/departments")
+
+
+async def op_get_department(client, rng, fx):
+    return "GET /departments/{id}", await client.get(f"/departments/{fx.department_id}")
+
+
+async def op_list_formulas(client, rng, fx):
+    params = {"department_id": fx.department_id, "limit": 50}
+    return "GET /formulas", await client.get("/formulas", params=params)
+
+
+async def op_get_formula(client, rng, fx):
+    formula_id, _ = rng.choice(fx.formulas)
+    return "GET /formulas/{id}", await client.get(f"/formulas/{formula_id}")
+
+
+async def op_create_formula(client, rng, fx):
+    fx.counter += 1
+    name = rng.choice(("sofa", "heart"))
+    body = {"name": f"load-{fx.counter}", "ast_data": fx.asts[name]}
+    response = await client.post(f"/departments/{fx.department_id}/formulas", json=body)
+    if response.status_code == 201:
+        fx.created.append(response.json()["id"])
+    return "POST /departments/{id}/formulas", response
+
+
+async def op_update_formula(client, rng, fx):
+    if not fx.created:
+        return await op_create_formula(client, rng, fx)
+    formula_id = rng.choice(fx.created)
+    body = {"description": f"updated {rng.random():.6f}"}
+    return "PUT /formulas/{id}", await client.put(f"/formulas/{formula_id}", json=body)
+
+
+async def op_delete_formula(client, rng, fx):
+    if not fx.created:
+        return await op_create_formula(client, rng, fx)
+    formula_id = fx.created.pop(rng.randrange(len(fx.created)))
+    return "DELETE /formulas/{id}", await client.delete(f"/formulas/{formula_id}")
+
+
+async def op_chat(client, rng, fx):
+    message = rng.choice(("請幫我產生 HEART 評分", "請給我 SOFA 評分公式", "SOFA 是什麼？"))
+    return "POST /chat", await client.post("/chat", json={"message": message})
+
+
+async def op_chat_stream(client, rng, fx):
+    message = rng.choice(("請幫我產生 HEART 評分", "請給我 SOFA 評分公式", "SOFA 是什麼？"))
+    response = await client.post("/chat/stream", json={"message": message})
+    return "POST /chat/stream", response
+
+
+async def op_parse_ai(client, rng, fx):
+    # A handful of distinct texts, so part of the parses hit the AI parse cache.
+    text = f"Add one point when age is at least 65 (variant {rng.randint(1, 20)})."
+    return "POST /parse (ai)", await client.post("/parse", json={"text": text})
+
+
+async def op_parse_dsl(client, rng, fx):
+    return "POST /parse (dsl)", await client.post("/parse", json={"text": rng.choice((SOFA, HEART))})
+
+
+WORKLOADS = {
+    "calculate": {
+        op_calculate: 50, op_formula_calculate: 30, op_department_calculate: 15, op_parse_dsl: 5,
+    },
+    "crud": {
+        op_list_departments: 15, op_get_department: 15, op_list_formulas: 20, op_get_formula: 20,
+        op_create_formula: 15, op_update_formula: 10, op_delete_formula: 5,
+    },
+    "chat": {
+        op_chat: 45, op_chat_stream: 35, op_parse_ai: 20,
+    },
+    "mixed": {
+        op_calculate: 25, op_formula_calculate: 15, op_department_calculate: 5, op_parse_dsl: 5,
+        op_list_departments: 5, op_get_department: 5, op_list_formulas: 5, op_get_formula: 10,
+        op_create_formula: 5, op_update_formula: 3, op_delete_formula: 2,
+        op_chat: 7, op_chat_stream: 5, op_parse_ai: 3,
+    },
+}
+
+
+def _failed(endpoint, response):
+    if response.status_code >= 400:
+        return True
+    # /chat/stream reports upstream failures in-band, with status 200.
+    return endpoint == "POST /chat/stream" and "event: error" in response.text
+
+
+# ──────────────────────────────────────────────
+# Running
+# ──────────────────────────────────────────────
+
+async def setup(client, formulas=20):
+    """Create the department and formulas the workloads use."""
+    response = await client.post("/departments", json={"name": f"loadtest-{time.time_ns()}"})
+    response.raise_for_status()
+    department_id = response.json()["id"]
+    asts = {}
+    for name, text in (("sofa", SOFA), ("heart", HEART)):
+        response = await client.post("/parse", json={"text": text})
+        response.raise_for_status()
+        asts[name] = response.json()
+    created = []
+    for n in range(formulas):
+        name = "sofa" if n % 2 else "heart"
+        body = {"name": f"{name}-{n}", "ast_data": asts[name]}
+        response = await client.post(f"/departments/{department_id}/formulas", json=body)
+        response.raise_for_status()
+        created.append((response.json()["id"], name))
+    return Fixture(department_id, created, asts)
+
+
+async def drive(client, fx, workload, concurrency, duration=None, requests=None, seed=SEED):
+    """Run ``workload`` from ``concurrency`` clients until ``duration``
+    seconds pass or ``requests`` requests were sent; returns
+    ``({endpoint: [seconds, ...]}, {endpoint: failures}, elapsed)``."""
+    ops, weights = zip(*WORKLOADS[workload].items())
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+    remaining = [requests]
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+
+    def more():
+        if deadline is not None and time.perf_counter() >= deadline:
+            return False
+        if remaining[0] is not None:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+        return True
+
+    async def worker(n):
+        rng = random.Random(seed + n)
+        while more():
+            op = rng.choices(ops, weights)[0]
+            began = time.perf_counter()
+            try:
+                endpoint, response = await op(client, rng, fx)
+                failed = _failed(endpoint, response)
+            except Exception as e:
+                endpoint, failed = op.__name__, True
+                print(f"{op.__name__} raised {type(e).__name__}: {e}")
+            latencies[endpoint].append(time.perf_counter() - began)
+            if failed:
+                failures[endpoint] += 1
+
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    return latencies, failures, time.perf_counter() - start
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, failures, elapsed):
+    """Per-endpoint and total count, failures, throughput and percentiles (ms)."""
+    def row(values, failed):
+        values = sorted(values)
+        return {
+            "requests": len(values),
+            "failures": failed,
+            "rps": len(values) / elapsed if elapsed else 0.0,
+            **{f"p{p}_ms": percentile(values, p) * 1000 for p in PERCENTILES},
+            "max_ms": (values[-1] if values else 0.0) * 1000,
+        }
+
+    endpoints = {name: row(values, failures.get(name, 0)) for name, values in sorted(latencies.items())}
+    every = [v for values in latencies.values() for v in values]
+    return {
+        "elapsed_s": elapsed,
+        "endpoints": endpoints,
+        "total": row(every, sum(failures.values())),
+    }
+
+
+def print_report(report, out=sys.stdout):
+    columns = ["requests", "failures", "rps"] + [f"p{p}_ms" for p in PERCENTILES] + ["max_ms"]
+    out.write(f"\n{'endpoint':<36}" + "".join(f"{c:>10}" for c in columns) + "\n")
+    rows = list(report["endpoints"].items()) + [("TOTAL", report["total"])]
+    for name, stats in rows:
+        cells = [f"{stats['requests']:>10}", f"{stats['failures']:>10}"]
+        cells += [f"{stats[c]:>10.1f}" for c in columns[2:]]
+        out.write(f"{name:<36}" + "".join(cells) + "\n")
+    out.write(f"\n{report['total']['requests']} requests in {report['elapsed_s']:.1f}s\n")
+
+
+async def run(args):
+    import httpx
+
+    import llm
+    from app import app
+    from migrate import migrate
+
+    llm._provider = FakeLLMProvider(
+        latency=args.llm_latency, jitter=args.llm_jitter, error_rate=args.llm_error_rate,
+        replies=args.replies or CHAT_REPLIES, stream_chunks=args.stream_chunks, seed=args.seed,
+    )
+    await migrate()
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+            fx = await setup(client, args.formulas)
+            latencies, failures, elapsed = await drive(
+                client, fx, args.workload, args.concurrency,
+                duration=None if args.requests else args.duration,
+                requests=args.requests, seed=args.seed,
+            )
+    return summarize(latencies, failures, elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test with SQLite and a fake LLM.")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds to run")
+    parser.add_argument("--requests", type=int, help="stop after this many requests instead")
+    parser.add_argument("--formulas", type=int, default=20, help="formulas seeded into the test department")
+    parser.add_argument("--database-url", help="default: a fresh SQLite file in a temp directory")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake LLM call")
+    parser.add_argument("--llm-jitter", type=float, default=0.05)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of LLM calls that fail")
+    parser.add_argument("--stream-chunks", type=int, default=8, help="chunks per streamed reply")
+    parser.add_argument("--replies", help="JSON file with a list of canned chat replies")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    if args.replies:
+        with open(args.replies, encoding="utf-8") as f:
+            args.replies = json.load(f)
+    # Before the app (and database.py) is imported; .env values do not override these.
+    os.environ["DATABASE_URL"] = args.database_url or (
+        "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="blocky-loadtest-"), "loadtest.db")
+    )
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,329 @@
+"""In-process metrics, exposed on ``/metrics`` in the Prometheus text format.
+
+Counters, gauges and histograms are plain dicts keyed by label values
+behind one lock each, so recording a sample costs a dict lookup (and a
+bisect for histograms). Values owned by other modules (pool occupancy,
+cache counters) are read only when ``/metrics`` is scraped, through the
+collectors at the bottom of this file.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; the fine end is for in-process work, the coarse end for Gemini.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+            for labels, value in values
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # per-bucket counts (last one is +Inf), then sum
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def time(self, *labels):
+        """Context manager observing the seconds spent in its body."""
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = self.header()
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+_registry = []
+_collectors = []
+
+
+def register_collector(collect):
+    """Add ``collect()``, called on every scrape; it returns
+    ``(name, kind, documentation, [(labels_dict, value), ...])`` tuples."""
+    _collectors.append(collect)
+    return collect
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            families = collect()
+        except Exception as e:  # a broken collector must not break the scrape
+            print(f"Metrics collector {collect.__name__} failed: {e}")
+            continue
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ──────────────────────────────────────────────
+# Metrics of the application
+# ──────────────────────────────────────────────
+
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to answer a request, streamed bodies included.",
+    ("method", "route", "status"),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests being answered.", ("method", "route"),
+)
+CALCULATE_STAGE = Histogram(
+    "calculate_stage_seconds", "Time per evaluation stage of /calculate and stored-formula calculations.",
+    ("stage",), buckets=FAST_BUCKETS,
+)
+PARSE_LATENCY = Histogram(
+    "parse_duration_seconds", "Time to turn a /parse document into an AST.", ("parser",),
+)
+LLM_LATENCY = Histogram(
+    "llm_request_duration_seconds", "Duration of Gemini calls (whole stream for streamed calls).",
+    ("model", "mode"),
+)
+LLM_ERRORS = Counter(
+    "llm_errors_total", "Failed Gemini calls by error type.", ("error",),
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Gemini tokens reported by usage metadata.", ("model", "kind"),
+)
+DB_POOL_CHECKOUT = Histogram(
+    "db_pool_checkout_seconds", "Time to get a connection from the pool (waiting and connecting).",
+    buckets=FAST_BUCKETS + (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+
+# ──────────────────────────────────────────────
+# Per-route timing
+# ──────────────────────────────────────────────
+
+class MetricsRoute(APIRoute):
+    """``APIRoute`` recording ``HTTP_LATENCY`` and ``HTTP_IN_FLIGHT`` under the
+    route template (``/formulas/{formula_id}``), so ids never become labels.
+
+    Set as ``app.router.route_class`` before any route is declared.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def timed_handler(request):
+            method = request.method
+            start = time.perf_counter()
+            HTTP_IN_FLIGHT.inc(method, route)
+
+            def finish(status):
+                HTTP_IN_FLIGHT.dec(method, route)
+                HTTP_LATENCY.observe(time.perf_counter() - start, method, route, status)
+
+            try:
+                response = await handler(request)
+            except HTTPException as e:
+                finish(str(e.status_code))
+                raise
+            except RequestValidationError:
+                finish("422")
+                raise
+            except Exception:
+                finish("500")
+                raise
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = _finish_after(
+                    response.body_iterator, finish, str(response.status_code)
+                )
+            else:
+                finish(str(response.status_code))
+            return response
+
+        return timed_handler
+
+
+async def _finish_after(body, finish, status):
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        finish(status)
+
+
+# ──────────────────────────────────────────────
+# Collectors
+# ──────────────────────────────────────────────
+
+@register_collector
+def _pool_metrics():
+    from database import engine
+
+    pool = engine.sync_engine.pool
+    samples = []
+    for name in ("size", "checkedout", "checkedin", "overflow"):
+        method = getattr(pool, name, None)
+        if method is not None:
+            # QueuePool counts overflow from -size up; only positive values are extra connections.
+            value = max(method(), 0) if name == "overflow" else method()
+            samples.append(({"state": name}, value))
+    return [("db_pool_connections", "gauge", "Connection pool occupancy.", samples)]
+
+
+@register_collector
+def _cache_metrics():
+    from batch import batch_plan_cache
+    from parse_cache import memory_cache, stats_counters
+    from plan_cache import department_plan_cache, formula_plan_cache, plan_cache, state_cache
+
+    caches = {
+        "ast_plans": plan_cache,
+        "formula_plans": formula_plan_cache,
+        "department_plans": department_plan_cache,
+        "states": state_cache,
+        "batch_plans": batch_plan_cache,
+        "parse_memory": memory_cache,
+    }
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    families = [
+        (f"cache_{key}_total" if kind == "counter" else f"cache_{key}", kind, documentation,
+         [({"cache": name}, s[key]) for name, s in stats.items()])
+        for key, kind, documentation in (
+            ("hits", "counter", "Cache lookups served from the cache."),
+            ("misses", "counter", "Cache lookups that missed."),
+            ("evictions", "counter", "Entries evicted to stay within bounds."),
+            ("entries", "gauge", "Entries held."),
+            ("bytes", "gauge", "Approximate bytes held."),
+            ("hit_ratio", "gauge", "hits / (hits + misses) since start."),
+        )
+    ]
+    counters = stats_counters()
+    families.append((
+        "parse_cache_lookups_total", "counter", "AI parse cache lookups by outcome.",
+        [({"result": name}, value) for name, value in counters.items()],
+    ))
+    return families
+
+
+@register_collector
+def _llm_metrics():
+    from llm import single_flight
+
+    stats = single_flight.stats()
+    return [
+        ("llm_upstream_calls_total", "counter", "Gemini calls started.", [({}, stats["upstream_calls"])]),
+        ("llm_coalesced_calls_total", "counter", "Calls served by an identical call in flight.", [({}, stats["coalesced"])]),
+        ("llm_calls_in_flight", "gauge", "Distinct Gemini calls in flight.", [({}, stats["in_flight"])]),
+    ]
+
+
+@register_collector
+def _startup_metrics():
+    from startup import phases
+
+    return [(
+        "startup_phase_seconds", "gauge", "Time spent in each startup phase of this worker.",
+        [({"phase": name}, seconds) for name, seconds in phases.items()],
+    )]
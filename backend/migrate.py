@@ -0,0 +1,80 @@
+"""Database bootstrap: create the database, tables and indexes, seed defaults.
+
+Every step is idempotent, so this is safe to run on each deploy (before
+the workers start) or by hand after pulling a model change. Workers do
+not run it unless ``AUTO_MIGRATE`` is set.
+
+Usage:
+    python migrate.py             # create + seed
+    python migrate.py --no-seed   # schema only
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import crud
+from database import SessionLocal, engine, ensure_database_exists, init_db
+from schemas import PatientFieldCreate
+
+# From the PatientPanel sample data
+DEFAULT_PATIENT_FIELDS = [
+    PatientFieldCreate(field_name="age",         label="年齡 (歲)",      field_type="int"),
+    PatientFieldCreate(field_name="height",      label="身高 (公尺)",    field_type="float"),
+    PatientFieldCreate(field_name="weight",      label="體重 (公斤)",    field_type="float"),
+    PatientFieldCreate(field_name="cholesterol", label="膽固醇 (mg/dL)", field_type="float"),
+    PatientFieldCreate(field_name="has_disease", label="是否患有常見疾病", field_type="boolean"),
+]
+
+
+async def seed_default_patient_fields():
+    """Insert the default patient fields if there are none; returns how many."""
+    created = 0
+    async with SessionLocal() as db:
+        if await crud.get_patient_fields(db):
+            return 0  # already seeded
+        for f in DEFAULT_PATIENT_FIELDS:
+            try:
+                await crud.create_patient_field(db, f)
+                created += 1
+            except Exception:
+                await db.rollback()  # skip duplicate
+    return created
+
+
+async def migrate(seed=True):
+    """Create the schema (and seed); returns ``{step: seconds}``."""
+    timings = {}
+    started = time.perf_counter()
+    await init_db()
+    timings["schema"] = time.perf_counter() - started
+    if seed:
+        started = time.perf_counter()
+        created = await seed_default_patient_fields()
+        timings["seed"] = time.perf_counter() - started
+        if created:
+            print(f"Seeded {created} default patient fields.")
+    return timings
+
+
+async def _run(seed):
+    try:
+        return await migrate(seed)
+    finally:
+        await engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create the database schema and seed defaults.")
+    parser.add_argument("--no-seed", action="store_true", help="skip the default patient fields")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    ensure_database_exists()
+    timings = {"database": time.perf_counter() - started, **asyncio.run(_run(not args.no_seed))}
+    print("Migrated: " + ", ".join(f"{step} {seconds * 1000:.0f} ms" for step, seconds in timings.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,26 @@
 from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON, Boolean
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, JSON, Boolean
 from sqlalchemy.orm import relationship
 from database import Base
 
 
+def utcnow():
+    """Current UTC time without tzinfo, as the ``DateTime`` columns store it
+    (asyncpg rejects aware values for ``timestamp without time zone``)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class Department(Base):
     __tablename__ = "departments"
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     name = Column(String(255), unique=True, nullable=False, index=True)
     description = Column(String(500), nullable=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
     updated_at = Column(
         DateTime,
-        default=lambda: datetime.now(timezone.utc),
-        onupdate=lambda: datetime.now(timezone.utc),
+        default=utcnow,
+        onupdate=utcnow,
     )
 
     # Relationship: one department has many formulas
@@ -22,12 +28,21 @@ class Department(Base):
         "Formula", back_populates="department", cascade="all, delete-orphan"
     )
 
+    @property
+    def formula_count(self):
+        # Needs ``formulas`` loaded up front (see crud.get_department).
+        return len(self.formulas)
+
     def __repr__(self):
         return f"<Department(id={self.id}, name='{self.name}')>"
 
 
 class Formula(Base):
     __tablename__ = "formulas"
+    __table_args__ = (
+        # Backs the department-filtered, id-ordered listings and keyset pages.
+        Index("ix_formulas_department_id_id", "department_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     department_id = Column(
@@ -37,11 +52,11 @@ class Formula(Base):
     description = Column(String(500), nullable=True)
     ast_data = Column(JSON, nullable=False)
     raw_text = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
     updated_at = Column(
         DateTime,
-        default=lambda: datetime.now(timezone.utc),
-        onupdate=lambda: datetime.now(timezone.utc),
+        default=utcnow,
+        onupdate=utcnow,
     )
 
     # Relationship back to department
@@ -62,7 +77,44 @@ class PatientField(Base):
     field_name = Column(String(100), unique=True, nullable=False, index=True)  # e.g. "height"
     label = Column(String(255), nullable=True)    # e.g. "身高 (公尺)"
     field_type = Column(String(50), nullable=False, default="float")  # int / float / boolean / string
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
 
     def __repr__(self):
         return f"<PatientField(id={self.id}, field_name='{self.field_name}')>"
+
+
+class ParseCacheEntry(Base):
+    """AST returned by the AI parser for one input text.
+
+    Keyed by a SHA-256 of (normalized text, model name, prompt version),
+    so a prompt or model change never serves stale results.
+    """
+    __tablename__ = "parse_cache"
+
+    key = Column(String(64), primary_key=True)
+    model_name = Column(String(100), nullable=False)
+    prompt_version = Column(String(20), nullable=False)
+    ast_data = Column(JSON, nullable=False)
+    size = Column(Integer, nullable=False, default=0)  # bytes of the canonical AST
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=utcnow, index=True)
+    last_used_at = Column(DateTime, default=utcnow, index=True)
+
+    def __repr__(self):
+        return f"<ParseCacheEntry(key='{self.key[:12]}', model='{self.model_name}')>"
+
+
+class TableVersion(Base):
+    """Change counter of one table, incremented by every crud write to it.
+
+    ETags of the list and detail endpoints are derived from these, so a
+    conditional GET costs one primary-key lookup instead of a query of the
+    table itself.
+    """
+    __tablename__ = "table_versions"
+
+    name = Column(String(50), primary_key=True)  # e.g. "formulas"
+    version = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<TableVersion(name='{self.name}', version={self.version})>"
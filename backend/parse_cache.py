@@ -0,0 +1,140 @@
+"""Two-tier cache of AI parse results for ``/parse``.
+
+Natural-language documents cost a multi-second Gemini round trip, yet the
+same text is parsed over and over. Results are stored in the
+``parse_cache`` table, keyed by a hash of the normalized text, the model
+name and the prompt version, with a small in-memory LRU in front so
+repeated parses skip the database as well. Entries expire after
+``PARSE_CACHE_TTL`` seconds and the table is kept to
+``PARSE_CACHE_MAX_ENTRIES`` rows, least recently used first out.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import unicodedata
+from datetime import timedelta, timezone
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import crud
+from models import utcnow
+from plan_cache import LRUCache, canonical_json
+
+logger = logging.getLogger(__name__)
+
+PARSE_CACHE_TTL = int(os.getenv("PARSE_CACHE_TTL", str(30 * 24 * 3600)))  # 0 = never expire
+PARSE_CACHE_MAX_ENTRIES = int(os.getenv("PARSE_CACHE_MAX_ENTRIES", "10000"))
+
+memory_cache = LRUCache(
+    max_entries=int(os.getenv("PARSE_CACHE_MEMORY_SIZE", "256")),
+    max_bytes=int(os.getenv("PLAN_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+
+_counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "bypassed": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def normalize_text(text):
+    """Canonical form of a document: NFC, ``\\n`` newlines, no trailing spaces or blank edges."""
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.strip().split("\n"))
+
+
+def cache_key(text, model_name, prompt_version):
+    blob = "\0".join((str(prompt_version), model_name, normalize_text(text)))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _created_after():
+    """Oldest ``created_at`` that is still live, or ``None`` without a TTL."""
+    if PARSE_CACHE_TTL <= 0:
+        return None
+    return utcnow() - timedelta(seconds=PARSE_CACHE_TTL)
+
+
+def _expires_at(created_at):
+    if PARSE_CACHE_TTL <= 0:
+        return None
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.timestamp() + PARSE_CACHE_TTL
+
+
+async def cached_parse(db, text, parse, model_name, prompt_version, bypass=False):
+    """Return ``await parse(text)``, served from the cache when possible.
+
+    With ``bypass`` the cache is not read, but the fresh result replaces
+    any cached one. Database problems only cost the cache, never the parse.
+    """
+    key = cache_key(text, model_name, prompt_version)
+    if bypass:
+        _count("bypassed")
+    else:
+        entry = memory_cache.get(key)
+        if entry is not None:
+            ast, expires_at = entry
+            if expires_at is None or expires_at > time.time():
+                _count("memory_hits")
+                return ast
+            memory_cache.pop(key)
+        try:
+            row = await crud.get_parse_cache_entry(db, key, _created_after())
+        except SQLAlchemyError as e:
+            await db.rollback()
+            row = None
+            logger.warning("Parse cache lookup failed: %s", e)
+        if row is not None:
+            _count("db_hits")
+            memory_cache.put(key, (row.ast_data, _expires_at(row.created_at)), cost=row.size)
+            return row.ast_data
+        _count("misses")
+
+    # Hand the pooled connection back while the model runs.
+    await db.close()
+    ast = await parse(text)
+    size = len(canonical_json(ast))
+    try:
+        row = await crud.save_parse_cache_entry(db, key, model_name, str(prompt_version), ast, size)
+        expires_at = _expires_at(row.created_at)
+        await crud.prune_parse_cache(db, PARSE_CACHE_MAX_ENTRIES, _created_after())
+    except SQLAlchemyError as e:
+        await db.rollback()
+        expires_at = _expires_at(utcnow())
+        logger.warning("Parse cache store failed: %s", e)
+    memory_cache.put(key, (ast, expires_at), cost=size)
+    return ast
+
+
+def stats_counters():
+    """Lookups so far by outcome (memory / database hit, miss, bypassed)."""
+    with _counters_lock:
+        return dict(_counters)
+
+
+async def stats(db):
+    """Hit counters of both tiers plus the size of the persistent table."""
+    counters = stats_counters()
+    lookups = counters["memory_hits"] + counters["db_hits"] + counters["misses"]
+    hits = counters["memory_hits"] + counters["db_hits"]
+    try:
+        entries = await crud.count_parse_cache_entries(db)
+    except SQLAlchemyError:
+        await db.rollback()
+        entries = None
+    return {
+        **counters,
+        "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+        "memory": memory_cache.stats(),
+        "persistent": {
+            "entries": entries,
+            "max_entries": PARSE_CACHE_MAX_ENTRIES,
+            "ttl_seconds": PARSE_CACHE_TTL,
+        },
+    }
@@ -1,32 +1,12 @@
-import google.generativeai as genai
-import os
 import json
-import re
-from dotenv import load_dotenv
 
-load_dotenv()
+from llm import get_provider
 
-api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
-    # Fallback or warning? For now print warning.
-    print("WARNING: GEMINI_API_KEY not found in environment variables.")
-else:
-    genai.configure(api_key=api_key)
+# Bump whenever the prompt below changes so cached parse results are not reused.
+PROMPT_VERSION = "1"
 
-def parse_document_ai(doc_text):
-    if not api_key:
-        raise ValueError("GEMINI_API_KEY is not set. Please check your .env file.")
-
-    # Try using a standard model that is generally available
-    # If gemini-1.5-flash fails, try gemini-pro
-    model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
-    try:
-        model = genai.GenerativeModel(model_name)
-    except:
-        # Fallback
-        model = genai.GenerativeModel('gemini-pro')
-
-    prompt = f"""
+def parse_prompt(doc_text):
+    return f"""
     You are a medical rule parser. Convert the following text rule document into a specific JSON Abstract Syntax Tree (AST) format.
     
     Input Text:
@@ -119,9 +99,13 @@ def parse_document_ai(doc_text):
     7. The "left" in risk_level conditions should always be "score".
     8. Return ONLY the raw JSON. Do not include markdown formatting.
     """
-    
+
+def parse_document_ai(doc_text):
+    provider = get_provider()
+    prompt = parse_prompt(doc_text)
+
     try:
-        response = model.generate_content(prompt)
+        response = provider.generate(prompt)
         text = response.text.strip()
         
         # Clean up potential markdown code blocks if the model ignores the instruction
@@ -0,0 +1,204 @@
+"""Process-wide cache of compiled evaluation plans.
+
+The frontend resends the same AST on every input change, so plans are
+keyed by a hash of the canonical (sorted-key) JSON form of the AST and
+kept in a bounded LRU.
+"""
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from engine import FusedPlan, compile_plan
+
+
+def canonical_json(ast):
+    """Serialise an AST deterministically (sorted keys, no whitespace)."""
+    return json.dumps(ast, sort_keys=True, separators=(",", ":"),
+                      ensure_ascii=False, default=str)
+
+
+def ast_fingerprint(ast):
+    """SHA-256 of the canonical JSON form of ``ast``; returns (digest, size)."""
+    blob = canonical_json(ast).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest(), len(blob)
+
+
+class LRUCache:
+    """Thread-safe LRU bounded by entry count and by an approximate byte cost.
+
+    The cost of an entry is supplied by the caller (the canonical AST size
+    is a good proxy for the size of the compiled plan).
+    """
+
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (value, cost)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, cost=0):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, cost)
+            self._bytes += cost
+            while self._data and (
+                len(self._data) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                _, (_, evicted_cost) = self._data.popitem(last=False)
+                self._bytes -= evicted_cost
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            self._bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+plan_cache = LRUCache(
+    max_entries=int(os.getenv("PLAN_CACHE_SIZE", "256")),
+    max_bytes=int(os.getenv("PLAN_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+
+
+def get_plan(ast):
+    """Return the compiled plan for ``ast``, compiling it on a cache miss."""
+    key, size = ast_fingerprint(ast)
+    plan = plan_cache.get(key)
+    if plan is None:
+        plan = compile_plan(ast)
+        plan_cache.put(key, plan, cost=size)
+    return plan
+
+
+# Plans of formulas stored in the database, keyed by formula id and
+# validated against the row's ``updated_at``.
+formula_plan_cache = LRUCache(
+    max_entries=int(os.getenv("FORMULA_PLAN_CACHE_SIZE", "1024")),
+    max_bytes=int(os.getenv("PLAN_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+
+
+async def get_formula_plan(formula_id, version, load_ast):
+    """Return the plan of a stored formula, awaiting ``load_ast()`` only when
+    no plan for this ``version`` (its ``updated_at``) is cached.
+
+    Returns ``None`` if ``load_ast`` finds no formula.
+    """
+    cached = formula_plan_cache.get(formula_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    ast = await load_ast()
+    if ast is None:
+        return None
+    plan = compile_plan(ast)
+    formula_plan_cache.put(formula_id, (version, plan), cost=len(canonical_json(ast)))
+    return plan
+
+
+def invalidate_formula(formula_id):
+    """Drop the cached plan of a stored formula after it changed or was deleted."""
+    formula_plan_cache.pop(formula_id)
+
+
+# Fused plans over every formula of a department, keyed by department id and
+# validated against the formulas table counter and (id, updated_at) pairs.
+department_plan_cache = LRUCache(
+    max_entries=int(os.getenv("DEPARTMENT_PLAN_CACHE_SIZE", "64")),
+    max_bytes=int(os.getenv("PLAN_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+
+
+async def get_department_plan(department_id, versions, load_asts):
+    """Return the ``FusedPlan`` of a department's formulas.
+
+    ``versions`` identifies the current formulas (e.g. a tuple of
+    ``(id, updated_at)``); ``load_asts()`` is a coroutine function returning
+    ``(formula_id, ast)`` pairs, only awaited when no plan for these
+    versions is cached.
+    """
+    cached = department_plan_cache.get(department_id)
+    if cached is not None and cached[0] == versions:
+        return cached[1]
+    members = list(await load_asts())
+    plan = FusedPlan(members)
+    cost = sum(len(canonical_json(ast)) for _, ast in members)
+    department_plan_cache.put(department_id, (versions, plan), cost=cost)
+    return plan
+
+
+def invalidate_department(department_id):
+    """Drop the fused plan of a department after one of its formulas changed
+    or the department was deleted."""
+    department_plan_cache.pop(department_id)
+
+
+# Evaluation states for /calculate/incremental, keyed by an opaque id.
+state_cache = LRUCache(
+    max_entries=int(os.getenv("STATE_CACHE_SIZE", "4096")),
+    max_bytes=int(os.getenv("PLAN_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+
+
+def get_state(state_id, plan):
+    """Return the saved ``PlanState`` for ``state_id`` if it belongs to ``plan``."""
+    if not state_id:
+        return None
+    cached = state_cache.get(state_id)
+    if cached is None or cached[0] is not plan:
+        return None
+    return cached[1]
+
+
+def save_state(plan, state, replaces=None):
+    """Store ``state`` under a new random id and return the id.
+
+    Ids are always minted here, never taken from the client, so one client
+    cannot plant or overwrite a state another will read. ``replaces`` (an
+    id whose state was just read) is dropped, keeping one entry per session.
+    """
+    state_id = uuid.uuid4().hex
+    state_cache.put(state_id, (plan, state), cost=len(state.context) * 64)
+    if replaces:
+        state_cache.pop(replaces)
+    return state_id
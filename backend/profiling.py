@@ -0,0 +1,61 @@
+"""Opt-in per-request profiling for ``/calculate`` and ``/parse``.
+
+Disabled unless ``PROFILING_ENABLED`` is set. A request then asks for it
+with ``?profile=trace`` (or the ``X-Profile`` header): the response gains
+a ``profile`` object with the evaluation or parse trace. ``cprofile``
+additionally runs the synchronous part of the request under ``cProfile``
+and attaches the top of its ``pstats`` report.
+"""
+import cProfile
+import io
+import os
+import pstats
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+
+MODES = ("trace", "cprofile")
+
+
+class ProfilingDisabledError(Exception):
+    """Profiling was requested but ``PROFILING_ENABLED`` is off."""
+
+
+def requested_mode(request, profile=None):
+    """``None``, ``"trace"`` or ``"cprofile"`` from the ``profile`` query
+    parameter or the ``X-Profile`` header (``1`` / ``true`` mean ``trace``).
+
+    Raises ``ProfilingDisabledError`` for a request while disabled and
+    ``ValueError`` for an unknown mode.
+    """
+    value = profile if profile is not None else request.headers.get("x-profile")
+    if value is None:
+        return None
+    value = value.strip().lower()
+    if value in ("", "0", "false", "no", "off"):
+        return None
+    if not PROFILING_ENABLED:
+        raise ProfilingDisabledError("Profiling is disabled (set PROFILING_ENABLED)")
+    if value in ("1", "true", "yes", "on"):
+        return "trace"
+    if value not in MODES:
+        raise ValueError(f"profile must be one of {', '.join(MODES)}")
+    return value
+
+
+def run(fn, mode, *args, **kwargs):
+    """Call ``fn(*args, **kwargs)``; returns ``(result, report)`` where
+    ``report`` is the cProfile summary in ``cprofile`` mode, else ``None``."""
+    if mode != "cprofile":
+        return fn(*args, **kwargs), None
+    profiler = cProfile.Profile()
+    result = profiler.runcall(fn, *args, **kwargs)
+    return result, summarize(profiler)
+
+
+def summarize(profiler, limit=None):
+    """The top ``limit`` (``PROFILE_TOP_N``) functions by cumulative time, as text."""
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit or PROFILE_TOP_N)
+    return out.getvalue()
@@ -21,7 +21,9 @@ class FormulaInDepartment(BaseModel):
     """Lightweight formula representation used when listing a department."""
     id: int
     name: str
+    description: Optional[str] = None
     created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
     model_config = {"from_attributes": True}
 
@@ -32,6 +34,7 @@ class DepartmentResponse(BaseModel):
     description: Optional[str] = None
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
+    formula_count: int = 0
     formulas: List[FormulaInDepartment] = []
 
     model_config = {"from_attributes": True}
@@ -79,6 +82,22 @@ class FormulaResponse(BaseModel):
     model_config = {"from_attributes": True}
 
 
+FORMULA_FIELDS = tuple(FormulaResponse.model_fields)
+
+
+class FormulaListItem(BaseModel):
+    """A formula in GET /formulas; only the requested ``fields`` are set
+    (and serialized, with ``response_model_exclude_unset``)."""
+    id: Optional[int] = None
+    department_id: Optional[int] = None
+    name: Optional[str] = None
+    description: Optional[str] = None
+    ast_data: Optional[Dict[str, Any]] = None
+    raw_text: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+
 # ──────────────────────────────────────────────
 # PatientField  (field-name registry only, no actual patient values)
 # ──────────────────────────────────────────────
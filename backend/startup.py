@@ -0,0 +1,25 @@
+"""Startup timing, phase by phase.
+
+``app.py`` imports this module first and calls ``mark`` after each
+phase; each phase is the time since the previous mark. The startup hook
+prints the breakdown once, and ``/metrics`` exposes it as
+``startup_phase_seconds``.
+"""
+import time
+
+_last = time.perf_counter()
+phases = {}
+
+
+def mark(name):
+    """Record the time since the previous mark as phase ``name``."""
+    global _last
+    now = time.perf_counter()
+    phases[name] = phases.get(name, 0.0) + now - _last
+    _last = now
+
+
+def report():
+    """One line: every phase in milliseconds and the total."""
+    parts = [f"{name} {seconds * 1000:.0f} ms" for name, seconds in phases.items()]
+    return f"Startup: {', '.join(parts)} (total {sum(phases.values()) * 1000:.0f} ms)"
@@ -0,0 +1,104 @@
+"""HTTP behaviour: plan caches across formula writes, conditional GETs, bulk import."""
+import json
+
+from dsl import parse_formula
+
+
+def score_ast(points):
+    return parse_formula(f"score_name: S\nvariables:\n  x: int\nrules:\n  - if: x >= 2\n    add: {points}\n")
+
+
+def create_formula(client, department, name, points):
+    resp = client.post(
+        f"/departments/{department['id']}/formulas",
+        json={"name": name, "ast_data": score_ast(points)},
+    )
+    assert resp.status_code == 201, resp.text
+    return resp.json()
+
+
+def test_formula_write_invalidates_cached_plans(client, department):
+    formula = create_formula(client, department, "s", 1)
+    calculate = f"/formulas/{formula['id']}/calculate"
+    fused = f"/departments/{department['id']}/calculate"
+    assert client.post(calculate, json={"inputs": {"x": 3}}).json()["score"] == 1
+    assert client.post(fused, json={"inputs": {"x": 3}}).json()["results"][0]["score"] == 1
+
+    resp = client.put(f"/formulas/{formula['id']}", json={"ast_data": score_ast(5)})
+    assert resp.status_code == 200
+    assert client.post(calculate, json={"inputs": {"x": 3}}).json()["score"] == 5
+    assert client.post(fused, json={"inputs": {"x": 3}}).json()["results"][0]["score"] == 5
+
+    assert client.delete(f"/formulas/{formula['id']}").status_code == 200
+    assert client.post(calculate, json={"inputs": {"x": 3}}).status_code == 404
+    assert client.post(fused, json={"inputs": {"x": 3}}).json()["results"] == []
+
+
+def test_matching_etag_answers_304_until_a_write(client, department):
+    create_formula(client, department, "s", 1)
+    url = f"/formulas?department_id={department['id']}"
+    first = client.get(url)
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+
+    again = client.get(url, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+    assert again.content == b""
+
+    create_formula(client, department, "t", 2)
+    changed = client.get(url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert [f["name"] for f in changed.json()] == ["s", "t"]
+
+
+def ndjson(*items):
+    return "".join(json.dumps(item) + "\n" for item in items).encode()
+
+
+def import_formulas(client, department, body, **params):
+    return client.post(
+        f"/departments/{department['id']}/formulas/import",
+        content=body,
+        params=params,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+
+def test_import_rejects_duplicates(client, department):
+    resp = import_formulas(client, department, ndjson(
+        {"name": "a", "ast_data": score_ast(1)},
+        {"name": "a", "ast_data": score_ast(2)},
+    ))
+    assert resp.status_code == 422
+    assert resp.json()["detail"]["errors"] == [
+        {"item": 2, "name": "a", "error": "duplicate name (also item 1)"},
+    ]
+
+    create_formula(client, department, "existing", 1)
+    resp = import_formulas(client, department, ndjson({"name": "existing", "ast_data": score_ast(2)}))
+    assert resp.status_code == 422
+    assert "already exists" in resp.json()["detail"]["errors"][0]["error"]
+    resp = import_formulas(client, department, ndjson({"name": "existing", "ast_data": score_ast(2)}), upsert="true")
+    assert resp.status_code == 200
+    assert client.get(f"/formulas?department_id={department['id']}").json()[0]["ast_data"] == score_ast(2)
+
+
+def test_import_rejects_formulas_that_do_not_compile(client, department):
+    cycle = {
+        "formulas": {"a": "b + 1", "b": "a * 2"},
+        "rules": [{"condition": {"op": ">", "left": "a", "right": 1}, "action": {"type": "add", "value": 1}}],
+    }
+    resp = import_formulas(client, department, ndjson(
+        {"name": "good", "ast_data": score_ast(1)},
+        {"name": "cycle", "ast_data": cycle},
+        {"name": "broken", "raw_text": "score_name: X\nrules:\n  - if: age >=\n    add: 1\n"},
+    ))
+    assert resp.status_code == 422
+    errors = resp.json()["detail"]["errors"]
+    assert [(e["item"], e["name"]) for e in errors] == [(2, "cycle"), (3, "broken")]
+    assert errors[0]["error"].startswith("ast_data: Formula cycle")
+    assert errors[1]["error"].startswith("raw_text: line 3, column ")
+    # Nothing was written, not even the valid item.
+    assert client.get(f"/formulas?department_id={department['id']}").json() == []
@@ -0,0 +1,69 @@
+"""The DSL parser: document shapes, condition splitting and error positions."""
+import pytest
+
+from dsl import DSLSyntaxError, parse_condition_str, parse_formula
+from parser import parse_document
+
+
+def leaf(left, op, right):
+    return {"op": op, "left": left, "right": right}
+
+
+def test_bare_boolean_after_and_is_its_own_condition():
+    assert parse_condition_str("age > 50 and has_disease") == {
+        "compound": "and",
+        "conditions": [leaf("age", ">", 50), leaf("has_disease", "==", True)],
+    }
+
+
+def test_and_or_inside_names_do_not_split():
+    assert parse_condition_str("android >= 1 or has_disease_or_risk") == {
+        "compound": "or",
+        "conditions": [leaf("android", ">=", 1), leaf("has_disease_or_risk", "==", True)],
+    }
+
+
+def test_and_binds_tighter_than_or_and_parentheses_group():
+    assert parse_condition_str("a > 1 or b > 2 and c > 3") == {
+        "compound": "or",
+        "conditions": [
+            leaf("a", ">", 1),
+            {"compound": "and", "conditions": [leaf("b", ">", 2), leaf("c", ">", 3)]},
+        ],
+    }
+    assert parse_condition_str("(a > 1 or b > 2) and c > 3")["compound"] == "and"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("diabetes is true", leaf("diabetes", "==", True)),
+    ("diabetes IS NOT false", leaf("diabetes", "!=", False)),
+    ("bmi >= 25.0", leaf("bmi", ">=", 25)),
+    ("bmi < 18.5", leaf("bmi", "<", 18.5)),
+])
+def test_simple_conditions(text, expected):
+    assert parse_condition_str(text) == expected
+
+
+@pytest.mark.parametrize("text, line, column", [
+    ("score_name: X\nvariables:\n  age: int\nrules:\n  - if: age >= \n    add: 1\n", 5, 15),
+    ("score_name: X\nrules:\n  - if: age >= 65\n    add: one\n", 4, 10),
+    ("score_name: X\nformulas:\n  bmi: weight / (height *\n", 3, 26),
+])
+def test_errors_report_line_and_column(text, line, column):
+    with pytest.raises(DSLSyntaxError) as info:
+        parse_formula(text)
+    assert (info.value.line, info.value.column) == (line, column)
+    assert str(info.value).startswith(f"line {line}, column {column}: ")
+
+
+def test_condition_error_position():
+    with pytest.raises(DSLSyntaxError) as info:
+        parse_condition_str("age >> 3")
+    assert (info.value.line, info.value.column) == (1, 6)
+
+
+def test_parse_document_uses_the_same_parser():
+    text = "score_name: S\nvariables:\n  age: int\nrules:\n  - if: age >= 65 and has_disease\n    add: 2\n"
+    assert parse_document(text)["rules"] == parse_formula(text)["rules"]
+    with pytest.raises(DSLSyntaxError):
+        parse_document("score_name: S\nrules:\n  - if: age >=\n    add: 1\n")
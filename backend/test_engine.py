@@ -0,0 +1,178 @@
+"""Compiled plans against the interpreter they replaced.
+
+``baseline_calculate`` is the pre-plan ``/calculate``: every input is
+``re.sub``-ed into every formula and the text ``eval``-ed, then rules and
+risk levels go through ``evaluate_condition`` one by one. Every other
+evaluator (compiled, incremental, fused, batch) must agree with it.
+"""
+import itertools
+import math
+import re
+
+import pytest
+
+from batch import evaluate_batch
+from dsl import parse_formula
+from engine import FusedPlan, build_context, compile_condition, compile_plan, evaluate_condition
+
+_ALLOWED = {"__builtins__": {}, "sqrt": math.sqrt, "pow": pow, "abs": abs, "True": True, "False": False}
+
+
+def _substitute(expr, context):
+    for name, value in context.items():
+        if isinstance(value, bool):
+            replacement = "True" if value else "False"
+        else:
+            replacement = str(value)
+        expr = re.sub(r"\b" + name + r"\b", replacement, expr)
+    return expr
+
+
+def _risk_level(ast, context, score):
+    for risk in ast.get("risk_levels") or []:
+        if risk and "condition" in risk and evaluate_condition(risk["condition"], {**context, "score": score}):
+            return risk.get("text", "")
+    return None
+
+
+def baseline_calculate(ast, inputs):
+    context = build_context(inputs)
+    for name, expr in (ast.get("formulas") or {}).items():
+        try:
+            context[name] = eval(_substitute(expr, context), _ALLOWED)
+        except Exception:
+            context[name] = 0
+
+    if ast.get("type") == "formula" and ast.get("formula"):
+        result = round(eval(_substitute(ast["formula"], context), _ALLOWED), 2)
+        return {"result": result, "score": result, "risk_level": _risk_level(ast, context, result)}
+
+    score = 0
+    for rule in ast.get("rules", []):
+        if evaluate_condition(rule["condition"], context) and rule["action"].get("type") == "add":
+            score += rule["action"].get("value", 0)
+    risk_level = _risk_level(ast, context, score)
+    computed = {k: round(v, 2) if isinstance(v, float) else v for k, v in context.items() if k not in inputs}
+    if risk_level:
+        computed["RiskLevel"] = risk_level
+    return {"score": score, "computed": computed, "risk_level": risk_level}
+
+
+# Ladders on one variable are evaluated through a ThresholdIndex, the rest
+# condition by condition; both are covered, on and around each threshold.
+EDGES = parse_formula("""score_name: Edges
+variables:
+  age: int
+  weight: float
+  height: float
+  has_disease: boolean
+formulas:
+  bmi: weight / (height * height)
+  older: age - 65
+rules:
+  - if: age >= 65
+    add: 1
+  - if: age > 80
+    add: 2
+  - if: age < 18
+    add: 1
+  - if: age <= 18
+    add: 1
+  - if: age == 50
+    add: 3
+  - if: age != 40
+    add: 1
+  - if: bmi >= 25 and has_disease
+    add: 2
+  - if: bmi < 18.5 or older > 10
+    add: 1
+  - if: has_disease == false
+    add: 1
+  - if: weight != 70.5
+    add: 1
+risk_levels:
+  - if: score >= 8
+    text: High
+  - if: score >= 4
+    text: Medium
+  - if: score < 4
+    text: Low
+""")
+
+AGES = [17, 18, 18.0, 18.5, 19, 39.99, 40, 40.0, 50, 50.0, 64.99, 65, 80, 80.01, 81, True]
+WEIGHTS = [45, 70.5, 70, 90.25]
+HEIGHTS = [1.75, 0]  # 0: the formula fails and counts as 0
+DISEASE = [True, False, "true", "false", 1, 0]
+
+CASES = [
+    {"age": age, "weight": weight, "height": height, "has_disease": disease}
+    for age, weight, height, disease in itertools.product(AGES, WEIGHTS, HEIGHTS, DISEASE)
+]
+
+
+@pytest.mark.parametrize("inputs", CASES[::7] + [{}, {"age": 70}, {"age": "abc", "weight": "80"}])
+def test_compiled_plan_matches_baseline(inputs):
+    assert compile_plan(EDGES).evaluate(inputs) == baseline_calculate(EDGES, inputs)
+
+
+def test_incremental_update_matches_baseline():
+    plan = compile_plan(EDGES)
+    state = plan.compute(CASES[0])
+    for inputs in CASES[1:]:
+        state = plan.update(state, inputs)
+        assert plan.render(state) == baseline_calculate(EDGES, inputs)
+
+
+def test_fused_plan_matches_baseline():
+    other = parse_formula("score_name: Other\nvariables:\n  age: int\nrules:\n  - if: age >= 65\n    add: 5\n")
+    fused = FusedPlan([("edges", EDGES), ("other", other)])
+    for inputs in CASES[::5]:
+        results = dict(fused.evaluate(inputs))
+        assert results["edges"] == baseline_calculate(EDGES, inputs)
+        assert results["other"] == baseline_calculate(other, inputs)
+
+
+def test_batch_matches_baseline():
+    # The batch path skips the 'true'/'false' string coercion of the
+    # registry; give it the booleans the endpoint would have coerced.
+    rows = [dict(case, has_disease=build_context(case)["has_disease"]) for case in CASES]
+    assert evaluate_batch(EDGES, rows=rows) == [baseline_calculate(EDGES, row) for row in rows]
+
+
+def test_pure_formula_matches_baseline():
+    ast = {
+        "type": "formula",
+        "formula": "weight / (height * height)",
+        "risk_levels": [
+            {"condition": {"op": ">=", "left": "score", "right": 25}, "text": "Overweight"},
+            {"condition": {"op": "<", "left": "score", "right": 25}, "text": "Normal"},
+        ],
+    }
+    for weight, height in itertools.product(WEIGHTS, [1.6, 1.75, 2]):
+        inputs = {"weight": weight, "height": height}
+        assert compile_plan(ast).evaluate(inputs) == baseline_calculate(ast, inputs)
+
+
+@pytest.mark.parametrize("op", [">=", "<=", ">", "<", "==", "!="])
+@pytest.mark.parametrize("value", [9, 10, 10.0, 11, True, "10", None])
+def test_compiled_condition_matches_interpreter(op, value):
+    cond = {"op": op, "left": "x", "right": 10}
+    context = {"x": value}
+    assert compile_condition(cond)(context) == evaluate_condition(cond, context)
+
+
+def test_not_equal_matches():
+    cond = {"op": "!=", "left": "x", "right": 10}
+    assert evaluate_condition(cond, {"x": 9}) is True
+    assert evaluate_condition(cond, {"x": 10.0}) is False
+    assert evaluate_condition(cond, {}) is False  # a missing input never matches
+    ast = {"rules": [{"condition": cond, "action": {"type": "add", "value": 1}}]}
+    assert compile_plan(ast).evaluate({"x": 9})["score"] == 1
+    assert compile_plan(ast).evaluate({"x": 10})["score"] == 0
+
+
+def test_non_numeric_string_scores_formula_zero():
+    ast = parse_formula("score_name: S\nvariables:\n  x: int\nformulas:\n  y: x * 2\n"
+                        "rules:\n  - if: y >= 10\n    add: 1\n")
+    assert compile_plan(ast).evaluate({"x": "abc"})["computed"] == {"y": 0}
+    assert compile_plan(ast).evaluate({"x": "5"}) == {"score": 1, "computed": {"y": 10}, "risk_level": None}
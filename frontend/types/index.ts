@@ -109,6 +109,7 @@ export interface Department {
   description?: string | null;
   created_at?: string | null;
   updated_at?: string | null;
+  formula_count?: number;
   formulas?: FormulaRecord[];
 }
 
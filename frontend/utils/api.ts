@@ -1,6 +1,7 @@
 import type { Department, FormulaRecord } from '@/types';
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_BASE_URL || 'http://localhost:5000';
+const FORMULA_PAGE_SIZE = 500;
 
 // ──────────────────────────────────────────────
 // Department API
@@ -54,12 +55,20 @@ export async function deleteDepartment(id: number): Promise<void> {
 // ──────────────────────────────────────────────
 
 export async function fetchFormulas(departmentId?: number): Promise<FormulaRecord[]> {
-    const url = departmentId
-        ? `${API_BASE_URL}/formulas?department_id=${departmentId}`
-        : `${API_BASE_URL}/formulas`;
-    const res = await fetch(url);
-    if (!res.ok) throw new Error('Failed to fetch formulas');
-    return res.json();
+    // Fetch in pages; follow X-Next-Cursor until the last page.
+    const formulas: FormulaRecord[] = [];
+    let after: string | null = null;
+    do {
+        const params = new URLSearchParams({ limit: String(FORMULA_PAGE_SIZE) });
+        if (departmentId) params.set('department_id', String(departmentId));
+        if (after) params.set('after', after);
+        const query = params.toString();
+        const res = await fetch(`${API_BASE_URL}/formulas${query ? `?${query}` : ''}`);
+        if (!res.ok) throw new Error('Failed to fetch formulas');
+        formulas.push(...(await res.json()));
+        after = res.headers.get('X-Next-Cursor');
+    } while (after);
+    return formulas;
 }
 
 export async function fetchFormula(id: number): Promise<FormulaRecord> {